@@ -0,0 +1,102 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Run the ProtGoCTF calibration (windowSize / ctfDownFactor sweep) on
+synthetic micrographs and print the sweep and the selected setting.
+
+goCTF is replaced by the stub (stub/goctf) emulating the cost and the
+defocus error of each setting (see GOCTF_STUB_MODEL there). Downsampling
+factors other than 1 need Xmipp to rescale the micrographs.
+
+Usage:
+    python benchmarks/bench_calibration.py [numMics] [micSize] [windows]
+                                           [downFactors] [tolerance]
+"""
+
+import os
+import sys
+import time
+import json
+import tempfile
+
+from synthetic import (createParticles, createMicrographs, createProtocol,
+                       writeMicrographFiles, runSteps)
+
+from goctf import Plugin
+
+STUB_GOCTF = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'stub', 'goctf')
+
+
+def main():
+    numMics = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    micSize = int(sys.argv[2]) if len(sys.argv) > 2 else 2048
+    windows = sys.argv[3] if len(sys.argv) > 3 else '256 384 512 768'
+    downFactors = sys.argv[4] if len(sys.argv) > 4 else '1'
+    tolerance = float(sys.argv[5]) if len(sys.argv) > 5 else 15.
+
+    Plugin.getProgram = classmethod(lambda cls: STUB_GOCTF)
+    os.environ.setdefault('GOCTF_STUB_MODEL', '0.05')
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        partSet = createParticles(os.path.join(tmpDir, 'particles.sqlite'),
+                                  numMics * 4, 100, micDim=(micSize, micSize))
+        micDir = os.path.join(tmpDir, 'mics')
+        os.makedirs(micDir)
+        micSet = createMicrographs(os.path.join(tmpDir, 'mics.sqlite'),
+                                   numMics * 4, micDir, dims=(micSize, micSize))
+        writeMicrographFiles(micSet, dims=(micSize, micSize))
+
+        prot = createProtocol(os.path.join(tmpDir, 'goctf'), partSet, micSet,
+                              doCalibration=True, calibrationMics=numMics,
+                              calibrationWindows=windows,
+                              calibrationDownFactors=downFactors,
+                              calibrationTolerance=tolerance)
+        t0 = time.perf_counter()
+        runSteps(prot, ['calibrateStep'])
+        elapsed = time.perf_counter() - t0
+
+        with open(prot._getCalibrationFn()) as f:
+            report = json.load(f)
+
+    print(f"Calibration on {numMics} micrographs of {micSize}x{micSize} px, "
+          f"tolerance {tolerance:0.1f} A: {elapsed:0.2f}s")
+    print(f"{'box':>6}{'down':>7}{'goctf (s)':>11}{'speedup':>9}"
+          f"{'mean dA':>9}{'max dA':>9}")
+    refTime = report['reference']['wallTime']
+    for s in report['sweep']:
+        selected = ' <' if s == report['selected'] else ''
+        if s['meanDelta'] is None:
+            deltas = f"{'failed':>18}"
+        else:
+            deltas = f"{s['meanDelta']:9.1f}{s['maxDelta']:9.1f}"
+        print(f"{s['windowSize']:6d}{s['downFactor']:7.2f}"
+              f"{s['wallTime']:11.2f}{refTime / s['wallTime']:8.2f}x"
+              f"{deltas}{selected}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Benchmark the coordinates conversion of ProtGoCTF: _writeCoordinates
+for all micrographs in a single call, reading the particles columns
+from the set database and, for comparison, iterating the particles
+objects (the fallback used when the columns can not be read).
+
+Usage:
+    python benchmarks/bench_convert.py [numParticles] [numMics]
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+from synthetic import createParticles, createMicrographs, createProtocol
+
+
+def main():
+    numParts = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    numMics = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        partSet = createParticles(os.path.join(tmpDir, 'particles.sqlite'),
+                                  numMics, numParts // numMics)
+        micSet = createMicrographs(os.path.join(tmpDir, 'mics.sqlite'),
+                                   numMics)
+        print(f"{numParts} particles in {numMics} micrographs")
+        print(f"{'mode':>10}{'shifts':>8}{'time (s)':>10}")
+        for mode in ['columns', 'objects']:
+            for applyShifts in [False, True]:
+                prot = createProtocol(
+                    os.path.join(tmpDir, f'{mode}_{applyShifts}'),
+                    partSet, micSet, applyShifts=applyShifts)
+                prot._insertAllSteps()
+                if mode == 'objects':
+                    prot._readMicColumns = prot._readMicColumnsFromParticles
+                t0 = time.perf_counter()
+                prot._writeCoordinates(list(prot.micDict), prot._downFactor,
+                                       prot._getCoordsFn)
+                elapsed = time.perf_counter() - t0
+                print(f"{mode:>10}{str(applyShifts):>8}{elapsed:10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Benchmark the coordinates star files written for goCTF: one writeRow
+call per particle vs. a single writeRows call per micrograph
+(np.savetxt into a buffer is also shown as a reference).
+
+Usage:
+    python benchmarks/bench_coords_writer.py [numParticles] [partsPerMic]
+"""
+
+import io
+import os
+import sys
+import time
+import filecmp
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from goctf.convert import CoordinatesWriter
+
+
+def writeByRow(fn, blocks):
+    writer = CoordinatesWriter(fn)
+    for values in blocks:
+        for row in values.tolist():
+            writer.writeRow(*row)
+    writer.close()
+
+
+def writeByBlock(fn, blocks):
+    writer = CoordinatesWriter(fn)
+    for values in blocks:
+        writer.writeRows(values)
+    writer.close()
+
+
+def writeSavetxt(fn, blocks):
+    with open(fn, 'w') as f:
+        f.write(CoordinatesWriter.HEADER)
+        for values in blocks:
+            buffer = io.StringIO()
+            np.savetxt(buffer, values, fmt='%.2f')
+            f.write(buffer.getvalue())
+
+
+def main():
+    numParts = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    partsPerMic = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    rng = np.random.default_rng(0)
+    values = np.column_stack([rng.uniform(0, 4096, (numParts, 2)),
+                              rng.uniform(10000, 30000, (numParts, 2)),
+                              rng.uniform(0, 180, numParts)])
+    # Each block is written as the coordinates file of a micrograph,
+    # here all go to a single file to compare the outputs
+    blocks = np.array_split(values, max(1, numParts // partsPerMic))
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        results = {}
+        for name, func in [('writeRow', writeByRow),
+                           ('writeRows', writeByBlock),
+                           ('np.savetxt', writeSavetxt)]:
+            fn = os.path.join(tmpDir, name + '.star')
+            t0 = time.perf_counter()
+            func(fn, blocks)
+            results[name] = (fn, time.perf_counter() - t0)
+
+        rowFn, rowTime = results['writeRow']
+        print(f"{numParts} particles, {partsPerMic} per micrograph")
+        for name, (fn, t) in results.items():
+            same = filecmp.cmp(fn, rowFn, shallow=False)
+            print(f"{name:<12}{t:8.2f}s {numParts / t / 1e6:8.2f} M rows/s"
+                  f"{rowTime / t:8.1f}x   same output: {same}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Benchmark the micrograph discovery done in ProtGoCTF._createMicDict:
+full particle scan vs. a single GROUP BY query on the set mapper.
+
+Usage:
+    python benchmarks/bench_micdict.py [numParticles] [numMics]
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+from synthetic import createParticles
+
+from goctf.protocols import ProtGoCTF
+
+
+def scanMics(partSet):
+    """ Particle scan done by _createMicDict before the aggregate query. """
+    micNames = []
+    lastMicId = None
+    for particle in partSet.iterItems(orderBy='_micId'):
+        micId = particle.getMicId()
+        if micId != lastMicId:
+            micNames.append(particle.getCoordinate().getMicName())
+            lastMicId = micId
+    return micNames
+
+
+def main():
+    numParts = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    numMics = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        fn = os.path.join(tmpDir, 'particles.sqlite')
+        t0 = time.time()
+        partSet = createParticles(fn, numMics, numParts // numMics)
+        print(f"Created {partSet.getSize()} particles in "
+              f"{numMics} micrographs: {time.time() - t0:.1f}s")
+
+        t0 = time.time()
+        scanned = scanMics(partSet)
+        tScan = time.time() - t0
+
+        t0 = time.time()
+        counts = ProtGoCTF()._getMicParticleCounts(partSet)
+        tQuery = time.time() - t0
+
+        assert scanned == [m[1] for m in counts]
+        assert sum(m[2] for m in counts) == partSet.getSize()
+        print(f"Particle scan:   {tScan:8.2f}s")
+        print(f"Aggregate query: {tQuery:8.2f}s ({tScan / tQuery:.0f}x)")
+        partSet.close()
+
+
+if __name__ == '__main__':
+    main()
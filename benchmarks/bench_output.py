@@ -0,0 +1,137 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Benchmark the merge of goCTF results done in ProtGoCTF.createOutputStep:
+cloned md.Row lists and particle clones vs. per micrograph arrays.
+Each merge runs in its own process to measure its peak RSS.
+
+Usage:
+    python benchmarks/bench_output.py [numParticles] [numMics]
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import subprocess
+
+import psutil
+
+from synthetic import (createParticles, createMicrographs, createProtocol,
+                       runSteps, writeGoCtfOutputs)
+
+import pyworkflow.utils as pwutils
+import pwem.emlib.metadata as md
+from pwem.objects import SetOfParticles, SetOfMicrographs
+
+from goctf.convert import CTF_DICT
+
+
+def rowToCtfModel(ctfRow, ctfModel):
+    """ CTF conversion of each row done by the merge before arrays. """
+    for attr, label in CTF_DICT.items():
+        getattr(ctfModel, attr).set(ctfRow.getValue(label))
+    ctfModel.standardize()
+
+
+def mergeRowClones(prot):
+    """ Merge done by createOutputStep before using arrays. """
+    inputParts = prot.inputParticles.get()
+    partSet = prot._createSetOfParticles()
+    partSet.copyInfo(inputParts)
+    state = {'rows': None, 'counter': 0}
+
+    def _newMic(mic):
+        micFn = mic.getFileName()
+        micPath = prot._getTmpPath(pwutils.removeBaseExt(micFn))
+        ctfFn = os.path.join(micPath,
+                             prot._getOutputPath(micFn, ext="_goCTF.star"))
+        state['counter'] = 0
+        state['rows'] = [row.clone() for row in md.iterRows(ctfFn)]
+
+    for particle in prot._iterParticlesMic(newMicCallback=_newMic):
+        newPart = particle.clone()
+        row = state['rows'][state['counter']]
+        state['counter'] += 1
+        rowToCtfModel(row, newPart.getCTF())
+        partSet.append(newPart)
+
+    partSet.write()
+    partSet.close()
+
+
+def runMerge(mode, tmpDir):
+    partSet = SetOfParticles(filename=os.path.join(tmpDir, 'particles.sqlite'))
+    partSet.loadAllProperties()
+    micSet = SetOfMicrographs(filename=os.path.join(tmpDir, 'micrographs.sqlite'))
+    micSet.loadAllProperties()
+    prot = createProtocol(os.path.join(tmpDir, 'run'), partSet, micSet)
+    prot._insertAllSteps()
+    pwutils.cleanPath(prot._getPath('particles.sqlite'))
+
+    rssStart = psutil.Process().memory_info().rss
+    t0 = time.time()
+    if mode == 'rows':
+        mergeRowClones(prot)
+    else:
+        prot.createOutputStep()
+    wallTime = time.time() - t0
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(json.dumps({'wall': wallTime, 'peakRss': maxRss,
+                      'peakRssIncrease': maxRss - rssStart}))
+
+
+def main():
+    numParts = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    numMics = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        partSet = createParticles(os.path.join(tmpDir, 'particles.sqlite'),
+                                  numMics, numParts // numMics)
+        micSet = createMicrographs(os.path.join(tmpDir, 'micrographs.sqlite'),
+                                   numMics)
+        prot = createProtocol(os.path.join(tmpDir, 'run'), partSet, micSet)
+        runSteps(prot, ['convertInputStep'])
+        writeGoCtfOutputs(prot)
+        print(f"Merging {partSet.getSize()} particles from {numMics} micrographs")
+
+        for mode in ['rows', 'arrays']:
+            output = subprocess.check_output(
+                [sys.executable, __file__, '--merge', mode, tmpDir],
+                stderr=subprocess.DEVNULL, text=True)
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{mode:8s} wall: {result['wall']:8.1f}s  "
+                  f"peak RSS: {result['peakRss'] / 2**20:8.1f} MB  "
+                  f"(+{result['peakRssIncrease'] / 2**20:.1f} MB during merge)")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--merge':
+        runMerge(sys.argv[2], sys.argv[3])
+    else:
+        main()
@@ -0,0 +1,88 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Benchmark the defocus plane fitting of ProtGoCTF: the fit alone
+(convert.fitDefocusPlanes on all particles at once) and the output
+database written by createOutputStep with and without fitPlanes.
+
+Usage:
+    python benchmarks/bench_planes.py [numParticles] [numMics]
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+
+from synthetic import (createParticles, createMicrographs, createProtocol,
+                       runSteps, writeGoCtfOutputs)
+
+import pyworkflow.utils as pwutils
+
+from goctf.convert import fitDefocusPlanes
+
+
+def main():
+    numParts = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    numMics = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    rng = np.random.default_rng(0)
+    groups = np.repeat(np.arange(numMics), numParts // numMics)
+    coords = rng.uniform(0, 4096, size=(len(groups), 2))
+    defocus = (rng.uniform(8000, 30000, numMics)[groups] +
+               coords @ [0.3, -0.2] + rng.normal(0, 50, len(groups)))
+    t0 = time.perf_counter()
+    fitDefocusPlanes(groups, coords, defocus, threshold=5)
+    elapsed = time.perf_counter() - t0
+    print(f"fitDefocusPlanes: {len(groups)} particles in {elapsed:0.2f}s "
+          f"({len(groups) / elapsed * 60 / 1e6:0.1f}M particles/min)")
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        partSet = createParticles(os.path.join(tmpDir, 'particles.sqlite'),
+                                  numMics, numParts // numMics)
+        micSet = createMicrographs(os.path.join(tmpDir, 'micrographs.sqlite'),
+                                   numMics)
+        prot = createProtocol(os.path.join(tmpDir, 'run'), partSet, micSet)
+        runSteps(prot, ['convertInputStep'])
+        writeGoCtfOutputs(prot)
+
+        for fitPlanes in [False, True]:
+            # A new protocol instance, the output can be defined only once
+            prot = createProtocol(os.path.join(tmpDir, 'run'), partSet,
+                                  micSet, fitPlanes=fitPlanes)
+            prot._insertAllSteps()
+            pwutils.cleanPath(prot._getPath('particles.sqlite'))
+            t0 = time.perf_counter()
+            prot.createOutputStep()
+            elapsed = time.perf_counter() - t0
+            print(f"createOutputStep, fitPlanes={fitPlanes}: "
+                  f"{elapsed:0.2f}s")
+
+
+if __name__ == '__main__':
+    main()
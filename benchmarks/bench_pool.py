@@ -0,0 +1,118 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Measure how the micrographs throughput of ProtGoCTF scales with the
+number of cores, running the refinement with the steps threads (as the
+pyworkflow executor would do) and with the processes pool.
+
+Micrographs are written as int16 MRC, so they are converted to float
+before calling the stub goctf (stub/goctf) and each job has some
+ImageHandler work and a process launch. With micDtype float32 they are
+linked instead, for environments without the ImageHandler conversion.
+Set GOCTF_STUB_MODEL to emulate the goCTF run time.
+
+Usage:
+    python benchmarks/bench_pool.py [numMics] [micSize] [maxWorkers] [micDtype]
+"""
+
+import os
+import sys
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from synthetic import (createParticles, createMicrographs, createProtocol,
+                       writeMicrographFiles, runSteps)
+
+from goctf import Plugin
+from goctf.constants import PARALLEL_THREADS, PARALLEL_PROCESSES
+
+STUB_GOCTF = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'stub', 'goctf')
+
+
+def runRefine(prot, numWorkers):
+    """ Run the refinement steps of prot with numWorkers and return
+    the elapsed time. """
+    steps = [step for step in prot._steps
+             if step.funcName in ['refineCtfStep', 'refineCtfPoolStep']]
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(numWorkers) as executor:
+        for _ in executor.map(lambda step: step._runFunc(), steps):
+            pass
+    if prot._jobPool is not None:
+        prot._jobPool.shutdown()
+    elapsed = time.perf_counter() - t0
+
+    for mic in prot.micDict.values():
+        assert os.path.exists(prot._getCtfFn(mic.getFileName()))
+    return elapsed
+
+
+def main():
+    numMics = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    micSize = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    maxWorkers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    micDtype = np.dtype(sys.argv[4] if len(sys.argv) > 4 else 'int16')
+
+    Plugin.getProgram = classmethod(lambda cls: STUB_GOCTF)
+    workersList = [1]
+    while workersList[-1] * 2 <= maxWorkers:
+        workersList.append(workersList[-1] * 2)
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        partSet = createParticles(os.path.join(tmpDir, 'particles.sqlite'),
+                                  numMics, 50, micDim=(micSize, micSize))
+        micDir = os.path.join(tmpDir, 'mics')
+        os.makedirs(micDir)
+        micSet = createMicrographs(os.path.join(tmpDir, 'mics.sqlite'),
+                                   numMics, micDir, dims=(micSize, micSize))
+        writeMicrographFiles(micSet, dims=(micSize, micSize), dtype=micDtype)
+
+        print(f"{numMics} micrographs of {micSize}x{micSize} px, "
+              f"{os.cpu_count()} cores")
+        print(f"{'workers':>8}{'threads mic/s':>16}{'speedup':>9}"
+              f"{'pool mic/s':>13}{'speedup':>9}")
+        base = {}
+        for numWorkers in workersList:
+            line = f"{numWorkers:8d}"
+            for mode in [PARALLEL_THREADS, PARALLEL_PROCESSES]:
+                workingDir = os.path.join(tmpDir, f'goctf_{mode}_{numWorkers}')
+                prot = createProtocol(workingDir, partSet, micSet,
+                                      parallelMode=mode,
+                                      numberOfThreads=numWorkers + 1)
+                runSteps(prot, ['convertInputStep'])
+                elapsed = runRefine(prot, numWorkers)
+                throughput = numMics / elapsed
+                base.setdefault(mode, throughput)
+                line += f"{throughput:16.2f}{throughput / base[mode]:8.2f}x"
+            print(line, flush=True)
+
+
+if __name__ == '__main__':
+    main()
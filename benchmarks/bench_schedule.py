@@ -0,0 +1,150 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Simulate the execution of the ProtGoCTF steps with a number of threads
+and compare the makespan when steps are inserted in micrograph order
+(as done before) and by decreasing estimated cost.
+
+The simulated executor behaves as the pyworkflow one: when a thread is
+free, it runs the first step in the list whose prerequisites are done.
+
+Usage:
+    python benchmarks/bench_schedule.py [numMics] [numThreads] [seed]
+"""
+
+import sys
+import heapq
+import types
+
+import numpy as np
+
+from goctf.protocols import ProtGoCTF
+
+# Cost of converting the coordinates of a particle, in the same
+# units as the refinement cost
+CONVERT_COST = 0.02
+
+
+def createProtocol(counts, numThreads, micsPerStep=1):
+    """ Protocol with the micrographs dictionaries filled for the given
+    number of particles per micrograph, recording inserted steps. """
+    prot = ProtGoCTF()
+    prot.numberOfThreads.set(numThreads)
+    prot.micsPerStep.set(micsPerStep)
+    micSet = types.SimpleNamespace(getDim=lambda: (4096, 4096, 1))
+    prot._getMicrographs = lambda: micSet
+    prot.micDict, prot.micSizeDict, prot.micIdDict = {}, {}, {}
+    for i, count in enumerate(counts, start=1):
+        micName = 'mic%05d' % i
+        prot.micDict[micName] = types.SimpleNamespace(
+            getFileName=lambda m=micName: m)
+        prot.micSizeDict[micName] = int(count)
+        prot.micIdDict[micName] = i
+
+    prot.steps = []
+
+    def _insertFunctionStep(funcName, *args, prerequisites=None, **kwargs):
+        prot.steps.append((funcName, args, prerequisites or []))
+        return len(prot.steps)
+
+    prot._insertFunctionStep = _insertFunctionStep
+    return prot
+
+
+def previousOrder(prot):
+    """ Steps as they were inserted before: each conversion
+    step followed by the refinement of its micrographs. """
+    steps = []
+    for chunk in prot._getConvertChunks(list(prot.micDict)):
+        steps.append(('convertInputStep', (chunk,), []))
+        convId = len(steps)
+        for micName in chunk:
+            steps.append(('refineCtfStep', (micName,), [convId]))
+    return steps
+
+
+def stepCost(prot, step, micCost):
+    funcName, args, _ = step
+    if funcName == 'convertInputStep':
+        return CONVERT_COST * sum(prot.micSizeDict[m] for m in args[0])
+    return sum(prot.micSizeDict[m] + micCost for m in args)
+
+
+def simulate(prot, steps, numThreads):
+    """ Return the makespan of running steps with numThreads. """
+    micCost = prot._getMicCost()
+    costs = [stepCost(prot, step, micCost) for step in steps]
+    pending = list(range(len(steps)))
+    done = set()
+    running = []  # heap of (endTime, stepIndex)
+    now = 0.
+
+    while pending or running:
+        launched = True
+        while launched and len(running) < numThreads:
+            launched = False
+            for i in pending:
+                if all(p - 1 in done for p in steps[i][2]):
+                    heapq.heappush(running, (now + costs[i], i))
+                    pending.remove(i)
+                    launched = True
+                    break
+        now, i = heapq.heappop(running)
+        done.add(i)
+
+    return now
+
+
+def main():
+    numMics = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    numThreads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+    rng = np.random.default_rng(seed)
+    scenarios = {
+        'lognormal': rng.lognormal(4, 0.8, numMics),
+        'dense tail': np.concatenate([rng.poisson(40, numMics - numMics // 50),
+                                      rng.poisson(2000, numMics // 50)]),
+        'uniform': rng.poisson(100, numMics),
+    }
+
+    print(f"{numMics} micrographs, {numThreads} threads")
+    print(f"{'scenario':<12}{'lower bound':>14}{'mic order':>12}"
+          f"{'cost order':>12}{'gain':>8}")
+    for name, counts in scenarios.items():
+        prot = createProtocol(counts, numThreads)
+        before = simulate(prot, previousOrder(prot), numThreads)
+        prot._insertNewMicsSteps(list(prot.micDict))
+        after = simulate(prot, prot.steps, numThreads)
+        micCost = prot._getMicCost()
+        costs = [stepCost(prot, s, micCost) for s in prot.steps]
+        bound = max(sum(costs) / numThreads, max(costs))
+        print(f"{name:<12}{bound:14.0f}{before:12.0f}{after:12.0f}"
+              f"{(before - after) / before:8.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Benchmark reading the defocus values of goCTF output files:
+md.iterRows (one Row per particle), md.MetaData columns and the
+native memory mapped reader (goctf.convert.readStarColumns).
+
+Usage:
+    python benchmarks/bench_star_reader.py [rowsPerFile ...]
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pwem.emlib.metadata as md
+
+from goctf.convert import CTF_DICT, readStarColumns
+from synthetic import GOCTF_HEADER
+
+LABELS = list(CTF_DICT.values())
+NAMES = [md.label2Str(label) for label in LABELS]
+
+
+def readIterRows(fn):
+    return np.array([[row.getValue(label) for label in LABELS]
+                     for row in md.iterRows(fn)]).reshape(-1, 3)
+
+
+def readMetaData(fn):
+    mdCtf = md.MetaData(fn)
+    return np.array([mdCtf.getColumnValues(label) for label in LABELS],
+                    dtype=float).reshape(3, -1).T
+
+
+def readNative(fn):
+    columns = readStarColumns(fn, NAMES)
+    return np.column_stack([columns[name] for name in NAMES])
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [100, 1000, 10000, 100000]
+    rng = np.random.default_rng(0)
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        print(f"{'rows':>8}{'iterRows':>12}{'MetaData':>12}"
+              f"{'native':>12}{'speedup':>10}")
+        for n in sizes:
+            fn = os.path.join(tmpDir, 'mic%d_goCTF.star' % n)
+            values = np.column_stack([rng.uniform(0, 4096, (n, 2)),
+                                      rng.uniform(5000, 30000, (n, 2)),
+                                      rng.uniform(0, 180, n)])
+            with open(fn, 'w') as f:
+                f.write(GOCTF_HEADER)
+                np.savetxt(f, values, fmt='%.2f')
+
+            # Read several times the small files to have measurable times
+            repeat = max(1, 100000 // n)
+            times = []
+            results = []
+            for func in [readIterRows, readMetaData, readNative]:
+                t0 = time.perf_counter()
+                for _ in range(repeat):
+                    result = func(fn)
+                times.append((time.perf_counter() - t0) / repeat)
+                results.append(result)
+
+            assert all(np.array_equal(r, results[0]) for r in results)
+            print(f"{n:8d}" + ''.join(f"{t * 1000:10.2f}ms" for t in times)
+                  + f"{times[0] / times[2]:9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Measure the particle subset mode of ProtGoCTF: how many particles goCTF
+refines, the time to select the subsets and interpolate the defocus of
+all particles, and the residual against the refined defocus.
+
+The refined defocus is emulated as in synthetic.createParticles: a tilted
+plane per micrograph plus 50 A of per particle noise.
+
+Usage:
+    python benchmarks/bench_subset.py [numMics] [partsPerMic]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from goctf.convert import selectSubset, interpolateCtfValues
+
+
+def main():
+    numMics = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    partsPerMic = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    rng = np.random.default_rng(0)
+    mics = []
+    for _ in range(numMics):
+        coords = rng.integers(0, 4096, size=(partsPerMic, 2)).astype(float)
+        tilt = rng.normal(0, 0.5, size=2)
+        defocus = rng.uniform(8000, 30000) + coords @ tilt
+        refined = defocus + rng.normal(0, 50, size=partsPerMic)
+        astig = rng.uniform(100, 1000)
+        values = np.column_stack([refined + astig / 2, refined - astig / 2,
+                                  np.full(partsPerMic, 45.)])
+        mics.append((coords, values, defocus))
+
+    print(f"{numMics} micrographs, {partsPerMic} particles each")
+    print(f"{'subset':>7}{'refined %':>11}{'interp (s)':>12}"
+          f"{'vs refined A':>14}{'vs true A':>11}")
+    for size in [10, 25, 50, 100, 200]:
+        t0 = time.perf_counter()
+        residuals, errors = [], []
+        for coords, values, defocus in mics:
+            subset = selectSubset(coords, size)
+            interpolated = interpolateCtfValues(coords[subset],
+                                                values[subset], coords)
+            meanDefocus = interpolated[:, :2].mean(axis=1)
+            residuals.append(meanDefocus - values[:, :2].mean(axis=1))
+            errors.append(meanDefocus - defocus)
+        elapsed = time.perf_counter() - t0
+        rms = [np.sqrt((np.concatenate(r) ** 2).mean())
+               for r in [residuals, errors]]
+        print(f"{size:7d}{100 * min(size, partsPerMic) / partsPerMic:10.1f}%"
+              f"{elapsed:12.2f}{rms[0]:14.1f}{rms[1]:11.1f}")
+
+
+if __name__ == '__main__':
+    main()
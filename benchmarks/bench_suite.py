@@ -0,0 +1,153 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Offline benchmark of ProtGoCTF: the protocol steps are run with synthetic
+inputs and a stub goctf program (stub/goctf) that copies the coordinates
+as refined values, so only the plugin overhead is measured.
+
+Each scenario times the micrograph discovery (_createMicDict), the insertion
+of the steps and the execution (serially, in insertion order) of the
+convertInputStep, refineCtfStep and createOutputStep steps. Results are
+written to a JSON file to be compared between versions.
+
+Usage:
+    python benchmarks/bench_suite.py [-o results.json] [scenario ...]
+Scenarios: %s
+"""
+
+import os
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+from synthetic import (createParticles, createMicrographs, createProtocol,
+                       writeMicrographFiles)
+
+from goctf import Plugin
+
+# Scenario name: (number of particles, number of micrographs)
+SCENARIOS = {
+    '10k': (10000, 100),
+    '100k': (100000, 500),
+    '1M': (1000000, 2000),
+}
+
+__doc__ %= ', '.join(SCENARIOS)
+
+STUB_GOCTF = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'stub', 'goctf')
+
+
+def _timed(func, times, key):
+    """ Wrap func to add its execution time to times[key]. """
+    def _wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            times[key] = times.get(key, 0.) + time.perf_counter() - t0
+    return _wrapper
+
+
+def runScenario(name, tmpDir):
+    numParts, numMics = SCENARIOS[name]
+    result = {'particles': numParts, 'micrographs': numMics}
+    times = result['times'] = {}
+
+    t0 = time.perf_counter()
+    partSet = createParticles(os.path.join(tmpDir, 'particles.sqlite'),
+                              numMics, numParts // numMics)
+    micDir = os.path.join(tmpDir, 'mics')
+    os.makedirs(micDir)
+    micSet = createMicrographs(os.path.join(tmpDir, 'mics.sqlite'),
+                               numMics, micDir)
+    writeMicrographFiles(micSet)
+    result['setupTime'] = time.perf_counter() - t0
+
+    prot = createProtocol(os.path.join(tmpDir, 'goctf'), partSet, micSet)
+    prot._createMicDict = _timed(prot._createMicDict, times, '_createMicDict')
+    _timed(prot._insertAllSteps, times, '_insertAllSteps')()
+
+    # Run the steps serially, as with one thread
+    for funcName in ['convertInputStep', 'refineCtfStep', 'createOutputStep']:
+        for step in prot._steps:
+            if step.funcName == funcName:
+                _timed(step._runFunc, times, funcName)()
+                step.setStatus('finished')
+
+    output = prot.outputParticles
+    assert output.getSize() == partSet.getSize(), \
+        f"{output.getSize()} output particles, expected {partSet.getSize()}"
+    output.close()
+    partSet.close()
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS),
+                        choices=list(SCENARIOS), metavar='scenario')
+    parser.add_argument('-o', '--output', default='bench_results.json',
+                        help='JSON file to write the results')
+    args = parser.parse_args()
+
+    # Use the stub instead of the installed goctf
+    Plugin.getProgram = classmethod(lambda cls: STUB_GOCTF)
+
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], text=True,
+            cwd=os.path.dirname(STUB_GOCTF), stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    results = {'date': datetime.now().isoformat(timespec='seconds'),
+               'commit': commit,
+               'python': platform.python_version(),
+               'host': platform.node(),
+               'scenarios': {}}
+
+    for name in args.scenarios:
+        print(f"Running scenario {name}...", flush=True)
+        with tempfile.TemporaryDirectory() as tmpDir:
+            result = runScenario(name, tmpDir)
+        results['scenarios'][name] = result
+        for key, value in result['times'].items():
+            print(f"    {key:<18} {value:10.2f}s")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Generators of synthetic goCTF inputs used by the benchmark scripts.
+
+Sets are created through pyworkflow with a single template item, so the
+database schema is exactly the one Scipion writes, and then the rest of
+the rows are bulk inserted with sqlite3. This allows to create
+multi-million particle sets in seconds.
+"""
+
+import os
+import sys
+import json
+import sqlite3
+
+import numpy as np
+import mrcfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyworkflow.utils.process import runJob
+from pwem.constants import ALIGN_2D
+from pwem.objects import (SetOfParticles, Particle, Coordinate, CTFModel,
+                          Transform, SetOfMicrographs, Micrograph, Acquisition)
+
+
+SAMPLING_RATE = 1.0
+
+
+def micName(micId):
+    return 'mic%06d' % micId
+
+
+def _getColumns(conn):
+    """ Return a dict attribute label -> column name. """
+    return {label: col for label, col in
+            conn.execute("SELECT label_property, column_name FROM Classes")}
+
+
+def createParticles(filename, numMics, partsPerMic, alignment=ALIGN_2D,
+                    micDim=(4096, 4096), seed=0):
+    """ Create a SetOfParticles sqlite in filename.
+    Params:
+        numMics: number of micrographs with particles.
+        partsPerMic: number of particles per micrograph, either an int
+            or a sequence with one value per micrograph.
+        alignment: alignment type stored in the set.
+        micDim: micrograph dimensions used to place the coordinates.
+    """
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    rng = np.random.default_rng(seed)
+    counts = np.broadcast_to(np.asarray(partsPerMic, dtype=int), (numMics,))
+
+    partSet = SetOfParticles(filename=filename)
+    partSet.setSamplingRate(SAMPLING_RATE)
+    partSet.setAlignment(alignment)
+    partSet.setHasCTF(True)
+    partSet.setAcquisition(_createAcquisition())
+    part = Particle(location=(1, 'particles.mrcs'))
+    coord = Coordinate()
+    coord.setMicId(1)
+    coord.setMicName(micName(1))
+    part.setCoordinate(coord)
+    part.setMicId(1)
+    ctf = CTFModel()
+    ctf.setStandardDefocus(20000., 19000., 45.)
+    part.setCTF(ctf)
+    part.setTransform(Transform())
+    partSet.append(part)
+    partSet.write()
+    partSet.close()
+
+    conn = sqlite3.connect(filename)
+    cols = _getColumns(conn)
+    template = conn.execute("SELECT * FROM Objects").fetchone()
+    names = [d[0] for d in conn.execute("SELECT * FROM Objects").description]
+    conn.execute("DELETE FROM Objects")
+    pos = {n: i for i, n in enumerate(names)}
+
+    def _set(row, label, value):
+        row[pos[cols[label] if label in cols else label]] = value
+
+    def _rows():
+        partId = 0
+        for i, n in enumerate(counts):
+            micId = i + 1
+            # Defocus follows a tilted plane across the micrograph
+            base = rng.uniform(8000, 30000)
+            tilt = rng.normal(0, 0.5, size=2)
+            xs = rng.integers(0, micDim[0], size=n)
+            ys = rng.integers(0, micDim[1], size=n)
+            defU = base + tilt[0] * xs + tilt[1] * ys + rng.normal(0, 50, size=n)
+            astig = rng.uniform(100, 1000, size=n)
+            angles = rng.uniform(0, 180, size=n)
+            shifts = rng.normal(0, 5, size=(n, 2))
+            for j in range(n):
+                partId += 1
+                row = list(template)
+                _set(row, 'id', partId)
+                _set(row, '_index', partId)
+                _set(row, '_ctfModel._defocusU', float(defU[j]))
+                _set(row, '_ctfModel._defocusV', float(defU[j] - astig[j]))
+                _set(row, '_ctfModel._defocusAngle', float(angles[j]))
+                _set(row, '_ctfModel._defocusRatio',
+                     float(defU[j] / (defU[j] - astig[j])))
+                _set(row, '_transform._matrix',
+                     json.dumps([[1.0, 0.0, 0.0, float(shifts[j, 0])],
+                                 [0.0, 1.0, 0.0, float(shifts[j, 1])],
+                                 [0.0, 0.0, 1.0, 0.0],
+                                 [0.0, 0.0, 0.0, 1.0]]))
+                _set(row, '_coordinate._x', int(xs[j]))
+                _set(row, '_coordinate._y', int(ys[j]))
+                _set(row, '_coordinate._micId', micId)
+                _set(row, '_coordinate._micName', micName(micId))
+                _set(row, '_micId', micId)
+                yield row
+
+    placeholders = ','.join('?' * len(names))
+    with conn:
+        conn.executemany("INSERT INTO Objects VALUES (%s)" % placeholders,
+                         _rows())
+        conn.execute("UPDATE Properties SET value=? WHERE key='_size'",
+                     (str(int(counts.sum())),))
+    conn.close()
+
+    partSet = SetOfParticles(filename=filename)
+    partSet.loadAllProperties()
+    return partSet
+
+
+def createMicrographs(filename, numMics, micDir='', dims=(4096, 4096),
+                      samplingRate=SAMPLING_RATE):
+    """ Create a SetOfMicrographs sqlite with numMics items whose names
+    match the ones used in createParticles. Files are expected to be
+    at micDir/<micName>.mrc (they are not created here).
+    """
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    micSet = SetOfMicrographs(filename=filename)
+    micSet.setSamplingRate(samplingRate)
+    micSet.setAcquisition(_createAcquisition())
+    for i in range(numMics):
+        name = micName(i + 1)
+        mic = Micrograph(location=os.path.join(micDir, name + '.mrc'))
+        mic.setMicName(name)
+        micSet.append(mic)
+    micSet.setDim((dims[0], dims[1], 1))
+    micSet.write()
+
+    return micSet
+
+
+class LocalExecutor:
+    """ Run the protocol jobs in this machine, out of a project. """
+    def runJob(self, log, programName, params, numberOfMpi=1,
+               numberOfThreads=1, env=None, cwd=None, executable=None):
+        runJob(log, programName, params, env=env, cwd=cwd,
+               executable=executable)
+
+
+def writeMicrographFiles(micSet, dims=(256, 256), dtype=np.float32, seed=0):
+    """ Write a small MRC file (float32 by default) for each
+    micrograph in micSet. """
+    rng = np.random.default_rng(seed)
+    data = (rng.normal(size=(dims[1], dims[0])) * 100).astype(dtype)
+    for mic in micSet:
+        with mrcfile.new(mic.getFileName(), overwrite=True) as mrc:
+            mrc.set_data(data)
+
+
+def createProtocol(workingDir, partSet, micSet, **kwargs):
+    """ Create a ProtGoCTF that can run its steps outside a project.
+    kwargs are used to set the protocol parameters.
+    """
+    from goctf.protocols import ProtGoCTF
+
+    prot = ProtGoCTF()
+    prot.setWorkingDir(workingDir)
+    prot.inputParticles.set(partSet)
+    prot.inputMicrographs.set(micSet)
+    for key, value in kwargs.items():
+        getattr(prot, key).set(value)
+    # There is no project database to store the relations
+    prot._defineTransformRelation = lambda *args: None
+    # Nor the stub goCTF times should be added to the user cost table
+    prot._getCostTableFn = lambda: os.path.join(workingDir, 'cost_table.json')
+    # Nor a project executor to launch jobs
+    prot._stepsExecutor = LocalExecutor()
+    prot.makeWorkingDir()
+
+    return prot
+
+
+def runSteps(prot, funcNames):
+    """ Insert the protocol steps and run, in order, the ones
+    from funcNames (e.g. to convert the inputs). """
+    if not prot._steps:
+        prot._insertAllSteps()
+    for step in prot._steps:
+        if step.funcName in funcNames and not step.isFinished():
+            step._runFunc()
+            step.setStatus('finished')
+
+
+def writeGoCtfOutputs(prot):
+    """ Write a _goCTF.star file for each coordinates file in prot tmp
+    folder, with defocus values slightly changed from the input ones.
+    """
+    for micName, mic in prot.micDict.items():
+        micBase = os.path.splitext(os.path.basename(mic.getFileName()))[0]
+        micPath = prot._getTmpPath(micBase)
+        coordFn = os.path.join(micPath, micBase + '_go.star')
+        coords = _readStarBlock(coordFn)
+        values = np.column_stack([coords[:, :2],
+                                  coords[:, 2] + 10., coords[:, 3] - 10.,
+                                  np.full(len(coords), 30.)])
+        with open(os.path.join(micPath, micBase + '_goCTF.star'), 'w') as f:
+            f.write(GOCTF_HEADER)
+            np.savetxt(f, values, fmt='%.2f')
+
+
+GOCTF_HEADER = """
+data_
+
+loop_
+_rlnCoordinateX #1
+_rlnCoordinateY #2
+_rlnDefocusU #3
+_rlnDefocusV #4
+_rlnDefocusAngle #5
+"""
+
+
+def _readStarBlock(filename):
+    """ Read the numeric rows of a single loop star file. """
+    with open(filename) as f:
+        lines = [line for line in f
+                 if line.strip() and line[0] not in '_dl']
+    return np.loadtxt(lines, ndmin=2)
+
+
+def _createAcquisition():
+    acq = Acquisition()
+    acq.setVoltage(300.)
+    acq.setSphericalAberration(2.7)
+    acq.setAmplitudeContrast(0.1)
+    acq.setMagnification(50000)
+    return acq
@@ -24,6 +24,9 @@
 # *
 # **************************************************************************
 
+import os
+
+import pyworkflow as pw
 import pwem
 
 from .constants import *
@@ -42,6 +45,9 @@ class Plugin(pwem.Plugin):
     @classmethod
     def _defineVariables(cls):
         cls._defineEmVar(GOCTF_HOME, 'goctf-%s' % V1_2_0)
+        cls._defineVar(GOCTF_COST_TABLE, os.path.join(
+            os.path.dirname(pw.Config.SCIPION_LOCAL_CONFIG),
+            'goctf_cost_table.json'))
 
     @classmethod
     def getProgram(cls):
@@ -25,6 +25,43 @@
 # **************************************************************************
 
 GOCTF_HOME = 'GOCTF_HOME'
+# Table with the goCTF times of earlier runs, to estimate the cost of new ones
+GOCTF_COST_TABLE = 'GOCTF_COST_TABLE'
 
 # Supported versions
 V1_2_0 = '1.2.0'
+
+# Number of coordinate conversion steps per thread
+CONVERT_CHUNKS_PER_THREAD = 4
+
+# Estimated cost of the CTF search of a 4k x 4k micrograph,
+# relative to the cost of refining the defocus of one particle
+MIC_COST_PARTICLES = 50
+
+# Parallel modes to run the micrographs
+PARALLEL_THREADS = 0
+PARALLEL_PROCESSES = 1
+PARALLEL_SHARDS = 2
+
+# Folder (under the project Tmp) with the micrographs preprocessed for goCTF
+MIC_CACHE_DIR = 'goctf_cache'
+
+# What to do with the particles far from the defocus plane of their micrograph
+OUTLIERS_FLAG = 0
+OUTLIERS_REMOVE = 1
+
+# Extra particle attributes with the defocus plane of their micrograph
+# (offset in A and slopes in A of defocus per A), the residual of the
+# particle defocus (A) and if it is an outlier
+PLANE_LABELS = ['_goctf_planeOffset', '_goctf_planeSlopeX',
+                '_goctf_planeSlopeY']
+RESIDUAL_LABEL = '_goctf_defocusResidual'
+OUTLIER_LABEL = '_goctf_outlier'
+
+# Records of earlier runs kept in the cost table, and needed
+# to fit the cost model instead of scaling the default one
+COST_TABLE_SIZE = 2000
+COST_MIN_RECORDS = 20
+# Default seconds per Mpixel, per defocus search step and per refined
+# particle (the last two for a 512 px FFT box) of the cost model
+COST_DEFAULT_COEFFS = [0.5, 0.05, 0.2]
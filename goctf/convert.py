@@ -25,13 +25,14 @@
 # **************************************************************************
 
 import os
+import mmap
+import sqlite3
 import numpy as np
 from collections import OrderedDict
 
-from pyworkflow.object import ObjectWrap
 import pyworkflow.utils as pwutils
 from pwem.constants import ALIGN_2D, ALIGN_3D, ALIGN_PROJ, ALIGN_NONE
-from pwem.convert.transformations import translation_from_matrix
+from pwem.objects import CTFModel
 import pwem.emlib.metadata as md
 
 
@@ -53,7 +54,9 @@ _rlnCoordinateX #1
 _rlnCoordinateY #2
 _rlnDefocusU #3
 _rlnDefocusV #4
+_rlnDefocusAngle #5
 """
+    ROW_FORMAT = "%.2f %.2f %.2f %.2f %.2f\n"
 
     def __init__(self, filename):
         """ Filename where to write the coordinates. """
@@ -62,27 +65,263 @@ _rlnDefocusV #4
         self._f.write(self.HEADER)
 
     def writeRow(self, x, y, defU, defV, defAng):
-        self._f.write(f"{x:.2f} {y:.2f} {defU:.2f} {defV:.2f}\n")
+        self._f.write(self.ROW_FORMAT % (x, y, defU, defV, defAng))
+
+    def writeRows(self, values):
+        """ Write all rows at once from an array with 5 columns:
+        x, y, defocusU, defocusV and defocusAngle. """
+        values = np.asarray(values, dtype=float)
+        if len(values):
+            self._f.write((self.ROW_FORMAT * len(values))
+                          % tuple(values.ravel().tolist()))
 
     def close(self):
         self._f.close()
 
 
-def rowToCtfModel(ctfRow, ctfModel):
-    """ Create a CTFModel from a row of a meta """
-    if ctfRow.containsAll(CTF_DICT):
-        for attr, label in CTF_DICT.items():
-            value = ctfRow.getValue(label)
-            if not hasattr(ctfModel, attr):
-                setattr(ctfModel, attr, ObjectWrap(value))
-            else:
-                getattr(ctfModel, attr).set(value)
+def readStarColumns(filename, labels):
+    """ Read the values of some columns from the first loop of a star
+    file, without using the metadata library. The file is memory mapped
+    and only the requested columns are converted to numbers.
+    Params:
+        filename: star file to read.
+        labels: list of column names, without the leading underscore
+            (e.g. rlnDefocusU).
+    Return a dict with a float array for each label found in the file.
+    """
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return {}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            columns, start = _readStarLoopHeader(mm)
+            end = len(mm)
+            for token in [b'\ndata_', b'\nloop_']:
+                pos = mm.find(token, start)
+                if pos >= 0:
+                    end = min(end, pos)
+            tokens = mm[start:end].split()
+
+    if not columns:
+        return {}
+
+    n = len(columns)
+    if len(tokens) % n:
+        raise ValueError(f"Wrong number of values in {filename}: "
+                         f"{len(tokens)} for {n} columns")
+
+    return {label: np.array(tokens[columns.index(label)::n], dtype=float)
+            for label in labels if label in columns}
+
+
+def _readStarLoopHeader(mm):
+    """ Return the column names of the first loop in the memory
+    mapped star file and the position where its rows start. """
+    columns = []
+    inLoop = False
+    pos = 0
+
+    while True:
+        line = mm.readline()
+        if not line:  # end of file
+            break
+        line = line.strip()
+        if inLoop:
+            if line.startswith(b'_'):
+                columns.append(line.split()[0][1:].decode())
+            elif columns and line and not line.startswith(b'#'):
+                break  # first row of the loop
+        elif line.startswith(b'loop_'):
+            inLoop = True
+        pos = mm.tell()
+
+    return columns, pos
+
+
+def readCtfValues(ctfFn):
+    """ Read the refined defocus values from a goCTF star file.
+    Return a (N, 3) array with defocusU, defocusV and defocusAngle
+    columns or None if any of them is missing in the file.
+    """
+    labels = [md.label2Str(label) for label in CTF_DICT.values()]
+    columns = readStarColumns(ctfFn, labels)
+
+    if len(columns) < len(labels):
+        return None
+
+    return np.column_stack([columns[label] for label in labels])
+
+
+def standardizeCtfValues(values):
+    """ Apply CTFModel.standardize to all rows of a (N, 3) array with
+    defocusU, defocusV and defocusAngle columns (as from readCtfValues).
+    Return a new (N, 4) array adding the defocusRatio column.
+    """
+    values = np.asarray(values, dtype=float).reshape(-1, 3)
+    defU, defV, angle = values.T.copy()
+
+    swap = defV > defU
+    defU[swap], defV[swap] = defV[swap], values[swap, 0]
+    angle[swap] += 90.
+    angle[angle >= 180.] -= 180.
+    angle[angle < 0.] += 180.
+
+    ratio = np.full(len(values), float(CTFModel.DEFOCUS_RATIO_ERROR_VALUE))
+    valid = defV > CTFModel.DEFOCUS_V_MINIMUM_VALUE
+    ratio[valid] = defU[valid] / defV[valid]
+
+    return np.column_stack([defU, defV, angle, ratio])
+
+
+def setCtfValues(ctfModel, values):
+    """ Set defocusU, defocusV, defocusAngle and defocusRatio of the
+    ctfModel from a row of standardizeCtfValues output. """
+    defU, defV, angle, ratio = values
+    ctfModel._defocusU.set(defU)
+    ctfModel._defocusV.set(defV)
+    ctfModel._defocusAngle.set(angle)
+    ctfModel._defocusRatio.set(ratio)
+
+
+def selectSubset(coords, size):
+    """ Select a spatially stratified subset of size particles.
+    The area covered by coords (N, 2) is split in a grid of about size
+    cells and the particles closest to the center of each cell are
+    taken first. Return the sorted indexes of the selected particles.
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    n = len(coords)
+    if n <= size:
+        return np.arange(n)
 
-        ctfModel.standardize()
+    k = int(np.ceil(np.sqrt(size)))
+    low = coords.min(axis=0)
+    span = np.maximum(coords.max(axis=0) - low, 1e-6)
+    cells = np.minimum((coords - low) / span * k, k - 1).astype(int)
+    cellIds = cells[:, 0] * k + cells[:, 1]
+    dist = (((coords - low) / span * k - cells - 0.5) ** 2).sum(axis=1)
+
+    # Rank of each particle in its cell, by distance to the cell center
+    order = np.lexsort((dist, cellIds))
+    starts = np.r_[0, np.flatnonzero(np.diff(cellIds[order])) + 1]
+    rank = np.empty(n, dtype=int)
+    rank[order] = np.arange(n) - np.repeat(starts, np.diff(np.r_[starts, n]))
+
+    return np.sort(np.lexsort((dist, rank))[:size])
+
+
+def fitDefocusPlane(coords, defocus):
+    """ Least squares fit of defocus = a + b * x + c * y for the
+    particles at coords (N, 2). Return the array [a, b, c], with b and
+    c zero if there are not 3 non collinear particles. """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    a = np.column_stack([np.ones(len(coords)), coords])
+    if len(coords) >= 3 and np.linalg.matrix_rank(a) == 3:
+        return np.linalg.lstsq(a, defocus, rcond=None)[0]
+
+    return np.array([np.mean(defocus), 0., 0.])
+
+
+def fitDefocusPlanes(groups, coords, defocus, threshold=None,
+                     iterations=10):
+    """ Robust fit of a plane defocus = a + b * x + c * y for each group
+    of particles (e.g. micrograph), for all groups at once.
+    The plane is fitted by least squares and then refined with Tukey
+    biweights, residuals are scaled by the MAD of each group.
+    Params:
+        groups: (N,) group id of each particle.
+        coords: (N, 2) particle coordinates.
+        defocus: (N,) defocus of each particle.
+        threshold: particles with a residual larger than threshold
+            robust sigmas (1.4826 * MAD) are outliers.
+    Return the (N, 3) plane of the group of each particle, the (N,)
+    residuals and the (N,) boolean outliers mask (all False if
+    threshold is None).
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    defocus = np.asarray(defocus, dtype=float)
+    if not len(defocus):
+        return np.zeros((0, 3)), np.zeros(0), np.zeros(0, dtype=bool)
+
+    _, inverse = np.unique(groups, return_inverse=True)
+    inverse = inverse.ravel()
+    numGroups = inverse.max() + 1
+    counts = np.bincount(inverse, minlength=numGroups)
+
+    def _sum(values):
+        return np.bincount(inverse, weights=values, minlength=numGroups)
+
+    # Coordinates relative to the center of their group
+    center = np.column_stack([_sum(coords[:, 0]), _sum(coords[:, 1])])
+    center /= np.maximum(counts, 1)[:, None]
+    x, y = (coords - center[inverse]).T
+
+    # Start and group of each position in the particles sorted by group
+    starts = np.r_[0, np.cumsum(counts)[:-1]]
+    sortedGroups = np.repeat(np.arange(numGroups), counts)
+
+    def _median(values):
+        """ Median of the non negative values of each group. They are
+        sorted at once with a single key: group + values / range. """
+        valueRange = values.max() * (1 + 1e-9) + 1e-9
+        sortedValues = np.sort(inverse + values / valueRange)
+        sortedValues -= sortedGroups
+        sortedValues *= valueRange
+        return (sortedValues[starts + (counts - 1) // 2] +
+                sortedValues[starts + counts // 2]) / 2
+
+    weights = np.ones(len(defocus))
+    planes = np.zeros((numGroups, 3))
+    scale = np.ones(numGroups)
+    for i in range(iterations):
+        a = np.empty((numGroups, 3, 3))
+        terms = [np.ones(len(x)), x, y]
+        for j in range(3):
+            for k in range(j, 3):
+                a[:, j, k] = a[:, k, j] = _sum(weights * terms[j] * terms[k])
+        b = np.column_stack([_sum(weights * t * defocus) for t in terms])
+        # Groups with less than 3 non collinear particles get a constant
+        det = np.linalg.det(a)
+        flat = det <= 1e-9 * a[:, 0, 0] * a[:, 1, 1] * a[:, 2, 2]
+        a[flat, 1:, :] = a[flat, :, 1:] = 0
+        a[flat, 1, 1] = a[flat, 2, 2] = 1
+        b[flat, 1:] = 0
+        solved = a[:, 0, 0] > 0  # Keep the previous plane if no weights
+        planes[solved] = np.linalg.solve(a[solved], b[solved][..., None])[..., 0]
+
+        residuals = defocus - (planes[inverse, 0] + planes[inverse, 1] * x +
+                               planes[inverse, 2] * y)
+        scale = np.maximum(1.4826 * _median(np.abs(residuals)), 1.)
+        u = residuals / (4.685 * scale[inverse])
+        weights = np.where(np.abs(u) < 1, (1 - u ** 2) ** 2, 0.)
+
+    # Plane referred to the coordinates origin
+    planes[:, 0] -= planes[:, 1] * center[:, 0] + planes[:, 2] * center[:, 1]
+    if threshold is None:
+        outliers = np.zeros(len(defocus), dtype=bool)
     else:
-        ctfModel = None
+        outliers = np.abs(residuals) > threshold * scale[inverse]
 
-    return ctfModel
+    return planes[inverse], residuals, outliers
+
+
+def interpolateCtfValues(coords, values, newCoords):
+    """ Return the (M, 3) CTF values (defocusU, defocusV, defocusAngle)
+    at newCoords (M, 2) from the values (N, 3) refined at coords (N, 2).
+    The mean defocus follows a plane fitted to the refined one, while
+    the astigmatism is the median one and its angle the mean one.
+    """
+    defU, defV, angle, _ = standardizeCtfValues(values).T
+    plane = fitDefocusPlane(coords, (defU + defV) / 2)
+    newCoords = np.asarray(newCoords, dtype=float).reshape(-1, 2)
+    defocus = plane[0] + newCoords @ plane[1:]
+    halfAstig = np.median(defU - defV) / 2
+    # Angles are axial (period 180), average them as 2 * angle
+    angle2 = np.radians(2 * angle)
+    meanAngle = np.degrees(np.arctan2(np.sin(angle2).mean(),
+                                      np.cos(angle2).mean())) / 2 % 180
+
+    return np.column_stack([defocus + halfAstig, defocus - halfAstig,
+                            np.full(len(newCoords), meanAngle)])
 
 
 def getShifts(transform, alignType):
@@ -118,7 +357,106 @@ def getShifts(transform, alignType):
     return shifts
 
 
+def getShiftsBatch(matrices, alignType):
+    """ Vectorized version of getShifts for a stack of matrices.
+    Params:
+        matrices: (N, 4, 4) array (or list of 4x4 matrices), it is not modified.
+        alignType: alignment type of the particles.
+    Return:
+        (N, 2) array with the x, y shifts or None if alignType is ALIGN_NONE.
+    """
+    if alignType == ALIGN_NONE:
+        return None
+
+    matrices = np.array(matrices, dtype=float).reshape(-1, 4, 4)
+
+    if alignType == ALIGN_2D:
+        flip = np.linalg.det(matrices[:, 0:2, 0:2]) < 0
+        matrices[flip, 0, :2] *= -1.  # invert only the first two columns keep x
+        matrices[flip, 2, 2] = 1.  # set 3D rot
+
+    elif alignType == ALIGN_3D:
+        flip = np.linalg.det(matrices[:, 0:3, 0:3]) < 0
+        matrices[flip, 0, :4] *= -1.  # now, invert first line including x
+        matrices[flip, 3, 3] = 1.  # set 3D rot
+
+    if alignType == ALIGN_PROJ:
+        shifts = -np.linalg.inv(matrices)[:, :3, 3]
+    else:
+        shifts = matrices[:, :3, 3]
+
+    return shifts[:, :2]
+
+
+PARTICLE_COLUMNS = ['_coordinate._x', '_coordinate._y',
+                    '_ctfModel._defocusU', '_ctfModel._defocusV',
+                    '_ctfModel._defocusAngle']
+
+
+def readParticleColumns(partsFn, micIdRange=None, readMatrices=False,
+                        tablePrefix=''):
+    """ Read the coordinates, CTF and transform columns of the particles
+    from a set database, without creating the particle objects.
+    Params:
+        partsFn: sqlite file of the set of particles.
+        micIdRange: (min, max) of the micIds of the particles to read,
+            all particles are read if None.
+        readMatrices: read also the transform matrices.
+        tablePrefix: prefix of the set tables in the file (as the
+            particles of a class in a set of classes).
+    Return:
+        (micIds, values, matrices, micNames) with the (N,) micIds, the
+        (N, 5) x, y, defocusU, defocusV, defocusAngle values, the
+        (N, 4, 4) matrices (None if not read) of the particles sorted by
+        micId and id, and a dict micId -> micrograph name.
+    """
+    # Same table names as the set mapper
+    tablePrefix = tablePrefix.strip()
+    if tablePrefix and not tablePrefix.endswith('_'):
+        tablePrefix += '_'
+    objects = tablePrefix + 'Objects'
+    conn = sqlite3.connect(partsFn)
+    try:
+        cols = dict(conn.execute("SELECT label_property, column_name "
+                                 "FROM %sClasses" % tablePrefix))
+        micIdCol = cols['_micId']
+        where = ""
+        if micIdRange is not None:
+            where = "WHERE %s>=%d AND %s<=%d" % (micIdCol, micIdRange[0],
+                                                 micIdCol, micIdRange[1])
+        order = f"ORDER BY {micIdCol}, id"
+        numParts = conn.execute(f"SELECT COUNT(*) FROM {objects} "
+                                f"{where}").fetchone()[0]
+        rows = np.fromiter(
+            conn.execute("SELECT %s, %s FROM %s %s %s"
+                         % (micIdCol, ", ".join(cols[label] for label
+                                                in PARTICLE_COLUMNS),
+                            objects, where, order)),
+            dtype=np.dtype((float, 6)), count=numParts).reshape(-1, 6)
+
+        matrices = None
+        if readMatrices:
+            # Matrices are stored as json lists, parse all of them at once
+            text = " ".join(m for m, in conn.execute(
+                f"SELECT {cols['_transform._matrix']} FROM {objects} "
+                f"{where} {order}"))
+            text = text.translate(str.maketrans('[],', '   '))
+            matrices = np.array(text.split(), dtype=float).reshape(-1, 4, 4)
+            if len(matrices) != numParts:
+                raise ValueError(f"Read {len(matrices)} matrices for "
+                                 f"{numParts} particles")
+
+        micNames = dict(conn.execute(
+            f"SELECT {micIdCol}, {cols['_coordinate._micName']} "
+            f"FROM {objects} {where} GROUP BY {micIdCol}"))
+    finally:
+        conn.close()
+
+    return rows[:, 0].astype(np.int64), rows[:, 1:], matrices, micNames
+
+
 def geometryFromMatrix(matrix, inverseTransform):
+    from pwem.convert.transformations import translation_from_matrix
     if inverseTransform:
         matrix = np.linalg.inv(matrix)
         shifts = -translation_from_matrix(matrix)
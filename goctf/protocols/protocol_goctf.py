@@ -25,20 +25,41 @@
 # **************************************************************************
 
 import os
+import json
+import heapq
+import shutil
+import sqlite3
+import threading
+import time
+import hashlib
+import numpy as np
 from collections import OrderedDict
+from contextlib import ExitStack
 from enum import Enum
+from itertools import repeat
 
 import pyworkflow.utils as pwutils
 import pyworkflow.protocol.params as params
+from pyworkflow import PYTHON
 from pyworkflow.constants import BETA, SCIPION_DEBUG_NOCLEAN
-from pyworkflow.protocol.constants import STEPS_PARALLEL
-from pwem import emlib
-import pwem.emlib.metadata as md
-from pwem.objects import SetOfParticles
+from pyworkflow.object import Set, Float, Boolean
+from pyworkflow.protocol.constants import STEPS_PARALLEL, STATUS_NEW
+from pwem.objects import SetOfParticles, SetOfMicrographs
 from pwem.protocols import EMProtocol, ProtParticles
 
 from .. import Plugin
-from ..convert import CoordinatesWriter, rowToCtfModel, getShifts
+from ..constants import (CONVERT_CHUNKS_PER_THREAD, MIC_CACHE_DIR,
+                         MIC_COST_PARTICLES, PARALLEL_THREADS,
+                         PARALLEL_PROCESSES, PARALLEL_SHARDS, OUTLIERS_FLAG,
+                         OUTLIERS_REMOVE, PLANE_LABELS, RESIDUAL_LABEL,
+                         OUTLIER_LABEL, GOCTF_COST_TABLE)
+from ..convert import (CoordinatesWriter, getShiftsBatch, readCtfValues,
+                       readStarColumns, standardizeCtfValues, setCtfValues,
+                       selectSubset, interpolateCtfValues, fitDefocusPlanes,
+                       readParticleColumns)
+from ..utils import (MicrographCache, PhaseTimer, CostModel, isFloatMrc,
+                     readPhaseTimes, readMicPhaseTimes)
+from ..workers import MicJobPool, isOutputUpToDate, runMicJob
 
 
 class outputs(Enum):
@@ -99,6 +120,69 @@ class ProtGoCTF(ProtParticles):
                            'regarding CTF aliasing, consider '
                            'increasing this parameter.')
 
+        form.addParam('useMicCache', params.BooleanParam, default=False,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Cache preprocessed micrographs?',
+                      help='Keep the micrographs converted (and downsampled) '
+                           'for goCTF in a cache shared by all goCTF runs '
+                           'of the project, so running again with other '
+                           'search parameters does not repeat this step. '
+                           'The cache is in the project Tmp folder.')
+        form.addParam('micCacheSize', params.FloatParam, default=100.,
+                      condition='useMicCache',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Cache size (GB)',
+                      help='When the cache is larger than this size, the '
+                           'least recently used micrographs are removed.')
+
+        form.addParam('parallelMode', params.EnumParam,
+                      choices=['steps threads', 'processes pool',
+                               'shard jobs'],
+                      default=PARALLEL_THREADS,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Run micrographs in',
+                      help='With *steps threads*, each refinement step '
+                           'preprocesses its micrographs and launches goCTF '
+                           'from a thread of this protocol. With *processes '
+                           'pool*, this is done by a pool of worker '
+                           'processes (as many as threads minus one) in '
+                           'this node, so the Python work of several '
+                           'micrographs does not compete for the same '
+                           'interpreter. With *shard jobs*, micrographs are '
+                           'split in several jobs, launched as any other '
+                           'program of this protocol: in this node or, if '
+                           'the protocol is sent to a queue with jobs also '
+                           'submitted to the queue, in other nodes.')
+        form.addParam('numberOfShards', params.IntParam, default=4,
+                      validators=[params.Positive],
+                      condition='parallelMode==%d' % PARALLEL_SHARDS,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Number of shards',
+                      help='Number of jobs to split the micrographs. As '
+                           'many shards as threads minus one run at the '
+                           'same time. A failed shard can be run again on '
+                           'its own, only the micrographs without up to date '
+                           'output are processed.')
+        form.addParam('micsPerStep', params.IntParam, default=1,
+                      validators=[params.Positive],
+                      condition='parallelMode==%d' % PARALLEL_THREADS,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      label='Micrographs per step',
+                      help='Number of micrographs refined by each step. '
+                           'Use larger values to reduce the steps overhead '
+                           'when there are many small micrographs or few '
+                           'particles per micrograph.')
+        form.addParam('estimateCost', params.BooleanParam, default=False,
+                      label='Estimate the cost before running?',
+                      help='When the protocol is launched, show the '
+                           'expected CPU hours, peak temporary storage of '
+                           'the .mrc files and suggested number of threads, '
+                           'so the run can be cancelled. The estimate uses '
+                           'the goCTF times of earlier runs, recorded in the '
+                           'file of the %s plugin variable.'
+                           % GOCTF_COST_TABLE)
+
         group = form.addGroup('Search limits')
         line = group.addLine('Resolution (A)',
                              help='The CTF model will be fit to regions '
@@ -107,6 +191,26 @@ class ProtGoCTF(ProtParticles):
         line.addParam('lowRes', params.FloatParam, default=30., label='Min')
         line.addParam('highRes', params.FloatParam, default=5., label='Max')
 
+        group.addParam('autoDefocusRange', params.BooleanParam, default=False,
+                       label='Search range from input CTF?',
+                       help='Search the defocus of each micrograph around '
+                            'the CTF of its input particles: median '
+                            'defocus +/- (K * MAD + margin), where MAD is '
+                            'the median absolute deviation of the particles '
+                            'defocusU and defocusV. The range is limited by '
+                            'the min and max defocus below. This usually '
+                            'needs many less search steps than the full '
+                            'range.')
+        line = group.addLine('Defocus window (A)',
+                             condition='autoDefocusRange',
+                             help='K factor of the MAD and margin (in A) '
+                                  'added to both sides of the median '
+                                  'defocus of each micrograph.')
+        line.addParam('defocusWindowK', params.FloatParam, default=3.,
+                      label='K')
+        line.addParam('defocusWindowMargin', params.FloatParam, default=2000.,
+                      label='Margin')
+
         line = group.addLine('Defocus search range (A)',
                              help='Select _minimum_ and _maximum_ values for '
                                   'defocus search range (in A). Underfocus'
@@ -123,178 +227,1138 @@ class ProtGoCTF(ProtParticles):
                        expertLevel=params.LEVEL_ADVANCED,
                        label="Run per-particle refinement?")
 
+        form.addParam('refineSubset', params.BooleanParam, default=False,
+                      label='Refine a subset of particles?',
+                      help='Refine only some particles of each micrograph, '
+                           'spread over its area, and assign to all its '
+                           'particles the defocus of a plane fitted to the '
+                           'refined ones (keeping the median astigmatism). '
+                           'This is faster when there are many particles '
+                           'per micrograph, since the defocus usually '
+                           'varies smoothly across the micrograph.')
+        form.addParam('subsetSize', params.IntParam, default=50,
+                      validators=[params.Positive],
+                      condition='refineSubset',
+                      label='Particles per micrograph',
+                      help='Number of particles of each micrograph refined '
+                           'by goCTF.')
+        form.addParam('subsetValidationMics', params.IntParam, default=2,
+                      validators=[params.GE(0)],
+                      condition='refineSubset',
+                      label='Micrographs to validate',
+                      help='All particles are refined for these first '
+                           'micrographs, and their defocus is compared '
+                           'with the one interpolated from the subset. '
+                           'The residuals are written to '
+                           'extra/subset_residuals.json.')
+
+        form.addParam('fitPlanes', params.BooleanParam, default=False,
+                      label='Fit a defocus plane per micrograph?',
+                      help='Fit a plane to the refined defocus of the '
+                           'particles of each micrograph, robust to '
+                           'outliers. The plane and the residual of each '
+                           'particle are stored as extra attributes of the '
+                           'output particles (_goctf_planeOffset, '
+                           '_goctf_planeSlopeX, _goctf_planeSlopeY, '
+                           '_goctf_defocusResidual and _goctf_outlier).')
+        form.addParam('outlierThreshold', params.FloatParam, default=5.,
+                      validators=[params.Positive],
+                      condition='fitPlanes',
+                      label='Outliers threshold (sigmas)',
+                      help='Particles whose defocus is further from the '
+                           'plane than this number of robust standard '
+                           'deviations (1.4826 * MAD of the residuals of '
+                           'the micrograph) are outliers.')
+        form.addParam('outlierAction', params.EnumParam,
+                      choices=['flag', 'remove'], default=OUTLIERS_FLAG,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      condition='fitPlanes',
+                      label='Outliers',
+                      help='Flag the outliers (_goctf_outlier attribute) '
+                           'or remove them from the output.')
+
+        form.addSection(label='Calibration')
+        form.addParam('doCalibration', params.BooleanParam, default=False,
+                      label='Calibrate FFT box size and downsampling?',
+                      help='Before the refinement, run goCTF on a few '
+                           'micrographs for each combination of the FFT '
+                           'box sizes and downsampling factors below. The '
+                           'defocus obtained with each setting is compared '
+                           'with the reference one (largest box without '
+                           'downsampling) and the fastest setting within '
+                           'the tolerance is selected. The sweep is '
+                           'written to extra/calibration.json.')
+        form.addParam('calibrationMics', params.IntParam, default=3,
+                      validators=[params.Positive],
+                      condition='doCalibration',
+                      label='Number of micrographs',
+                      help='Micrographs used for the calibration, taken '
+                           'evenly spaced from the input ones.')
+        form.addParam('calibrationWindows', params.NumericListParam,
+                      default='256 384 512',
+                      condition='doCalibration',
+                      label='FFT box sizes (px)',
+                      help='Box sizes to try. The FFT box size of the '
+                           'Params tab is always included.')
+        form.addParam('calibrationDownFactors', params.NumericListParam,
+                      default='1 1.5 2',
+                      condition='doCalibration',
+                      label='Downsampling factors',
+                      help='Downsampling factors to try. No downsampling '
+                           '(1) is always included.')
+        form.addParam('calibrationTolerance', params.FloatParam, default=100.,
+                      validators=[params.GE(0)],
+                      condition='doCalibration',
+                      label='Defocus tolerance (A)',
+                      help='Maximum mean absolute change of the particles '
+                           'defocus, compared with the reference setting.')
+        form.addParam('applyCalibration', params.BooleanParam, default=True,
+                      condition='doCalibration',
+                      label='Use the selected setting?',
+                      help='Refine all micrographs with the FFT box size '
+                           'and downsampling selected by the calibration. '
+                           'If No, the selected setting is only reported '
+                           'and the ones of the Params tab are used.')
+
         form.addParallelSection(threads=2, mpi=1)
 
+    # -------------------------- INSERT steps functions ------------------------
+    def _insertAllSteps(self):
+        self._createMicDict()
+        self._defineArgs()
+        # Streaming is used when any of the inputs is still open
+        self.streamMode = not self.streamClosed
+        self.lastCheck = time.time()
+        pwutils.makePath(self._getExtraPath('DONE'))
+        self._micCache = self._createMicCache() if self.useMicCache else None
+        self._timer = PhaseTimer(self._getTimingFn())
+        self._jobPool = None
+        self._jobPoolLock = threading.Lock()
+        self._shardCount = 0
+        # Conversion depends on the downsampling, that may be
+        # selected by the calibration
+        self._calibrationDeps = []
+        if self.doCalibration:
+            self._calibrationDeps.append(self._insertFunctionStep(
+                'calibrateStep', self._getCalibrationMics(), prerequisites=[]))
+
+        # Micrographs with all particles refined to validate the subset
+        self._validationMics = set(sorted(
+            self.micDict, key=lambda m: self.micIdDict[m])[
+            :self.subsetValidationMics.get()])
+
+        refineDeps = self._insertNewMicsSteps(list(self.micDict))
+        self._insertFunctionStep('createOutputStep', prerequisites=refineDeps,
+                                 wait=self.streamMode)
+
+    def _insertNewMicsSteps(self, micNames):
+        """ Insert the conversion and refinement steps for the given
+        micrographs. Return the list of refinement steps ids.
+        Steps are inserted by decreasing estimated cost, so the longest
+        ones are started first and do not delay the end of the run.
+        """
+        micCost = self._getMicCost()
+        micsPerStep = self.micsPerStep.get()
+        chunks = []
+
+        for chunk in self._getConvertChunks(micNames):
+            batches = [chunk[i:i + micsPerStep]
+                       for i in range(0, len(chunk), micsPerStep)]
+            costs = [sum(self.micSizeDict[m] + micCost for m in batch)
+                     for batch in batches]
+            chunks.append((max(costs), chunk, batches, costs))
+
+        refineSteps = []
+        for _, chunk, batches, costs in sorted(chunks, key=lambda c: -c[0]):
+            convId = self._insertFunctionStep(
+                'convertInputStep', chunk,
+                prerequisites=list(self._calibrationDeps))
+            refineSteps.extend(zip(costs, repeat(convId), batches))
+
+        refineSteps.sort(key=lambda s: -s[0])
+
+        if self.parallelMode == PARALLEL_SHARDS:
+            return self._insertShardSteps(refineSteps, micCost)
+
+        if self.parallelMode == PARALLEL_PROCESSES:
+            # A step per conversion chunk feeds its micrographs to the
+            # processes pool, so they start as soon as they are converted
+            chunkMics = OrderedDict()
+            for _, convId, batch in refineSteps:
+                chunkMics.setdefault(convId, []).extend(batch)
+            return [self._insertFunctionStep(
+                'refineCtfPoolStep',
+                *[self.micDict[m].getFileName() for m in batch],
+                prerequisites=[convId])
+                for convId, batch in chunkMics.items()]
+
+        refineDeps = []
+        for _, convId, batch in refineSteps:
+            micFns = [self.micDict[m].getFileName() for m in batch]
+            stepId = self._insertFunctionStep('refineCtfStep', *micFns,
+                                              prerequisites=[convId])
+            refineDeps.append(stepId)
+
+        return refineDeps
+
+    def _insertShardSteps(self, refineSteps, micCost):
+        """ Split the micrographs of refineSteps (sorted by decreasing
+        cost) in shards with similar cost and insert a step for each. """
+        micNames = [m for _, _, batch in refineSteps for m in batch]
+        numShards = min(self.numberOfShards.get(), len(micNames))
+        shards = [(0, i, [], set()) for i in range(numShards)]
+        convIds = {m: convId for _, convId, batch in refineSteps
+                   for m in batch}
+
+        # Each micrograph goes to the shard with less work so far
+        for micName in micNames:
+            cost, i, shardMics, shardConvIds = heapq.heappop(shards)
+            shardMics.append(micName)
+            shardConvIds.add(convIds[micName])
+            heapq.heappush(shards, (cost + self.micSizeDict[micName] + micCost,
+                                    i, shardMics, shardConvIds))
+
+        refineDeps = []
+        for _, _, shardMics, shardConvIds in sorted(shards, key=lambda s: -s[0]):
+            self._shardCount += 1
+            micFns = [self.micDict[m].getFileName() for m in shardMics]
+            stepId = self._insertFunctionStep(
+                'refineCtfShardStep', self._shardCount, *micFns,
+                prerequisites=sorted(shardConvIds))
+            refineDeps.append(stepId)
+
+        return refineDeps
+
     # -------------------------- STEPS functions -------------------------------
     def _createMicDict(self):
         """ Create a dictionary with all micrographs that
          are both in the input micrographs set and there
          are particles belonging to it.
          micName will be the key to that dict.
+         The number of particles and the particles micId for
+         each micrograph are stored in micSizeDict and micIdDict,
+         using the same keys.
          """
         inputParticles = self.inputParticles.get()
-        firstCoord = inputParticles.getFirstItem().getCoordinate()
-        self.hasMicName = firstCoord.getMicName() is not None
+        firstItem = inputParticles.getFirstItem()
+        self.hasMicName = (firstItem is not None and
+                           firstItem.getCoordinate().getMicName() is not None)
+        self.micDict = OrderedDict()
+        self.micSizeDict = OrderedDict()
+        self.micIdDict = {}
+        self._updateMicDict(inputParticles, self._getMicrographs())
+
+    def _updateMicDict(self, partSet, micSet):
+        """ Add to micDict the micrographs from micSet with particles
+        in partSet that are not there yet. Return the list of new keys.
+        It also stores if both input sets are closed in streamClosed.
+        """
         inputMicDict = {mic.getMicName(): mic.clone()
-                        for mic in self._getMicrographs()}
+                        for mic in micSet}
+        newMics = []
+        # The counts are totals of the current input, not increments
+        micCounts = OrderedDict()
         # Check now which if these mics have particles belonging
-        self.micDict = OrderedDict()
-        # match the mic from coord with micDict
+        for micId, micName, count in self._getMicParticleCounts(partSet):
+            if micName in inputMicDict:
+                if micName not in self.micDict:
+                    newMics.append(micName)
+                self.micDict[micName] = inputMicDict[micName]
+                micCounts[micName] = micCounts.get(micName, 0) + count
+                self.micIdDict.setdefault(micName, micId)
+        self.micSizeDict.update(micCounts)
+
+        self.streamClosed = partSet.isStreamClosed() and micSet.isStreamClosed()
+
+        return newMics
+
+    def _getMicParticleCounts(self, partSet):
+        """ Return a list of (micId, micName, count) tuples, sorted by micId,
+        for all micrographs that have particles in partSet.
+        A single GROUP BY query is done through the set mapper, and only
+        if the mapper can not handle it we scan all the particles.
+        """
+        try:
+            rows = partSet.aggregate(['COUNT'], '_micId',
+                                     ['_micId', '_coordinate._micName'])
+            micCounts = [(r['_micId'], r['_coordinate._micName'], r['COUNT'])
+                         for r in rows]
+            return sorted(micCounts, key=lambda m: m[0])
+        except Exception as e:
+            self.warning(f"Could not group particles by micrograph "
+                         f"in the database ({e}), scanning all particles.")
+
+        micCounts = []
         lastMicId = None
-        # TODO: If this loop is too expensive for very large input datasets,
-        # we could consider using the aggregate functions in the mapper
-        for particle in inputParticles.iterItems(orderBy='_micId'):
+        for particle in partSet.iterItems(orderBy='_micId'):
             micId = particle.getMicId()
             if micId != lastMicId:  # Do no repeat check when this is the same mic
                 micName = particle.getCoordinate().getMicName()
-                if micName in inputMicDict:
-                    self.micDict[micName] = inputMicDict[micName]
+                micCounts.append((micId, micName, 0))
                 lastMicId = micId
+            micId, micName, count = micCounts[-1]
+            micCounts[-1] = (micId, micName, count + 1)
 
-    def _insertAllSteps(self):
-        self._createMicDict()
-        self._defineArgs()
+        return micCounts
 
-        convIdDeps = [self._insertFunctionStep('convertInputStep')]
-        refineDeps = []
+    def _getConvertChunks(self, micNames):
+        """ Split the micrographs (sorted by micId) into consecutive
+        chunks with a similar number of particles. Each chunk will be
+        converted by a separate step, so refinement of the first
+        micrographs can start while the rest are still being converted.
+        """
+        micNames = sorted(micNames, key=lambda m: self.micIdDict[m])
+        numChunks = min(len(micNames),
+                        max(1, self.numberOfThreads.get()) * CONVERT_CHUNKS_PER_THREAD)
+        chunkSize = sum(self.micSizeDict[m] for m in micNames) / max(1, numChunks)
+        chunks = []
+        current, currentSize = [], 0
 
-        for micName, mic in self.micDict.items():
-            stepId = self._insertFunctionStep('refineCtfStep', mic.getFileName(),
-                                              prerequisites=convIdDeps)
-            refineDeps.append(stepId)
+        for micName in micNames:
+            current.append(micName)
+            currentSize += self.micSizeDict[micName]
+            if currentSize >= chunkSize:
+                chunks.append(current)
+                current, currentSize = [], 0
+
+        if current:
+            chunks.append(current)
 
-        self._insertFunctionStep('createOutputStep', prerequisites=refineDeps)
+        return chunks
 
-    def _iterParticlesMic(self, newMicCallback):
+    def _iterParticlesMic(self, newMicCallback, inputParts=None, micNames=None):
         """ Iterate through particles sorting by micId and only for
-        those that are present in the input set of micrographs. """
-        inputParts = self.inputParticles.get()
+        those that are present in the input set of micrographs.
+        If micNames is passed, only particles from these micrographs
+        are considered.
+        """
+        if inputParts is None:
+            inputParts = self.inputParticles.get()
+        where = None
+        if micNames is not None:
+            micIds = [self.micIdDict[m] for m in micNames]
+            where = f"_micId>={min(micIds)} AND _micId<={max(micIds)}"
+            micNames = set(micNames)
         lastMicId = None
 
-        for particle in inputParts.iterItems(orderBy=['_micId', 'id']):
+        for particle in inputParts.iterItems(orderBy=['_micId', 'id'],
+                                             where=where):
             coord = particle.getCoordinate()
             micId = particle.getMicId()
             micName = coord.getMicName()
 
             if micId != lastMicId:  # Do no repeat check when this is the same mic
-                mic = self.micDict.get(micName, None)
-                if mic is None:
-                    self.warning(f"Skipping all particles from micrograph, "
-                                 f"key {micName} not found")
+                if micNames is not None and micName not in micNames:
+                    mic = None
                 else:
-                    newMicCallback(mic)  # Notify about a new micrograph found
+                    mic = self.micDict.get(micName, None)
+                    if mic is None:
+                        self.warning(f"Skipping all particles from micrograph, "
+                                     f"key {micName} not found")
+                    else:
+                        newMicCallback(mic)  # Notify about a new micrograph found
                 lastMicId = micId
 
             if mic is not None:
                 yield particle
 
-    def convertInputStep(self):
+    def calibrateStep(self, micNames):
+        """ Run goCTF on micNames for each (windowSize, downFactor) of the
+        calibration grid and select the fastest setting whose defocus is
+        within the tolerance of the reference one. The sweep is written
+        to the calibration file, that is read by _defineArgs if the
+        selected setting is applied.
+        """
+        micFns = [self.micDict[m].getFileName() for m in micNames]
+        tolerance = self.calibrationTolerance.get()
+        calibPath = self._getTmpPath('calibration')
+        # Preprocessed micrographs are reused for all box sizes
+        cache = self._micCache or MicrographCache(
+            os.path.join(calibPath, 'cache'), float('inf'))
+        sweep = []
+        refDefocus = None
+
+        with self._timer.phase('calibration'):
+            for windowSize, downFactor in self._getCalibrationGrid():
+                settingPath = os.path.join(
+                    calibPath, 'box%d_down%0.2f' % (windowSize, downFactor))
+
+                def _getMicPath(micFn):
+                    return os.path.join(settingPath,
+                                        pwutils.removeBaseExt(micFn))
+
+                self._writeCoordinates(
+                    micNames, downFactor, lambda micFn: os.path.join(
+                        _getMicPath(micFn),
+                        self._getOutputPath(micFn, '_go.star')))
+                timingFn = os.path.join(settingPath, 'timing.csv')
+                timer = PhaseTimer(timingFn)
+                defocus = {}
+                for micFn in micFns:
+                    job = self._getMicJob(micFn, '', micPath=_getMicPath(micFn),
+                                          windowSize=windowSize,
+                                          downFactor=downFactor)
+                    job['timingFn'] = timingFn
+                    self._runCalibrationJob(job, cache, timer)
+                    if os.path.exists(job['ctfFn']):
+                        values = readCtfValues(job['ctfFn'])
+                        if values is not None:
+                            defocus[micFn] = values[:, :2].mean(axis=1)
+
+                # The first setting of the grid is the reference
+                if refDefocus is None:
+                    if not defocus:
+                        raise Exception("goCTF failed on all calibration "
+                                        "micrographs with the reference "
+                                        "setting.")
+                    refDefocus = defocus
+
+                deltas = [np.abs(defocus[m] - refDefocus[m])
+                          for m in refDefocus if m in defocus and
+                          len(defocus[m]) == len(refDefocus[m])]
+                _, wallTime, cpuTime = readPhaseTimes(timingFn).get(
+                    'goctf', (0, 0., 0.))
+                setting = {'windowSize': windowSize,
+                           'downFactor': downFactor,
+                           'wallTime': wallTime,
+                           'cpuTime': cpuTime,
+                           'meanDelta': None,
+                           'maxDelta': None}
+                # Settings failing on some micrographs can not be selected
+                if len(deltas) == len(refDefocus):
+                    deltas = np.concatenate(deltas)
+                    setting['meanDelta'] = float(deltas.mean())
+                    setting['maxDelta'] = float(deltas.max())
+                sweep.append(setting)
+                delta = ('failed' if setting['meanDelta'] is None
+                         else '%0.1f A' % setting['meanDelta'])
+                self.info(f"Calibration: box {windowSize} px, downsampling "
+                          f"{downFactor:0.2f}, goCTF {wallTime:0.1f}s, "
+                          f"defocus change {delta}")
+
+        valid = [s for s in sweep if s['meanDelta'] is not None and
+                 s['meanDelta'] <= tolerance]
+        selected = min(valid, key=lambda s: s['wallTime'])
+        report = {'micrographs': micFns,
+                  'tolerance': tolerance,
+                  'reference': sweep[0],
+                  'selected': selected,
+                  'sweep': sweep}
+        with open(self._getCalibrationFn(), 'w') as f:
+            json.dump(report, f, indent=1)
+
+        self.info("Calibration selected box %(windowSize)d px and "
+                  "downsampling %(downFactor)0.2f" % selected)
+        if not pwutils.envVarOn(SCIPION_DEBUG_NOCLEAN):
+            pwutils.cleanPath(calibPath)
+        self._defineArgs()
+
+    def _runCalibrationJob(self, job, cache, timer):
+        """ Run goCTF for a micrograph and setting of the calibration. """
+        runMicJob(job, log=self, runJob=self.runJob, cache=cache, timer=timer)
+
+    def convertInputStep(self, micNames):
+        """ Write the coordinates files for the given micrographs. """
+        micFns = [self.micDict[m].getFileName() for m in micNames]
+        chunkName = os.path.basename(micFns[0])
+        if len(micFns) > 1:
+            chunkName += '..' + os.path.basename(micFns[-1])
+
+        subsetMics = None
+        if self.refineSubset:
+            subsetMics = [m for m in micNames if m not in self._validationMics]
+
+        with self._timer.phase('convert', chunkName):
+            self._writeCoordinates(micNames, self._downFactor,
+                                   self._getCoordsFn, subsetMics)
+
+    def _writeCoordinates(self, micNames, downFactor, getCoordsFn,
+                          subsetMics=None):
+        """ Write the coordinates of the particles from micNames,
+        for micrographs downsampled by downFactor, in the files
+        returned by getCoordsFn(micFn). If subsetMics is given, only
+        a subset of subsetSize particles is written there for its
+        micrographs, and all of them in the _getAllCoordsFn file.
+        """
         inputParts = self.inputParticles.get()
         alignType = inputParts.getAlignment()
         inputMics = self._getMicrographs()
 
-        scale = inputParts.getSamplingRate() / inputMics.getSamplingRate() / self.ctfDownFactor.get()
+        scale = inputParts.getSamplingRate() / inputMics.getSamplingRate() / downFactor
         doScale = abs(scale - 1.0) > 0.00001
         if doScale:
             self.info(f"Scaling coordinates by a factor {scale:0.2f}")
 
-        self._lastWriter = None
-        coordDir = self._getTmpPath()
+        subsetSize = self.subsetSize.get()
+
+        for mic, values, matrices in self._readMicColumns(inputParts,
+                                                          micNames):
+            micFn = mic.getFileName()
+            coords = values[:, :2]
+            if matrices is not None:
+                shifts = getShiftsBatch(matrices, alignType)
+                if shifts is not None:
+                    coords -= shifts.astype(int)
+            if doScale:
+                coords *= scale
+
+            if subsetMics is not None:
+                allCoordsFn = self._getAllCoordsFn(micFn)
+                if mic.getMicName() in subsetMics and len(values) > subsetSize:
+                    writer = CoordinatesWriter(allCoordsFn)
+                    writer.writeRows(values)
+                    writer.close()
+                    values = values[selectSubset(coords, subsetSize)]
+                else:
+                    pwutils.cleanPath(allCoordsFn)  # From a previous run
+            writer = CoordinatesWriter(getCoordsFn(micFn))
+            writer.writeRows(values)
+            writer.close()
+
+    def _readMicColumns(self, inputParts, micNames):
+        """ Return a list of (mic, values, matrices) for the micrographs
+        in micNames with particles, sorted by micId. values has the
+        x, y, defocusU, defocusV, defocusAngle of its particles and
+        matrices their transforms (None if shifts are not applied).
+        The columns are read directly from the set database, and only
+        if that fails the particles are iterated.
+        """
+        readMatrices = bool(self.applyShifts)
+        micIds = [self.micIdDict[m] for m in micNames]
+        try:
+            # Several conversion steps can run in parallel, so each one
+            # uses its own connection to the particles database
+            partMicIds, values, matrices, micIdNames = readParticleColumns(
+                inputParts.getFileName(), (min(micIds), max(micIds)),
+                readMatrices, inputParts.getPrefix() or '')
+        except Exception as e:
+            self.warning(f"Could not read the particles columns from the "
+                         f"database ({e}), iterating all particles.")
+            return self._readMicColumnsFromParticles(inputParts, micNames)
+
+        micNames = set(micNames)
+        micColumns = []
+        uniqueIds, starts = np.unique(partMicIds, return_index=True)
+        ends = list(starts[1:]) + [len(partMicIds)]
+        for micId, start, end in zip(uniqueIds, starts, ends):
+            micName = micIdNames[micId]
+            if micName not in micNames:
+                continue
+            mic = self.micDict.get(micName, None)
+            if mic is None:
+                self.warning(f"Skipping all particles from micrograph, "
+                             f"key {micName} not found")
+                continue
+            micColumns.append((mic, values[start:end],
+                               matrices[start:end] if readMatrices
+                               else None))
+
+        return micColumns
+
+    def _readMicColumnsFromParticles(self, inputParts, micNames):
+        """ Same as _readMicColumns, iterating the particles objects. """
+        micColumns = []
 
         def _newMic(mic):
-            if self._lastWriter:
-                self._lastWriter.close()
-            micBase = pwutils.removeBaseExt(mic.getFileName())
-            posFn = os.path.join(coordDir, micBase, micBase + '_go.star')
-            self._lastWriter = CoordinatesWriter(posFn)
+            micColumns.append((mic, [], [] if self.applyShifts else None))
 
-        for particle in self._iterParticlesMic(newMicCallback=_newMic):
-            coord = particle.getCoordinate()
-            x, y = coord.getPosition()
-            if self.applyShifts:
-                shifts = getShifts(particle.getTransform(), alignType)
-                x, y = x - int(shifts[0]), y - int(shifts[1])
-            if doScale:
-                x, y = x * scale, y * scale
+        for particle in self._iterParticlesMic(newMicCallback=_newMic,
+                                               inputParts=inputParts,
+                                               micNames=micNames):
+            x, y = particle.getCoordinate().getPosition()
             ctf = particle.getCTF()
-            self._lastWriter.writeRow(x, y, ctf.getDefocusU(),
-                                      ctf.getDefocusV(), ctf.getDefocusAngle())
+            _, micRows, micMatrices = micColumns[-1]
+            micRows.append((x, y, ctf.getDefocusU(),
+                            ctf.getDefocusV(), ctf.getDefocusAngle()))
+            if self.applyShifts:
+                micMatrices.append(particle.getTransform().getMatrix())
+
+        return [(mic, np.array(rows, dtype=float).reshape(-1, 5),
+                 None if matrices is None
+                 else np.array(matrices, dtype=float).reshape(-1, 4, 4))
+                for mic, rows, matrices in micColumns]
 
-        if self._lastWriter:
-            self._lastWriter.close()  # Close file writing for last mic
+    def refineCtfStep(self, *micFns):
+        """ Run goCTF for each micrograph in micFns. A missing micrograph
+        makes the step fail, but only after processing the other ones.
+        """
+        missing = []
+        for micFn in micFns:
+            if not os.path.exists(micFn):
+                self.error(f"Missing input micrograph: {micFn}")
+                missing.append(micFn)
+                continue
 
-    def refineCtfStep(self, micFn):
-        if not os.path.exists(micFn):
-            raise FileNotFoundError("Missing input micrograph: %s" % micFn)
+            fingerprint = self._getMicFingerprint(micFn)
+            if self._isMicUpToDate(micFn, fingerprint):
+                self.info(f"Skipping {micFn}, goCTF output is up to date.")
+            else:
+                self._runGoCtf(micFn, fingerprint)
 
-        downFactor = self.ctfDownFactor.get()
-        # We convert the input micrograph on demand if not in .mrc
-        micPath = self._getTmpPath(pwutils.removeBaseExt(micFn))
-        ih = emlib.image.ImageHandler()
-        micFnMrc = os.path.join(micPath, pwutils.replaceBaseExt(micFn, 'mrc'))
+            # Mark this micrograph as processed
+            open(self._getMicDoneFn(micFn), 'w').close()
 
-        if downFactor != 1:
-            ih.scaleFourier(micFn, micFnMrc, downFactor)
-        else:
-            ih.convert(micFn, micFnMrc, emlib.DT_FLOAT)
+        if missing:
+            raise FileNotFoundError("Missing input micrographs: %s"
+                                    % ", ".join(missing))
 
-        # Run goCTF
-        try:
-            self._params.update({
-                'micFn': os.path.basename(micFnMrc),
-                'goctfOut': self._getOutputPath(micFn, ext="_ctf.log"),
-                'goctfPSD': self._getOutputPath(micFn, ext="_ctf.mrc")
-            })
-            args = self._args % self._params
-            self.runJob(Plugin.getProgram(), args,
-                        env=Plugin.getEnviron(),
-                        cwd=micPath)
-
-            # Let's clean the temporary mrc micrograph
-            if not pwutils.envVarOn(SCIPION_DEBUG_NOCLEAN):
-                pwutils.cleanPath(micFnMrc)
-
-        except:
-            self.error(f"ERROR: goCTF has failed on {micFnMrc}")
-            import traceback
-            traceback.print_exc()
+    def refineCtfPoolStep(self, *micFns):
+        """ Same as refineCtfStep, but running the micrographs
+        in the pool of worker processes. """
+        missing = []
+        jobs = []
+        for micFn in micFns:
+            if not os.path.exists(micFn):
+                self.error(f"Missing input micrograph: {micFn}")
+                missing.append(micFn)
+                continue
+
+            fingerprint = self._getMicFingerprint(micFn)
+            if self._isMicUpToDate(micFn, fingerprint):
+                self.info(f"Skipping {micFn}, goCTF output is up to date.")
+                open(self._getMicDoneFn(micFn), 'w').close()
+            else:
+                jobs.append(self._getMicJob(micFn, fingerprint))
+
+        for result in self._getJobPool().run(jobs):
+            micFn = result['micFn']
+            if result['error']:
+                self.error(f"ERROR: goCTF has failed on {micFn}: "
+                           f"{result['error']}")
+            else:
+                self.info(f"goCTF refined {result['refined']} particles "
+                          f"from {micFn}")
+            if result['cacheHit'] is not None:
+                with self._jobPoolLock:
+                    if result['cacheHit']:
+                        self._micCache.hits += 1
+                    else:
+                        self._micCache.misses += 1
+            # Mark this micrograph as processed
+            open(self._getMicDoneFn(micFn), 'w').close()
+
+        if missing:
+            raise FileNotFoundError("Missing input micrographs: %s"
+                                    % ", ".join(missing))
+
+    def refineCtfShardStep(self, shardId, *micFns):
+        """ Run goCTF for micFns in a separate job (python -m goctf.shard),
+        that can be submitted to a queue as any other program. """
+        missing = [micFn for micFn in micFns if not os.path.exists(micFn)]
+        jobs = []
+        for micFn in micFns:
+            if micFn in missing:
+                self.error(f"Missing input micrograph: {micFn}")
+                continue
+            job = self._getMicJob(micFn, self._getMicFingerprint(micFn))
+            # The shard job runs with the plugin environment
+            job['env'] = None
+            job['doneFn'] = self._getMicDoneFn(micFn)
+            jobs.append(job)
+
+        shardFn = self._getExtraPath('shards', 'shard_%03d.json' % shardId)
+        pwutils.makePath(os.path.dirname(shardFn))
+        with open(shardFn, 'w') as f:
+            json.dump(jobs, f, indent=1)
+
+        self.runJob(PYTHON, '-m goctf.shard %s' % shardFn,
+                    env=Plugin.getEnviron(), numberOfMpi=1, numberOfThreads=1)
+
+        if missing:
+            raise FileNotFoundError("Missing input micrographs: %s"
+                                    % ", ".join(missing))
+
+    def _runGoCtf(self, micFn, fingerprint):
+        runMicJob(self._getMicJob(micFn, fingerprint), log=self,
+                  runJob=self.runJob, cache=self._micCache, timer=self._timer)
+
+    def _getJobPool(self):
+        """ Return the processes pool, starting it the first time. """
+        with self._jobPoolLock:
+            if self._jobPool is None:
+                numWorkers = max(1, self.numberOfThreads.get() - 1)
+                self.info(f"Starting a pool of {numWorkers} processes")
+                self._jobPool = MicJobPool(numWorkers)
+            return self._jobPool
 
     def createOutputStep(self):
+        if self._jobPool is not None:
+            self._jobPool.shutdown()
+        if self._micCache is not None:
+            self.info(f"Micrograph cache: {self._micCache.getStats()}")
+        if self.refineSubset:
+            self._writeSubsetReport()
+        self._updateCostTable()
+
+        if self.streamMode:
+            return  # Output was already updated and closed in _checkNewOutput
+
         inputParts = self.inputParticles.get()
         partSet = self._createSetOfParticles()
-        partSet.copyInfo(inputParts)
-        self._rowList = None
-        self._rowCounter = 0
+        # The database is copied only for a set in its own tables, not
+        # for e.g. the particles of a class in a set of classes
+        if (inputParts.getFileName().endswith('.sqlite') and
+                not (inputParts.getPrefix() or '').strip()):
+            outputFn = partSet.getFileName()
+            partSet.close()
+            self._writeRefinedParticlesDb(outputFn, inputParts,
+                                          partSet._indexes)
+            partSet = SetOfParticles(filename=outputFn)
+            partSet.loadAllProperties()
+        else:
+            partSet.copyInfo(inputParts)
+            self._appendRefinedParticles(partSet, inputParts)
+
+        self._defineOutputs(**{outputs.outputParticles.name: partSet})
+        self._defineTransformRelation(self.inputParticles, partSet)
+
+    def _appendRefinedParticles(self, partSet, inputParts, micNames=None):
+        """ Append to partSet the particles from inputParts with the
+        CTF refined by goCTF. Particles from micrographs without goCTF
+        output are not included. The merge of each micrograph is
+        recorded as a phase in the timing file.
+        """
+        # Iterators over the refined CTF values of the current micrograph
+        # and over its defocus plane fit values
+        micCtfValues = [None, None]
+        outliers = [0]
+        micPhase = ExitStack()
 
         def _newMic(mic):
-            micFn = mic.getFileName()
-            micPath = self._getTmpPath(pwutils.removeBaseExt(micFn))
-            ctfFn = os.path.join(micPath,
-                                 self._getOutputPath(micFn, ext="_goCTF.star"))
-            self._rowCounter = 0
+            micPhase.close()
+            micPhase.enter_context(self._timer.phase(
+                'merge', os.path.basename(mic.getFileName())))
+            ctfFn = self._getCtfFn(mic.getFileName())
             if os.path.exists(ctfFn):
-                self._rowList = [row.clone() for row in md.iterRows(ctfFn)]
+                values = self._readMicCtfValues(mic.getFileName())
+                # Keep input CTF if some of the defocus values are missing
+                if values is None:
+                    micCtfValues[0] = repeat(None)
+                else:
+                    micCtfValues[0] = iter(standardizeCtfValues(values).tolist())
+                if self.fitPlanes:
+                    coords, defocus = self._getPlaneInput(mic.getFileName(),
+                                                          values)
+                    planeFit = fitDefocusPlanes(np.zeros(len(defocus)), coords,
+                                                defocus,
+                                                self.outlierThreshold.get())
+                    outliers[0] += int(planeFit[2].sum())
+                    micCtfValues[1] = zip(*[v.tolist() for v in planeFit])
+            else:
+                micCtfValues[0] = None
+
+        with micPhase:
+            for particle in self._iterParticlesMic(newMicCallback=_newMic,
+                                                   inputParts=inputParts,
+                                                   micNames=micNames):
+                ctfValues = micCtfValues[0]
+                if ctfValues is None:  # Ignore particles if no CTF
+                    continue
+                values = next(ctfValues)
+                if values is not None:
+                    setCtfValues(particle.getCTF(), values)
+                if self.fitPlanes:
+                    plane, residual, outlier = next(micCtfValues[1])
+                    if outlier and self.outlierAction == OUTLIERS_REMOVE:
+                        continue
+                    self._setPlaneAttributes(particle, plane, residual,
+                                             outlier)
+                partSet.append(particle)
+
+        if self.fitPlanes:
+            self._logOutliers(outliers[0])
+
+    def _setPlaneAttributes(self, particle, plane, residual, outlier):
+        """ Set the defocus plane extra attributes of the particle. """
+        for label, value, ObjClass in zip(
+                PLANE_LABELS + [RESIDUAL_LABEL, OUTLIER_LABEL],
+                plane + [residual, outlier], [Float] * 4 + [Boolean]):
+            if hasattr(particle, label):
+                getattr(particle, label).set(value)
             else:
-                self._rowList = None
+                setattr(particle, label, ObjClass(value))
+
+    def _getPlaneInput(self, micFn, values):
+        """ Return the coordinates (in A) and the mean defocus of the
+        particles of micFn, to fit its defocus plane. If values (as from
+        _readMicCtfValues) are None, the input defocus is used.
+        """
+        coordsFn = self._getAllCoordsFn(micFn)
+        # Files of all particles are only kept in the subset mode
+        if not (self.refineSubset and os.path.exists(coordsFn)):
+            coordsFn = self._getCoordsFn(micFn)
+        rows = self._readCoords(coordsFn, ['rlnCoordinateX', 'rlnCoordinateY',
+                                           'rlnDefocusU', 'rlnDefocusV'])
+        if values is None:
+            values = rows[:, 2:]
+        n = min(len(rows), len(values))
+        # Coordinates are in pixels of the micrograph given to goCTF
+        coords = rows[:n, :2] * self._params['samplingRate']
+
+        return coords, values[:n, :2].mean(axis=1)
+
+    def _logOutliers(self, numOutliers):
+        action = ('removed' if self.outlierAction == OUTLIERS_REMOVE
+                  else 'flagged')
+        self.info(f"{numOutliers} particles {action} as outliers of the "
+                  f"defocus plane of their micrograph")
 
-        for particle in self._iterParticlesMic(newMicCallback=_newMic):
-            if self._rowList is None:  # Ignore particles if no CTF
+    def _writeRefinedParticlesDb(self, outputFn, inputParts, indexes):
+        """ Write in outputFn the same set of particles as
+        _appendRefinedParticles, but working directly on the database:
+        the input set file is copied, the CTF columns are updated with
+        the goCTF values and the particles from micrographs without goCTF
+        output are removed, all of it in a single transaction.
+        Indexes are created for the given attributes.
+        The merge of each micrograph is recorded as a phase in the
+        timing file, and the copy and update of the database, shared by
+        all the micrographs, as the mergeDb phase.
+        """
+        with self._timer.phase('mergeDb'):
+            shutil.copyfile(inputParts.getFileName(), outputFn)
+            conn = sqlite3.connect(outputFn)
+            cols = dict(conn.execute("SELECT label_property, column_name "
+                                     "FROM Classes"))
+            micIdCol = cols['_micId']
+            ctfCols = [cols['_ctfModel.%s' % attr] for attr in
+                       ['_defocusU', '_defocusV', '_defocusAngle',
+                        '_defocusRatio']]
+
+            # Particle ids and micId, in the same order as _iterParticlesMic
+            numParts = conn.execute(
+                "SELECT COUNT(*) FROM Objects").fetchone()[0]
+            parts = np.fromiter(
+                conn.execute(f"SELECT id, {micIdCol} FROM Objects "
+                             f"ORDER BY {micIdCol}, id"),
+                dtype=[('id', np.int64), ('micId', np.int64)], count=numParts)
+            # Name of the micrograph for each micId, from its first particle
+            micNames = {micId: micName for micId, micName, _ in conn.execute(
+                f"SELECT {micIdCol}, {cols['_coordinate._micName']}, MIN(id) "
+                f"FROM Objects GROUP BY {micIdCol}")}
+            micIds, starts = np.unique(parts['micId'], return_index=True)
+
+        updates = []
+        removed = []
+        planeInput = []  # Particle ids, micIds, coordinates and defocus
+        for micId, start, end in zip(micIds, starts,
+                                     list(starts[1:]) + [numParts]):
+            ids = parts['id'][start:end].tolist()
+            mic = self.micDict.get(micNames[micId], None)
+            if mic is None:
+                self.warning(f"Skipping all particles from micrograph, "
+                             f"key {micNames[micId]} not found")
+                removed.extend(ids)
                 continue
-            newPart = particle.clone()
-            row = self._rowList[self._rowCounter]
-            self._rowCounter += 1
-            rowToCtfModel(row, newPart.getCTF())
-            partSet.append(newPart)
+            with self._timer.phase('merge',
+                                   os.path.basename(mic.getFileName())):
+                ctfFn = self._getCtfFn(mic.getFileName())
+                if not os.path.exists(ctfFn):
+                    removed.extend(ids)
+                    continue
+                values = self._readMicCtfValues(mic.getFileName())
+                # Keep input CTF if some of the defocus values are missing
+                if values is not None:
+                    if len(values) < len(ids):
+                        raise ValueError(f"{ctfFn} has {len(values)} rows, "
+                                         f"expected {len(ids)}")
+                    values = values[:len(ids)]
+                    updates.extend(row + [partId] for row, partId in zip(
+                        standardizeCtfValues(values).tolist(), ids))
+                if self.fitPlanes:
+                    coords, defocus = self._getPlaneInput(mic.getFileName(),
+                                                          values)
+                    planeInput.append((ids, np.full(len(ids), micId),
+                                       coords, defocus))
 
-        self._defineOutputs(**{outputs.outputParticles.name: partSet})
-        self._defineTransformRelation(self.inputParticles, partSet)
+        with self._timer.phase('mergeDb'):
+            planeUpdates = []
+            if planeInput:
+                ids, groups, coords, defocus = [np.concatenate(v) for v
+                                                in zip(*planeInput)]
+                planes, residuals, outliers = fitDefocusPlanes(
+                    groups, coords, defocus, self.outlierThreshold.get())
+                self._logOutliers(int(outliers.sum()))
+                if self.outlierAction == OUTLIERS_REMOVE:
+                    removed.extend(ids[outliers].tolist())
+                planeUpdates = zip(*planes.T.tolist(), residuals.tolist(),
+                                   outliers.astype(int).tolist(), ids.tolist())
+
+            with conn:
+                conn.executemany("UPDATE Objects SET %s WHERE id=?"
+                                 % ", ".join(f"{c}=?" for c in ctfCols), updates)
+                if self.fitPlanes:
+                    planeCols = self._addColumns(
+                        conn, cols, [(label, 'Float') for label in PLANE_LABELS] +
+                        [(RESIDUAL_LABEL, 'Float'), (OUTLIER_LABEL, 'Boolean')])
+                    conn.executemany("UPDATE Objects SET %s WHERE id=?"
+                                     % ", ".join(f"{c}=?" for c in planeCols),
+                                     planeUpdates)
+                conn.executemany("DELETE FROM Objects WHERE id=?",
+                                 [(partId,) for partId in removed])
+                conn.execute("UPDATE Properties SET value=? WHERE key='_size'",
+                             (str(numParts - len(removed)),))
+                conn.execute("UPDATE Properties SET value=? "
+                             "WHERE key='_streamState'",
+                             (str(Set.STREAM_CLOSED),))
+                # The output set will use its own file
+                conn.execute("DELETE FROM Properties WHERE key='_mapperPath'")
+                for idx in indexes:
+                    if idx in cols:
+                        conn.execute("CREATE INDEX IF NOT EXISTS index_%s "
+                                     "ON Objects (%s)"
+                                     % (idx.replace('.', '_'), cols[idx]))
+            conn.close()
+
+    def _addColumns(self, conn, cols, attributes):
+        """ Add to the Objects table of a set database the columns for
+        attributes, a list of (label, className), that are not in cols
+        (dict label -> column, that is updated). Return their columns.
+        """
+        lastCol = max(int(c[1:]) for c in cols.values())
+        for label, className in attributes:
+            if label not in cols:
+                lastCol += 1
+                cols[label] = 'c%02d' % lastCol
+                conn.execute("ALTER TABLE Objects ADD COLUMN %s %s "
+                             "DEFAULT NULL" % (cols[label],
+                                               'REAL' if className == 'Float'
+                                               else 'INTEGER'))
+                conn.execute("INSERT INTO Classes (label_property, "
+                             "column_name, class_name) VALUES (?, ?, ?)",
+                             (label, cols[label], className))
+
+        return [cols[label] for label, _ in attributes]
+
+    def _readMicCtfValues(self, micFn):
+        """ Return the goCTF values of the particles of micFn, as from
+        readCtfValues. If only a subset of them was refined, the values
+        of all of them are interpolated from the subset ones.
+        """
+        ctfFn = self._getCtfFn(micFn)
+        values = readCtfValues(ctfFn)
+        allCoordsFn = self._getAllCoordsFn(micFn)
+        if (values is None or not self.refineSubset or
+                not os.path.exists(allCoordsFn)):
+            return values
+
+        return interpolateCtfValues(self._readCoords(self._getCoordsFn(micFn)),
+                                    values, self._readCoords(allCoordsFn))
+
+    def _readCoords(self, coordsFn, labels=('rlnCoordinateX',
+                                            'rlnCoordinateY')):
+        """ Return the (N, len(labels)) values of a coordinates file,
+        the particle coordinates by default. """
+        columns = readStarColumns(coordsFn, labels)
+        return np.column_stack([columns.get(label, []) for label in labels])
+
+    def _writeSubsetReport(self):
+        """ Compare, for the validation micrographs, the defocus refined
+        for all particles with the one interpolated from the subset,
+        and write the residuals to the subset report file. """
+        subsetSize = self.subsetSize.get()
+        mics = []
+        for micName in sorted(self._validationMics):
+            micFn = self.micDict[micName].getFileName()
+            ctfFn = self._getCtfFn(micFn)
+            values = readCtfValues(ctfFn) if os.path.exists(ctfFn) else None
+            if values is None:
+                continue
+            coords = self._readCoords(self._getCoordsFn(micFn))[:len(values)]
+            subset = selectSubset(coords, subsetSize)
+            interpolated = interpolateCtfValues(coords[subset],
+                                                values[subset], coords)
+            residuals = (interpolated[:, :2].mean(axis=1) -
+                         values[:, :2].mean(axis=1))
+            mics.append({'micName': micName,
+                         'particles': len(values),
+                         'subset': len(subset),
+                         'meanResidual': float(np.abs(residuals).mean()),
+                         'rmsResidual': float(np.sqrt((residuals ** 2).mean())),
+                         'maxResidual': float(np.abs(residuals).max())})
+
+        if mics:
+            with open(self._getSubsetReportFn(), 'w') as f:
+                json.dump({'subsetSize': subsetSize, 'micrographs': mics},
+                          f, indent=1)
+
+    # -------------------------- STREAMING functions ---------------------------
+    def _stepsCheck(self):
+        # To refine in streaming we need to detect:
+        #   1) new micrographs with particles ready to be refined
+        #   2) micrographs already refined, whose particles
+        #      should be added to the output set
+        if getattr(self, 'streamMode', False):
+            self._checkNewInput()
+            self._checkNewOutput()
+
+    def _checkNewInput(self):
+        """ Insert refinement steps for the micrographs
+        with particles that appeared in the input sets. """
+        inputFiles = [self.inputParticles.get().getFileName(),
+                      self._getMicrographs().getFileName()]
+        mTime = max(os.path.getmtime(fn) for fn in inputFiles)
+        # If the input sets have not changed since our last check,
+        # it does not make sense to look for new micrographs
+        if self.lastCheck > mTime or self.streamClosed:
+            return
+
+        self.lastCheck = time.time()
+        partSet = self._loadInputSet(SetOfParticles, inputFiles[0])
+        micSet = self._loadInputSet(SetOfMicrographs, inputFiles[1])
+        newMics = self._updateMicDict(partSet, micSet)
+        partSet.close()
+        micSet.close()
+        self.debug(f"Found {len(newMics)} new micrographs with particles, "
+                   f"inputs closed: {self.streamClosed}")
+
+        if newMics:
+            refineDeps = self._insertNewMicsSteps(newMics)
+            outputStep = self._getFirstJoinStep()
+            if outputStep is not None:
+                outputStep.addPrerequisites(*refineDeps)
+            self.updateSteps()
+
+    def _checkNewOutput(self):
+        """ Append to the output the particles from the micrographs
+        refined since the last check, and close the output once all
+        micrographs are done and the inputs are closed. """
+        if getattr(self, 'finished', False):
+            return
+
+        doneList = self._readDoneList()
+        newDone = [micName for micName, mic in self.micDict.items()
+                   if micName not in doneList and
+                   os.path.exists(self._getMicDoneFn(mic.getFileName()))]
+        allDone = len(doneList) + len(newDone)
+        self.finished = self.streamClosed and allDone == len(self.micDict)
+        streamMode = Set.STREAM_CLOSED if self.finished else Set.STREAM_OPEN
+
+        if newDone:
+            self._updateOutputPartSet(newDone, streamMode)
+            self._writeDoneList(newDone)
+        elif not self.finished:
+            if allDone == len(self.micDict):
+                self._streamingSleepOnWait()
+            return
+
+        if self.finished:  # Unlock createOutputStep if finished all jobs
+            if not newDone:  # Close the output set
+                self._updateOutputPartSet([], Set.STREAM_CLOSED)
+            outputStep = self._getFirstJoinStep()
+            if outputStep and outputStep.isWaiting():
+                outputStep.setStatus(STATUS_NEW)
+
+    def _updateOutputPartSet(self, micNames, streamMode):
+        """ Append the refined particles from micNames to the output
+        set, creating it the first time. """
+        outputName = outputs.outputParticles.name
+        partSet = getattr(self, outputName, None)
+        inputParts = self._loadInputSet(SetOfParticles,
+                                        self.inputParticles.get().getFileName())
+        firstTime = partSet is None
+
+        if firstTime:
+            partSet = self._createSetOfParticles()
+            partSet.copyInfo(inputParts)
+        else:
+            partSet.enableAppend()
+
+        if micNames:
+            self._appendRefinedParticles(partSet, inputParts, micNames)
+        inputParts.close()
+        self._updateOutputSet(outputName, partSet, streamMode)
+
+        if firstTime:
+            self._defineTransformRelation(self.inputParticles, partSet)
+
+    def _createMicCache(self):
+        """ Create the cache of preprocessed micrographs, shared by all
+        goCTF runs in the project. """
+        project = self.getProject()
+        if project is not None:
+            cachePath = project.getTmpPath(MIC_CACHE_DIR)
+        else:  # Runs/000123_ProtGoCTF -> Tmp/ at the project folder
+            projPath = os.path.dirname(os.path.dirname(self.getWorkingDir()))
+            cachePath = os.path.join(projPath, 'Tmp', MIC_CACHE_DIR)
+
+        return MicrographCache(cachePath, self.micCacheSize.get() * 1024**3)
+
+    def _loadInputSet(self, SetClass, filename):
+        """ Open a new instance of an input set to get its current items. """
+        inputSet = SetClass(filename=filename)
+        inputSet.loadAllProperties()
+        return inputSet
+
+    def _getFirstJoinStep(self):
+        for s in self._steps:
+            if s.funcName == 'createOutputStep':
+                return s
+        return None
+
+    def _getMicDoneFn(self, micFn):
+        return self._getExtraPath('DONE', pwutils.removeBaseExt(micFn) + '.TXT')
+
+    def _getAllDone(self):
+        return self._getExtraPath('DONE', 'all.TXT')
+
+    def _readDoneList(self):
+        """ Read the micrographs already added to the output. """
+        doneFile = self._getAllDone()
+        doneList = []
+        if os.path.exists(doneFile):
+            with open(doneFile) as f:
+                doneList += [line.strip() for line in f]
+
+        return doneList
+
+    def _writeDoneList(self, micNames):
+        """ Write the micrographs already added to the output. """
+        with open(self._getAllDone(), 'a') as f:
+            for micName in micNames:
+                f.write(f"{micName}\n")
 
     # -------------------------- INFO functions --------------------------------
     def _validate(self):
         errors = []
 
+        if self.doCalibration:
+            try:
+                grid = self._getCalibrationGrid()
+                if min(w for w, _ in grid) <= 0:
+                    errors.append("Calibration box sizes should be positive.")
+                # No downsampling (1) is the reference of the calibration
+                if min(d for _, d in grid) < 1:
+                    errors.append("Calibration downsampling factors should "
+                                  "be 1 or greater.")
+            except ValueError:
+                errors.append("Calibration box sizes and downsampling "
+                              "factors should be lists of numbers.")
+
         return errors
 
+    def _warnings(self):
+        warnings = []
+
+        if self.estimateCost:
+            cost = self._estimateCost()
+            warnings.append(
+                "Estimated cost for %d micrographs: %0.1f CPU hours%s, "
+                "about %0.1f hours with %d threads."
+                % (cost['micrographs'], cost['cpuHours'],
+                   " (%0.1f of calibration)" % cost['calibrationHours']
+                   if self.doCalibration else "",
+                   cost['wallHours'], self.numberOfThreads.get()))
+            warnings.append("Peak temporary storage of the .mrc files: "
+                            "%0.1f GB." % (cost['tmpBytes'] / 1024 ** 3))
+            warnings.append("Suggested threads in this computer: %d "
+                            "(about %0.1f hours)."
+                            % (cost['suggestedThreads'],
+                               cost['suggestedWallHours']))
+            warnings.append("Estimated from %d records of earlier runs in %s."
+                            % (cost['records'], self._getCostTableFn()))
+
+        return warnings
+
     def _summary(self):
         summary = []
 
@@ -304,6 +1368,38 @@ class ProtGoCTF(ProtParticles):
             summary.append("CTF refinement of %d particles."
                            % self.inputParticles.get().getSize())
 
+        report = self._readCalibration()
+        if report is not None:
+            selected, reference = report['selected'], report['reference']
+            summary.append(
+                "Calibration on %d micrographs %s box %d px and "
+                "downsampling %0.2f: goCTF %0.1fs (reference %0.1fs), "
+                "mean defocus change %0.1f A."
+                % (len(report['micrographs']),
+                   'used' if self.applyCalibration else 'recommends',
+                   selected['windowSize'], selected['downFactor'],
+                   selected['wallTime'], reference['wallTime'],
+                   selected['meanDelta']))
+
+        subsetFn = self._getSubsetReportFn()
+        if self.refineSubset and os.path.exists(subsetFn):
+            with open(subsetFn) as f:
+                mics = json.load(f)['micrographs']
+            summary.append(
+                "Defocus interpolated from %d particles per micrograph, "
+                "mean residual %0.1f A (max %0.1f A) against the refinement "
+                "of all particles in %d micrographs."
+                % (self.subsetSize.get(),
+                   np.mean([m['meanResidual'] for m in mics]),
+                   max(m['maxResidual'] for m in mics), len(mics)))
+
+        timingFn = self._getTimingFn()
+        if os.path.exists(timingFn):
+            summary.append("Time per phase (wall / CPU):")
+            for phase, (count, wall, cpu) in readPhaseTimes(timingFn).items():
+                summary.append(f"    {phase}: {wall:0.1f}s / {cpu:0.1f}s "
+                               f"({count} runs)")
+
         return summary
 
     def _methods(self):
@@ -322,12 +1418,13 @@ class ProtGoCTF(ProtParticles):
     def _defineArgs(self):
         self.inputMics = self._getMicrographs()
         acq = self.inputMics.getAcquisition()
+        windowSize, self._downFactor = self._getWindowAndDownFactor()
 
         self._params = {'voltage': acq.getVoltage(),
                         'sphericalAberration': acq.getSphericalAberration(),
                         'ampContrast': acq.getAmplitudeContrast(),
-                        'samplingRate': self.inputMics.getSamplingRate() * self.ctfDownFactor.get(),
-                        'windowSize': self.windowSize.get(),
+                        'samplingRate': self.inputMics.getSamplingRate() * self._downFactor,
+                        'windowSize': windowSize,
                         'lowRes': self.lowRes.get(),
                         'highRes': self.highRes.get(),
                         'minDefocus': self.minDefocus.get(),
@@ -356,5 +1453,291 @@ eof\n
     def _getOutputPath(self, micFn, ext):
         return pwutils.removeBaseExt(micFn) + ext
 
+    def _getMicTmpPath(self, micFn, ext):
+        """ Return a file in the micrograph tmp folder, where goCTF runs. """
+        micBase = pwutils.removeBaseExt(micFn)
+        return self._getTmpPath(micBase, micBase + ext)
+
+    def _getCoordsFn(self, micFn):
+        return self._getMicTmpPath(micFn, '_go.star')
+
+    def _getCtfFn(self, micFn):
+        return self._getMicTmpPath(micFn, '_goCTF.star')
+
+    def _getAllCoordsFn(self, micFn):
+        """ Coordinates of all particles, when only a subset is refined. """
+        return self._getMicTmpPath(micFn, '_all.star')
+
+    def _getSubsetReportFn(self):
+        return self._getExtraPath('subset_residuals.json')
+
+    def _getMicJob(self, micFn, fingerprint, micPath=None,
+                   windowSize=None, downFactor=None):
+        """ Return a dict with the values needed by workers.runMicJob
+        to refine the micrograph micFn. goCTF runs in micPath (the
+        micrograph tmp folder by default) and windowSize and downFactor
+        can be given to use other values than the ones in _params.
+        """
+        # We convert the input micrograph on demand if not in float .mrc
+        micPath = micPath or self._getTmpPath(pwutils.removeBaseExt(micFn))
+        downFactor = downFactor or self._downFactor
+        coordsFn = os.path.join(micPath, self._getOutputPath(micFn, '_go.star'))
+        minDefocus, maxDefocus = self._getDefocusRange(micFn, coordsFn)
+        if self.autoDefocusRange:
+            self.info(f"Defocus search range for {micFn}: "
+                      f"{minDefocus:0.1f} - {maxDefocus:0.1f} A")
+        params = dict(self._params,
+                      minDefocus=minDefocus, maxDefocus=maxDefocus,
+                      samplingRate=self.inputMics.getSamplingRate() * downFactor,
+                      windowSize=windowSize or self._params['windowSize'],
+                      micFn=pwutils.replaceBaseExt(micFn, 'mrc'),
+                      goctfOut=self._getOutputPath(micFn, ext="_ctf.log"),
+                      goctfPSD=self._getOutputPath(micFn, ext="_ctf.mrc"))
+        cache = self._micCache
+        return {'micFn': micFn,
+                'micPath': micPath,
+                'micFnMrc': os.path.join(micPath, params['micFn']),
+                'downFactor': downFactor,
+                'program': Plugin.getProgram(),
+                'args': self._args % params,
+                'env': Plugin.getEnviron(),
+                'ctfFn': os.path.join(micPath,
+                                      self._getOutputPath(micFn, '_goCTF.star')),
+                'fingerprint': fingerprint,
+                'fingerprintFn': os.path.join(
+                    micPath, self._getOutputPath(micFn, '_goCTF.sha1')),
+                'clean': not pwutils.envVarOn(SCIPION_DEBUG_NOCLEAN),
+                'cachePath': cache.path if cache is not None else None,
+                'cacheSize': cache.maxSize if cache is not None else None,
+                'timingFn': self._getTimingFn()}
+
+    def _getTimingFn(self):
+        return self._getExtraPath('timing.csv')
+
+    def _getFingerprintFn(self, micFn):
+        return self._getMicTmpPath(micFn, '_goCTF.sha1')
+
+    def _getMicFingerprint(self, micFn):
+        """ Return a hash identifying the inputs of goCTF for a micrograph:
+        input micrograph path and modification time, content of the
+        coordinates file and goCTF parameters.
+        """
+        with open(self._getCoordsFn(micFn), 'rb') as f:
+            coordsHash = hashlib.sha1(f.read()).hexdigest()
+
+        inputs = {'micFn': os.path.abspath(micFn),
+                  'mtime': os.path.getmtime(micFn),
+                  'coordinates': coordsHash,
+                  'params': self._params,
+                  'defocusRange': self._getDefocusRange(micFn)}
+
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def _getDefocusRange(self, micFn, coordsFn=None):
+        """ Return the (min, max) defocus to search for this micrograph.
+        With autoDefocusRange, it is computed from the input defocus of
+        its particles (read from coordsFn, the coordinates file of the
+        micrograph by default).
+        """
+        minDefocus = self._params['minDefocus']
+        maxDefocus = self._params['maxDefocus']
+        if not self.autoDefocusRange:
+            return minDefocus, maxDefocus
+
+        columns = readStarColumns(coordsFn or self._getCoordsFn(micFn),
+                                  ['rlnDefocusU', 'rlnDefocusV'])
+        defocus = np.concatenate(list(columns.values()) or [[]])
+        if not len(defocus):
+            return minDefocus, maxDefocus
+
+        median = np.median(defocus)
+        mad = np.median(np.abs(defocus - median))
+        halfWidth = (self.defocusWindowK.get() * mad +
+                     self.defocusWindowMargin.get())
+        low = max(minDefocus, median - halfWidth)
+        high = min(maxDefocus, median + halfWidth)
+        if low >= high:  # Input CTF out of the limits, use them
+            return minDefocus, maxDefocus
+
+        return round(float(low), 2), round(float(high), 2)
+
+    def _isMicUpToDate(self, micFn, fingerprint):
+        """ Return True if the goCTF output of this micrograph exists
+        and was produced from the same inputs (e.g. when continuing
+        a run that was interrupted).
+        """
+        return isOutputUpToDate(self._getCtfFn(micFn),
+                                self._getFingerprintFn(micFn), fingerprint)
+
     def _getMicrographs(self):
         return self.inputMicrographs.get()
+
+    def _getMicCost(self):
+        """ Estimated cost of the CTF search of one micrograph (without
+        its particles), scaled by its size after downsampling. """
+        micDim = self._getMicrographs().getDim()
+        if micDim is None:
+            return MIC_COST_PARTICLES
+        x, y, _ = micDim
+        downFactor = self._downFactor
+        return MIC_COST_PARTICLES * x * y / (4096 * 4096 * downFactor ** 2)
+
+    def _getCostTableFn(self):
+        return Plugin.getVar(GOCTF_COST_TABLE)
+
+    def _getCostRecord(self, micDim, downFactor, windowSize,
+                       minDefocus, maxDefocus, particles):
+        """ Return the CostModel record of a micrograph. """
+        x, y, _ = micDim
+        return {'pixels': x * y / downFactor ** 2,
+                'windowSize': windowSize,
+                'steps': int((maxDefocus - minDefocus) /
+                             self.stepDefocus.get()) + 1,
+                'particles': particles if self.doRefine else 0}
+
+    def _estimateCost(self):
+        """ Return a dict with the estimated CPU hours (calibration
+        included), the wall hours with the selected threads, the peak
+        temporary storage (bytes) of the micrographs converted for goCTF
+        and their output spectra, and the suggested threads for this
+        computer (and their wall hours).
+        """
+        self._createMicDict()
+        micDim = self._getMicrographs().getDim() or (4096, 4096, 1)
+        windowSize, downFactor = self._getWindowAndDownFactor()
+        minDefocus, maxDefocus = self.minDefocus.get(), self.maxDefocus.get()
+        if self.autoDefocusRange:
+            # The MAD of the input defocus is not known until the
+            # conversion, the range is at least twice the margin
+            maxDefocus = min(maxDefocus, minDefocus +
+                             2 * self.defocusWindowMargin.get())
+
+        counts = [self.micSizeDict[m] for m in
+                  sorted(self.micDict, key=lambda m: self.micIdDict[m])]
+        if self.refineSubset:
+            n = self.subsetValidationMics.get()
+            counts = counts[:n] + [min(c, self.subsetSize.get())
+                                   for c in counts[n:]]
+        model = CostModel(self._getCostTableFn())
+        seconds = model.predict([
+            self._getCostRecord(micDim, downFactor, windowSize,
+                                minDefocus, maxDefocus, c) for c in counts])
+
+        calibrationSeconds = 0
+        if self.doCalibration:
+            calibCounts = [self.micSizeDict[m]
+                           for m in self._getCalibrationMics()]
+            calibrationSeconds = sum(model.predict([
+                self._getCostRecord(micDim, d, w, minDefocus, maxDefocus, c)
+                for c in calibCounts]).sum()
+                for w, d in self._getCalibrationGrid())
+
+        # Micrographs are refined by the threads but the main one
+        workers = max(1, self.numberOfThreads.get() - 1)
+        suggestedWorkers = max(1, min(len(counts), os.cpu_count() or 1))
+        totalSeconds = seconds.sum() + calibrationSeconds
+
+        def _wallHours(numWorkers):
+            # Calibration runs in a single step, before the refinement
+            return (calibrationSeconds + max(seconds.sum() / numWorkers,
+                                             seconds.max(initial=0))) / 3600
+
+        # goCTF reads the input directly if it is already a float mrc
+        firstMic = next(iter(self.micDict.values()), None)
+        micBytes = 4 * micDim[0] * micDim[1] / downFactor ** 2
+        if (downFactor == 1 and firstMic is not None
+                and isFloatMrc(firstMic.getFileName())):
+            micBytes = 0
+        # Converted micrographs are removed after each run of goCTF,
+        # the output spectra are kept
+        kept = (len(counts) if pwutils.envVarOn(SCIPION_DEBUG_NOCLEAN)
+                else min(workers, len(counts)))
+        tmpBytes = kept * micBytes + len(counts) * 4 * windowSize ** 2
+        if self.useMicCache:
+            tmpBytes += min(self.micCacheSize.get() * 1024 ** 3,
+                            len(counts) * micBytes)
+
+        return {'micrographs': len(counts),
+                'cpuHours': totalSeconds / 3600,
+                'calibrationHours': calibrationSeconds / 3600,
+                'wallHours': _wallHours(workers),
+                'tmpBytes': tmpBytes,
+                'suggestedThreads': suggestedWorkers + 1,
+                'suggestedWallHours': _wallHours(suggestedWorkers),
+                'records': len(model.records)}
+
+    def _updateCostTable(self):
+        """ Add the times of the micrographs refined by this run to the
+        cost table used by _estimateCost. """
+        tableFn = self._getCostTableFn()
+        timingFn = self._getTimingFn()
+        micDim = self._getMicrographs().getDim()
+        if not tableFn or micDim is None or not os.path.exists(timingFn):
+            return
+
+        micTimes = readMicPhaseTimes(timingFn, ['preprocess', 'goctf'])
+        records = []
+        for mic in self.micDict.values():
+            micFn = mic.getFileName()
+            seconds = micTimes.get(os.path.basename(micFn))
+            if seconds is None or not os.path.exists(self._getCtfFn(micFn)):
+                continue
+            columns = readStarColumns(self._getCoordsFn(micFn),
+                                      ['rlnCoordinateX'])
+            record = self._getCostRecord(
+                micDim, self._downFactor, self._params['windowSize'],
+                *self._getDefocusRange(micFn),
+                len(columns.get('rlnCoordinateX', [])))
+            record['seconds'] = seconds
+            records.append(record)
+
+        if records:
+            try:
+                CostModel(tableFn).addRecords(records)
+            except Exception as e:
+                self.warning(f"Could not update the cost table "
+                             f"{tableFn}: {e}")
+
+    def _getCalibrationFn(self):
+        return self._getExtraPath('calibration.json')
+
+    def _readCalibration(self):
+        """ Return the calibration report, None if not done yet. """
+        calibFn = self._getCalibrationFn()
+        if not (self.doCalibration and os.path.exists(calibFn)):
+            return None
+
+        with open(calibFn) as f:
+            return json.load(f)
+
+    def _getWindowAndDownFactor(self):
+        """ Return the FFT box size and downsampling factor to refine
+        the micrographs: the ones selected by the calibration, if it is
+        done and applied, or the ones from the form. """
+        report = self._readCalibration()
+        if report is not None and self.applyCalibration:
+            selected = report['selected']
+            return selected['windowSize'], selected['downFactor']
+
+        return self.windowSize.get(), self.ctfDownFactor.get()
+
+    def _getCalibrationGrid(self):
+        """ Return the list of (windowSize, downFactor) to calibrate.
+        The first one is the reference: the largest box size without
+        downsampling. """
+        windows = set(int(w) for w in pwutils.getFloatListFromValues(
+            self.calibrationWindows.get()))
+        windows.add(self.windowSize.get())
+        downFactors = set(pwutils.getFloatListFromValues(
+            self.calibrationDownFactors.get()))
+        downFactors.add(1.)
+
+        return [(w, d) for d in sorted(downFactors)
+                for w in sorted(windows, reverse=True)]
+
+    def _getCalibrationMics(self):
+        """ Return the names of the micrographs used for the calibration,
+        evenly spaced in the input ones. """
+        micNames = sorted(self.micDict, key=lambda m: self.micIdDict[m])
+        n = min(self.calibrationMics.get(), len(micNames))
+        return [micNames[i * len(micNames) // n] for i in range(n)]
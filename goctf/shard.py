@@ -0,0 +1,72 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Run goCTF for the micrographs of a shard of a ProtGoCTF run, as written
+by its refineCtfShardStep in a json file. Micrographs whose goCTF output is
+up to date are skipped, so a shard can be run again on its own (e.g. after
+a failure of its job):
+
+    python -m goctf.shard Runs/000123_ProtGoCTF/extra/shards/shard_001.json
+
+The exit status is 1 if goCTF failed on any micrograph.
+"""
+
+import sys
+import json
+import logging
+
+from .workers import isOutputUpToDate, runMicJob
+
+logger = logging.getLogger('goctf.shard')
+
+
+def main(shardFn):
+    with open(shardFn) as f:
+        jobs = json.load(f)
+
+    logger.info(f"Running {len(jobs)} micrographs from {shardFn}")
+    failed = 0
+    for job in jobs:
+        micFn = job['micFn']
+        if isOutputUpToDate(job['ctfFn'], job['fingerprintFn'],
+                            job['fingerprint']):
+            logger.info(f"Skipping {micFn}, goCTF output is up to date.")
+        else:
+            result = runMicJob(job, log=logger)
+            if result['error']:
+                failed += 1
+        # Mark this micrograph as processed
+        open(job['doneFn'], 'w').close()
+
+    logger.info(f"Shard done, goCTF failed on {failed} micrographs.")
+    # Non zero exit status, so the step (or queue job) fails
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout,
+                        format='%(asctime)s %(levelname)s: %(message)s')
+    sys.exit(main(sys.argv[1]))
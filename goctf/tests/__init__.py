@@ -24,7 +24,16 @@
 # *
 # **************************************************************************
 
-from .test_protocols_goctf import TestGoCTF
+from .test_protocols_goctf import (TestGoCTF, TestGoCTFStreaming, TestGoCTFRefine,
+                                   TestGoCTFSteps,
+                                   TestGoCTFOutput, TestGoCTFDefocusRange,
+                                   TestGoCTFCalibration, TestGoCTFSubset,
+                                   TestGoCTFPlanes, TestGoCTFConvert,
+                                   TestGoCTFCost)
+from .test_convert import TestConvert
+from .test_utils import TestMicrographCache, TestIsFloatMrc, TestCostModel
+from .test_imports import TestImports
+from .test_workers import TestMicJobPool, TestShard
 
 from pyworkflow.tests import DataSet
 
@@ -0,0 +1,259 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import tempfile
+
+import numpy as np
+
+from pyworkflow.tests import BaseTest
+from pwem.constants import ALIGN_2D, ALIGN_3D, ALIGN_PROJ, ALIGN_NONE
+import pwem.emlib.metadata as md
+from pwem.objects import Transform, CTFModel
+
+from goctf.convert import (CTF_DICT, CoordinatesWriter, getShifts,
+                           getShiftsBatch, readCtfValues, readStarColumns,
+                           standardizeCtfValues, setCtfValues, selectSubset,
+                           interpolateCtfValues, fitDefocusPlanes)
+
+
+def rowToCtfModel(ctfRow, ctfModel):
+    """ Set the CTF from a metadata row, as the goCTF results were
+    read before using arrays. """
+    for attr, label in CTF_DICT.items():
+        getattr(ctfModel, attr).set(ctfRow.getValue(label))
+    ctfModel.standardize()
+    return ctfModel
+
+
+def valuesToCtfModel(values, ctfModel):
+    """ Set the CTF from a row of readCtfValues, one particle at a time. """
+    for attr, value in zip(CTF_DICT, values):
+        getattr(ctfModel, attr).set(float(value))
+    ctfModel.standardize()
+    return ctfModel
+
+
+class TestConvert(BaseTest):
+    @staticmethod
+    def _randomMatrices(n, seed=0):
+        """ Random rigid transforms with shifts, half of them with a flip. """
+        rng = np.random.default_rng(seed)
+        matrices = np.zeros((n, 4, 4))
+        for i in range(n):
+            q, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+            if (np.linalg.det(q) < 0) != (i % 2 == 1):
+                q[:, 0] *= -1
+            matrices[i, :3, :3] = q
+            matrices[i, :3, 3] = rng.normal(0, 20, size=3)
+            matrices[i, 3, 3] = 1.
+        return matrices
+
+    def testShiftsBatch(self):
+        matrices = self._randomMatrices(500)
+
+        for alignType in [ALIGN_2D, ALIGN_3D, ALIGN_PROJ]:
+            shifts = getShiftsBatch(matrices, alignType)
+            self.assertEqual(shifts.shape, (len(matrices), 2))
+            for matrix, batchShifts in zip(matrices, shifts):
+                transform = Transform()
+                transform.setMatrix(matrix.copy())
+                scalarShifts = getShifts(transform, alignType)
+                self.assertTrue(np.array_equal(scalarShifts[:2], batchShifts),
+                                f"Shifts differ for alignment {alignType}")
+
+        self.assertIsNone(getShiftsBatch(matrices, ALIGN_NONE))
+        self.assertEqual(getShiftsBatch([], ALIGN_2D).shape, (0, 2))
+
+    def testReadCtfValues(self):
+        rng = np.random.default_rng(1)
+        values = np.column_stack([rng.uniform(1000, 2000, size=(50, 2)),
+                                  rng.uniform(5000, 30000, size=(50, 2)),
+                                  rng.uniform(-90, 270, size=50)])
+        with tempfile.TemporaryDirectory() as tmpDir:
+            ctfFn = os.path.join(tmpDir, 'mic_goCTF.star')
+            with open(ctfFn, 'w') as f:
+                f.write("\ndata_\n\nloop_\n_rlnCoordinateX #1\n"
+                        "_rlnCoordinateY #2\n_rlnDefocusU #3\n"
+                        "_rlnDefocusV #4\n_rlnDefocusAngle #5\n")
+                np.savetxt(f, values, fmt='%.2f')
+
+            ctfValues = readCtfValues(ctfFn)
+            self.assertEqual(ctfValues.shape, (50, 3))
+            for row, rowValues in zip(md.iterRows(ctfFn), ctfValues):
+                ctfRow = rowToCtfModel(row, CTFModel())
+                ctfArray = valuesToCtfModel(rowValues, CTFModel())
+                self.assertTrue(ctfRow.equalAttributes(ctfArray))
+
+    def testCoordinatesWriter(self):
+        rng = np.random.default_rng(2)
+        values = np.column_stack([rng.uniform(0, 4096, size=(20, 2)),
+                                  rng.uniform(5000, 30000, size=(20, 2)),
+                                  rng.uniform(0, 180, size=20)])
+        with tempfile.TemporaryDirectory() as tmpDir:
+            rowsFn = os.path.join(tmpDir, 'rows_go.star')
+            writer = CoordinatesWriter(rowsFn)
+            for row in values:
+                writer.writeRow(*row)
+            writer.close()
+
+            blockFn = os.path.join(tmpDir, 'block_go.star')
+            writer = CoordinatesWriter(blockFn)
+            writer.writeRows(values)
+            writer.writeRows(np.empty((0, 5)))
+            writer.close()
+
+            with open(rowsFn) as f1, open(blockFn) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+            mdCoords = md.MetaData(blockFn)
+            self.assertEqual(mdCoords.size(), 20)
+            self.assertTrue(mdCoords.containsLabel(md.RLN_CTF_DEFOCUS_ANGLE))
+            self.assertTrue(np.allclose(
+                mdCoords.getColumnValues(md.RLN_CTF_DEFOCUS_ANGLE),
+                values[:, 4], atol=0.005))
+
+    def testReadStarColumns(self):
+        """ Compare with the metadata library on files with random
+        columns order, number of rows and formatting. """
+        rng = np.random.default_rng(3)
+        labels = [md.RLN_IMAGE_COORD_X, md.RLN_IMAGE_COORD_Y,
+                  md.RLN_CTF_DEFOCUSU, md.RLN_CTF_DEFOCUSV,
+                  md.RLN_CTF_DEFOCUS_ANGLE, md.RLN_MICROGRAPH_NAME]
+        with tempfile.TemporaryDirectory() as tmpDir:
+            for i in range(20):
+                order = rng.permutation(len(labels))[:rng.integers(2, 7)]
+                fileLabels = [labels[j] for j in order]
+                numRows = int(rng.integers(0, 200))
+                starFn = os.path.join(tmpDir, 'file%02d.star' % i)
+                with open(starFn, 'w') as f:
+                    f.write("\n# comment\ndata_\n\nloop_\n")
+                    for j, label in enumerate(fileLabels):
+                        f.write("_%s #%d\n" % (md.label2Str(label), j + 1))
+                    for _ in range(numRows):
+                        row = ['mic%d.mrc' % rng.integers(100)
+                               if label == md.RLN_MICROGRAPH_NAME
+                               else '%.*f' % (int(rng.integers(0, 7)),
+                                              rng.uniform(-1e4, 1e5))
+                               for label in fileLabels]
+                        f.write('  '.join(row) + '\n')
+                    f.write("\n")
+
+                columns = readStarColumns(starFn, [md.label2Str(label)
+                                                   for label in labels[:5]])
+                mdStar = md.MetaData(starFn)
+                self.assertEqual(mdStar.size(), numRows)
+                for label in labels[:5]:
+                    name = md.label2Str(label)
+                    if label in fileLabels:
+                        self.assertTrue(np.array_equal(
+                            columns[name],
+                            np.array(mdStar.getColumnValues(label),
+                                     dtype=float)))
+                    else:
+                        self.assertNotIn(name, columns)
+
+    def testStandardizeCtfValues(self):
+        rng = np.random.default_rng(4)
+        values = np.column_stack([rng.uniform(-100, 30000, size=(500, 2)),
+                                  rng.uniform(-180, 360, size=500)])
+        values[:10, 1] = values[:10, 0]  # same defocusU and defocusV
+        values[10:20, 1] = 0.05  # too small defocusV
+        values[20:30, 2] = rng.choice([-90., 0., 90., 180.], size=10)
+
+        for row, stdRow in zip(values, standardizeCtfValues(values)):
+            ctf = valuesToCtfModel(row, CTFModel())
+            ctfBatch = CTFModel()
+            setCtfValues(ctfBatch, stdRow.tolist())
+            self.assertTrue(ctf.equalAttributes(ctfBatch))
+
+    def testSelectSubset(self):
+        rng = np.random.default_rng(5)
+        coords = rng.uniform(0, 4096, size=(1000, 2))
+        subset = selectSubset(coords, 49)
+        self.assertEqual(len(subset), 49)
+        self.assertTrue(np.all(np.diff(subset) > 0))
+        # One particle in each cell of the 7x7 grid
+        cells = (coords[subset] - coords.min(axis=0)) // (
+            np.ptp(coords, axis=0) / 7)
+        self.assertEqual(len(set(map(tuple, cells))), 49)
+        self.assertTrue(np.array_equal(selectSubset(coords[:30], 49),
+                                       np.arange(30)))
+        # Clustered particles: more than one per cell is taken
+        self.assertEqual(len(selectSubset(coords[:, :1].repeat(2, 1), 49)),
+                         49)
+
+    def testInterpolateCtfValues(self):
+        rng = np.random.default_rng(6)
+        coords = rng.uniform(0, 4096, size=(200, 2))
+        defocus = 20000. + 0.5 * coords[:, 0] - 0.2 * coords[:, 1]
+        values = np.column_stack([defocus + 300, defocus - 300,
+                                  np.full(200, 179.)])
+        values[::2, 2] = 1.  # axial mean of 179 and 1 is about 0
+        values[1::4] = values[1::4, [1, 0, 2]] + [0, 0, 90]
+
+        subset = selectSubset(coords, 20)
+        interpolated = interpolateCtfValues(coords[subset], values[subset],
+                                            coords)
+        self.assertTrue(np.allclose(interpolated[:, 0], defocus + 300))
+        self.assertTrue(np.allclose(interpolated[:, 1], defocus - 300))
+        self.assertTrue(np.allclose(np.minimum(interpolated[:, 2],
+                                               180 - interpolated[:, 2]), 0,
+                                    atol=1))
+        # Collinear particles: constant defocus
+        interpolated = interpolateCtfValues(coords[:2], values[:2], coords)
+        self.assertTrue(np.allclose(interpolated[:, :2].mean(axis=1),
+                                    defocus[:2].mean()))
+
+    def testFitDefocusPlanes(self):
+        rng = np.random.default_rng(7)
+        numGroups, n = 20, 300
+        groups = np.repeat(rng.permutation(numGroups) * 5, n)
+        coords = rng.uniform(0, 4096, size=(numGroups * n, 2))
+        planes = np.column_stack([rng.uniform(10000, 30000, numGroups),
+                                  rng.normal(0, 0.5, size=(numGroups, 2))])
+        expected = planes[groups // 5]
+        defocus = (expected[:, 0] + (coords * expected[:, 1:]).sum(axis=1) +
+                   rng.normal(0, 50, size=len(groups)))
+        outliers = rng.random(len(groups)) < 0.05
+        defocus[outliers] += rng.choice([-2000, 2000], size=outliers.sum())
+
+        fitPlanes, residuals, fitOutliers = fitDefocusPlanes(
+            groups, coords, defocus, threshold=5)
+        self.assertTrue(np.allclose(fitPlanes[:, 0], expected[:, 0], atol=30))
+        self.assertTrue(np.allclose(fitPlanes[:, 1:], expected[:, 1:],
+                                    atol=0.01))
+        self.assertTrue(np.array_equal(fitOutliers, outliers))
+        self.assertTrue(np.allclose(
+            residuals, defocus - fitPlanes[:, 0] -
+            (coords * fitPlanes[:, 1:]).sum(axis=1)))
+        # Less than 3 non collinear particles: constant defocus
+        fitPlanes, residuals, fitOutliers = fitDefocusPlanes(
+            [1, 1, 2], [[0, 0], [1, 1], [5, 5]], [10, 20, 30])
+        self.assertTrue(np.allclose(fitPlanes, [[15, 0, 0], [15, 0, 0],
+                                                [30, 0, 0]]))
+        self.assertFalse(fitOutliers.any())
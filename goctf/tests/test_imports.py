@@ -0,0 +1,70 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import subprocess
+import sys
+
+from pyworkflow.tests import BaseTest
+
+
+# Modules goctf.protocols may load on top of the ones already loaded by
+# pwem and pyworkflow, to be extended only on purpose
+ALLOWED_MODULES = set()
+
+BASELINE_IMPORT = 'import pwem.protocols, pwem.objects, pyworkflow.protocol.params'
+
+
+class TestImports(BaseTest):
+    """ The protocol module is imported by every Scipion process (project
+    window, viewers, protocol listings), so the heavy modules only needed
+    to run the steps must be imported when the steps run. """
+
+    @staticmethod
+    def _importedModules(statement):
+        """ Names of the modules loaded by statement in a new interpreter,
+        from the output of python -X importtime. """
+        result = subprocess.run([sys.executable, '-X', 'importtime',
+                                 '-c', statement],
+                                stderr=subprocess.PIPE, text=True, check=True)
+        modules = set()
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:'):
+                name = line.rsplit('|', 1)[-1].strip()
+                if name != 'package':  # header line
+                    modules.add(name)
+        return modules
+
+    def testProtocolImports(self):
+        baseline = self._importedModules(BASELINE_IMPORT)
+        modules = self._importedModules('import goctf.protocols')
+        self.assertIn('goctf.protocols.protocol_goctf', modules)
+
+        extra = {m for m in modules - baseline
+                 if m != 'goctf' and not m.startswith('goctf.')}
+        self.assertFalse(extra - ALLOWED_MODULES,
+                         "goctf.protocols imports new modules at load "
+                         "time: %s" % ', '.join(sorted(extra)))
@@ -24,11 +24,32 @@
 # *
 # **************************************************************************
 
+import os
+import csv
+import json
+import time
+import shutil
+from unittest import mock
+
+import numpy as np
+import mrcfile
+
+from pwem.constants import ALIGN_2D
+from pwem.objects import (SetOfParticles, SetOfMicrographs, Micrograph,
+                          Particle, Coordinate, CTFModel, Acquisition,
+                          Transform, SetOfClasses2D, Class2D)
 from pwem.protocols import ProtImportMicrographs, ProtImportParticles
+from pyworkflow.object import Set
+import pyworkflow.utils as pwutils
 from pyworkflow.utils import magentaStr
-from pyworkflow.tests import BaseTest, DataSet, setupTestProject
+from pyworkflow.tests import BaseTest, DataSet, setupTestProject, setupTestOutput
 
+from goctf import Plugin
+from goctf.constants import (OUTLIERS_FLAG, OUTLIERS_REMOVE, GOCTF_COST_TABLE,
+                             PARALLEL_PROCESSES, PARALLEL_SHARDS)
+from goctf.convert import CoordinatesWriter
 from goctf.protocols import ProtGoCTF
+from goctf.utils import PhaseTimer, CostModel, readPhaseTimes
 
 
 class TestGoCTFBase(BaseTest):
@@ -85,3 +106,788 @@ class TestGoCTF(TestGoCTFBase):
                              "SetOfParticles has not been produced.")
         self.assertEqual(protCTF.inputParticles.get().getSize(),
                          protCTF.outputParticles.getSize())
+
+
+class TestGoCTFOfflineBase(BaseTest):
+    """ Base class of the tests that run the steps of ProtGoCTF outside
+    a project, on small input sets created by the tests. goCTF execution
+    is replaced by a copy of the input values. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        # Do not add the times of these runs to the user cost table
+        cls._costTable = mock.patch.dict(Plugin._vars, {
+            GOCTF_COST_TABLE: cls.getOutputPath('cost_table.json')})
+        cls._costTable.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._costTable.stop()
+
+    def _createMicrographs(self, numMics, prefix=''):
+        micSet = SetOfMicrographs(
+            filename=self.getOutputPath(prefix + 'mics.sqlite'))
+        micSet.setSamplingRate(1.0)
+        acq = Acquisition(voltage=300., sphericalAberration=2.7,
+                          amplitudeContrast=0.1, magnification=50000)
+        micSet.setAcquisition(acq)
+        for i in range(1, numMics + 1):
+            mic = Micrograph(
+                location=self.getOutputPath(prefix + 'mic%03d.mrc' % i))
+            mic.setMicName('mic%03d' % i)
+            micSet.append(mic)
+            open(mic.getFileName(), 'w').close()
+        micSet.write()
+        return micSet
+
+    def _appendParticles(self, micIds, closeStream=False, prefix='',
+                         shifts=False):
+        """ Append 10 particles per micrograph to the input set
+        as an upstream protocol running in streaming would do.
+        If shifts, the particles have a 2D alignment with shifts. """
+        partsFn = self.getOutputPath(prefix + 'particles.sqlite')
+        exists = os.path.exists(partsFn)
+        partSet = SetOfParticles(filename=partsFn)
+        if exists:
+            partSet.loadAllProperties()
+            partSet.enableAppend()
+        else:
+            partSet.setSamplingRate(1.0)
+            partSet.setHasCTF(True)
+            if shifts:
+                partSet.setAlignment(ALIGN_2D)
+        for micId in micIds:
+            for i in range(10):
+                coord = Coordinate(x=100 * i, y=50 * (i % 4))
+                coord.setMicId(micId)
+                coord.setMicName('mic%03d' % micId)
+                ctf = CTFModel()
+                ctf.setStandardDefocus(20000. + micId, 19000., 45.)
+                part = Particle(location=(i + 1, 'particles.mrcs'))
+                part.setCoordinate(coord)
+                part.setMicId(micId)
+                part.setCTF(ctf)
+                if shifts:
+                    transform = Transform()
+                    transform.setShifts(i + 0.5, -2 * i, 0)
+                    part.setTransform(transform)
+                partSet.append(part)
+        partSet.setStreamState(Set.STREAM_CLOSED if closeStream
+                               else Set.STREAM_OPEN)
+        partSet.write()
+        partSet.close()
+        return SetOfParticles(filename=partsFn)
+
+    def _createClasses(self, partSet, prefix=''):
+        """ Return a set of two 2D classes of partSet, the first one
+        with the particles of odd id. Particles of each class are stored
+        in the classes database, in tables with the class prefix. """
+        classes = SetOfClasses2D(
+            filename=self.getOutputPath(prefix + 'classes.sqlite'))
+        classes.setImages(partSet)
+        for classId in [1, 2]:
+            class2D = Class2D(objId=classId)
+            class2D.copyInfo(partSet)
+            classes.append(class2D)
+            for part in partSet:
+                if part.getObjId() % 2 == classId % 2:
+                    class2D.append(part.clone())
+            classes.update(class2D)
+        classes.write()
+        classes.close()
+        return SetOfClasses2D(filename=classes.getFileName())
+
+    def _runNewSteps(self, prot):
+        """ Run the conversion and refinement steps not yet executed. """
+        for step in prot._steps:
+            if step.funcName in ['convertInputStep', 'refineCtfStep']:
+                if not step.isFinished():
+                    step._runFunc()
+                    step.setStatus('finished')
+
+    def _fakeGoCtf(self, prot, micFn, fingerprint):
+        shutil.copy(prot._getCoordsFn(micFn), prot._getCtfFn(micFn))
+
+    def _newProtocol(self, prefix, micIds, numMics=None, closeStream=True,
+                     shifts=False, runSteps=('convertInputStep',),
+                     inputClass=False, **params):
+        """ Create a ProtGoCTF with the given params, on new input sets of
+        numMics micrographs (the max of micIds by default) and particles
+        from micIds. Its steps are inserted and the ones in runSteps run.
+        If inputClass, the input particles are the first class of a set
+        of 2D classes of the particles.
+        """
+        micSet = self._createMicrographs(numMics or max(micIds),
+                                         prefix=prefix + '_')
+        partSet = self._appendParticles(micIds, closeStream=closeStream,
+                                        prefix=prefix + '_', shifts=shifts)
+        partSet.loadAllProperties()
+        if inputClass:
+            # Kept, the class is read with the connection of its set
+            self.inputClasses = self._createClasses(partSet,
+                                                    prefix=prefix + '_')
+            partSet = self.inputClasses[1]
+
+        protCTF = ProtGoCTF(**params)
+        protCTF.setWorkingDir(self.getOutputPath('goctf_' + prefix))
+        protCTF.makeWorkingDir()
+        protCTF.inputParticles.set(partSet)
+        protCTF.inputMicrographs.set(micSet)
+        protCTF._runGoCtf = lambda *args: self._fakeGoCtf(protCTF, *args)
+        # There is no project database to store relations
+        protCTF._defineTransformRelation = lambda *args: None
+        protCTF._insertAllSteps()
+        for step in protCTF._steps:
+            if step.funcName in runSteps:
+                step._runFunc()
+                step.setStatus('finished')
+
+        return protCTF
+
+    def _fakeGoCtfOutputs(self, prot, micNames=None):
+        """ Write the goCTF output of micNames (all by default). """
+        for micName in micNames or prot.micDict:
+            self._fakeGoCtf(prot, prot.micDict[micName].getFileName(), None)
+
+
+class TestGoCTFStreaming(TestGoCTFOfflineBase):
+    """ Refine CTF while a (locally simulated) input set of particles
+    grows. """
+    def testStreaming(self):
+        print(magentaStr("\n==> Testing goctf in streaming:"))
+        protCTF = self._newProtocol('stream', [1, 2], numMics=6,
+                                    closeStream=False, runSteps=(),
+                                    micsPerStep=2)
+        self.assertTrue(protCTF.streamMode)
+        self.assertEqual(list(protCTF.micDict), ['mic001', 'mic002'])
+        self.assertTrue(protCTF._getFirstJoinStep().isWaiting())
+
+        self._runNewSteps(protCTF)
+        protCTF._stepsCheck()
+        output = protCTF.outputParticles
+        self.assertEqual(output.getSize(), 20)
+        self.assertTrue(output.isStreamOpen())
+
+        # New micrographs arrive: new steps are inserted
+        protCTF.lastCheck = 0
+        self._appendParticles([3, 5], prefix='stream_')
+        protCTF._stepsCheck()
+        self.assertEqual(list(protCTF.micDict),
+                         ['mic001', 'mic002', 'mic003', 'mic005'])
+        self.assertEqual(protCTF.outputParticles.getSize(), 20)
+        # Counts are not added again for the micrographs already found
+        protCTF.lastCheck = 0
+        protCTF._checkNewInput()
+        self.assertEqual(dict(protCTF.micSizeDict),
+                         {'mic001': 10, 'mic002': 10, 'mic003': 10,
+                          'mic005': 10})
+
+        self._runNewSteps(protCTF)
+        protCTF._stepsCheck()
+        self.assertEqual(protCTF.outputParticles.getSize(), 40)
+        self.assertTrue(protCTF._getFirstJoinStep().isWaiting())
+
+        # The input is closed: the output is closed when all mics are done
+        protCTF.lastCheck = 0
+        self._appendParticles([6], closeStream=True, prefix='stream_')
+        protCTF._stepsCheck()
+        self.assertTrue(protCTF.outputParticles.isStreamOpen())
+        self.assertEqual(list(protCTF.micSizeDict.values()), [10] * 5)
+        self._runNewSteps(protCTF)
+        protCTF._stepsCheck()
+
+        output = SetOfParticles(filename=protCTF.outputParticles.getFileName())
+        output.loadAllProperties()
+        self.assertEqual(output.getSize(), 50)
+        self.assertTrue(output.isStreamClosed())
+        self.assertFalse(protCTF._getFirstJoinStep().isWaiting())
+
+        timings = readPhaseTimes(protCTF._getTimingFn())
+        self.assertEqual(list(timings), ['convert', 'merge'])
+        # Merge of each micrograph, once
+        with open(protCTF._getTimingFn(), newline='') as f:
+            merged = [row['micrograph'] for row in csv.DictReader(f)
+                      if row['phase'] == 'merge']
+        self.assertEqual(merged, [os.path.basename(mic.getFileName())
+                                  for mic in protCTF.micDict.values()])
+
+    def testMicParticleCounts(self):
+        protCTF = self._newProtocol('counts', [3, 1, 2], runSteps=())
+        partSet = self._appendParticles([1], closeStream=True,
+                                        prefix='counts_')
+        warnings = []
+        protCTF.warning = warnings.append
+        expected = [(1, 'mic001', 20), (2, 'mic002', 10), (3, 'mic003', 10)]
+
+        # A single query, particles are not iterated
+        with mock.patch.object(SetOfParticles, 'iterItems') as iterItems:
+            self.assertEqual(protCTF._getMicParticleCounts(partSet), expected)
+        iterItems.assert_not_called()
+        self.assertEqual(warnings, [])
+
+        # Scan of the particles if the mapper can not group them
+        with mock.patch.object(SetOfParticles, 'aggregate',
+                               side_effect=Exception('no GROUP BY')):
+            self.assertEqual(protCTF._getMicParticleCounts(partSet), expected)
+        self.assertEqual(len(warnings), 1)
+        self.assertIn('no GROUP BY', warnings[0])
+
+
+class TestGoCTFRefine(TestGoCTFOfflineBase):
+    """ Refinement steps, running goCTF through workers.runMicJob. """
+    def _fakeRunJob(self, program, args, env=None, cwd=None):
+        """ goCTF output with the input values. """
+        for fn in os.listdir(cwd):
+            if fn.endswith('_go.star'):
+                shutil.copy(os.path.join(cwd, fn),
+                            os.path.join(cwd, fn.replace('_go.star',
+                                                         '_goCTF.star')))
+
+    def _writeMrcMics(self, prot):
+        """ Write the input micrographs as float mrc files, so they are
+        linked for goCTF instead of being converted. """
+        for mic in prot.micDict.values():
+            with mrcfile.new(mic.getFileName(), overwrite=True) as mrc:
+                mrc.set_data(np.zeros((16, 16), dtype=np.float32))
+
+    def testBatchFailure(self):
+        print(magentaStr("\n==> Testing goctf steps with several mics:"))
+        protCTF = self._newProtocol('batch', list(range(1, 13)),
+                                    numberOfThreads=1, micsPerStep=3)
+        del protCTF._runGoCtf  # Run through runMicJob
+        protCTF.runJob = self._fakeRunJob
+        self._writeMrcMics(protCTF)
+
+        refineSteps = [s for s in protCTF._steps
+                       if s.funcName == 'refineCtfStep']
+        micFns = [mic.getFileName() for mic in protCTF.micDict.values()]
+        self.assertEqual([list(s._args) for s in refineSteps],
+                         [micFns[i:i + 3] for i in range(0, 12, 3)])
+
+        # Preprocessing of the middle micrograph of a step fails
+        micFns = micFns[:3]
+        open(micFns[1], 'w').close()  # Not a float mrc, it is converted
+        with mock.patch('goctf.workers.preprocessMic',
+                        side_effect=RuntimeError("Bad micrograph")):
+            refineSteps[0]._runFunc()
+
+        for micFn in micFns:
+            self.assertEqual(os.path.exists(protCTF._getCtfFn(micFn)),
+                             micFn != micFns[1])
+            self.assertTrue(os.path.exists(protCTF._getMicDoneFn(micFn)))
+
+    def testFingerprint(self):
+        print(magentaStr("\n==> Testing goctf up to date outputs:"))
+        protCTF = self._newProtocol('fingerprint', [1, 2])
+        del protCTF._runGoCtf  # Run through runMicJob
+        self._writeMrcMics(protCTF)
+        runs = []
+
+        def _runJob(program, args, env=None, cwd=None):
+            runs.append(os.path.basename(cwd))
+            self._fakeRunJob(program, args, env, cwd)
+
+        protCTF.runJob = _runJob
+        micFn = protCTF.micDict['mic001'].getFileName()
+        ctfFn = protCTF._getCtfFn(micFn)
+        protCTF.refineCtfStep(micFn)
+        self.assertEqual(runs, ['fingerprint_mic001'])
+
+        # Same inputs: the output is up to date
+        protCTF.refineCtfStep(micFn)
+        self.assertEqual(len(runs), 1)
+
+        # Other parameters or coordinates: goCTF runs again
+        protCTF.highRes.set(4.)
+        protCTF._defineArgs()
+        protCTF.refineCtfStep(micFn)
+        self.assertEqual(len(runs), 2)
+        with open(protCTF._getCoordsFn(micFn), 'a') as f:
+            f.write('1000.00 1000.00 20001.00 19000.00 45.00\n')
+        protCTF.refineCtfStep(micFn)
+        self.assertEqual(len(runs), 3)
+        self.assertEqual(len(protCTF._readCoords(ctfFn)), 11)
+        protCTF.refineCtfStep(micFn)
+        self.assertEqual(len(runs), 3)
+
+        # A failed run does not leave the output of the previous one
+        protCTF.lowRes.set(25.)
+        protCTF._defineArgs()
+        protCTF.runJob = mock.Mock(side_effect=RuntimeError("goCTF failed"))
+        protCTF.refineCtfStep(micFn)
+        self.assertFalse(os.path.exists(ctfFn))
+        self.assertFalse(os.path.exists(protCTF._getFingerprintFn(micFn)))
+
+    def testPoolSteps(self):
+        protCTF = self._newProtocol('pool', list(range(1, 13)), runSteps=(),
+                                    parallelMode=PARALLEL_PROCESSES)
+        convSteps = {i + 1: s for i, s in enumerate(protCTF._steps)
+                     if s.funcName == 'convertInputStep'}
+        poolSteps = [s for s in protCTF._steps
+                     if s.funcName == 'refineCtfPoolStep']
+        self.assertEqual(len(convSteps), 6)  # 2 micrographs per chunk
+        self.assertEqual(len(poolSteps), 6)
+        # Each pool step only waits for the conversion of its micrographs
+        for step in poolSteps:
+            convStep = convSteps[int(step._prerequisites[0])]
+            self.assertEqual(len(step._prerequisites), 1)
+            self.assertEqual(list(step._args),
+                             [protCTF.micDict[m].getFileName()
+                              for m in convStep._args[0]])
+
+
+class TestGoCTFSteps(TestGoCTFOfflineBase):
+    """ Conversion and refinement steps inserted for the micrographs. """
+    def _getSteps(self, prot, funcName):
+        """ Return a dict {stepId: step} of the steps of funcName. """
+        return {i + 1: s for i, s in enumerate(prot._steps)
+                if s.funcName == funcName}
+
+    def testStepsByCost(self):
+        protCTF = self._newProtocol('order', list(range(1, 7)), runSteps=(),
+                                    numberOfThreads=1, micsPerStep=1)
+        sizes = dict(zip(protCTF.micDict, [5, 30, 10, 20, 40, 1]))
+        protCTF.micSizeDict.update(sizes)
+        micNames = {mic.getFileName(): m for m, mic in protCTF.micDict.items()}
+
+        numSteps = len(protCTF._steps)
+        protCTF._insertNewMicsSteps(list(protCTF.micDict))
+        newSteps = {i: s for i, s in enumerate(protCTF._steps, 1)
+                    if i > numSteps}
+        convSteps = {i: s._args[0] for i, s in newSteps.items()
+                     if s.funcName == 'convertInputStep'}
+        refineSteps = [s for s in newSteps.values()
+                       if s.funcName == 'refineCtfStep']
+
+        # Chunks with the most expensive micrograph are converted first
+        chunkCosts = [max(sizes[m] for m in chunk)
+                      for chunk in convSteps.values()]
+        self.assertGreater(len(chunkCosts), 1)
+        self.assertEqual(chunkCosts, sorted(chunkCosts, reverse=True))
+
+        # Refinement by decreasing cost, after converting its micrograph
+        refineMics = [micNames[s._args[0]] for s in refineSteps]
+        self.assertEqual(refineMics, ['mic005', 'mic002', 'mic004',
+                                      'mic003', 'mic001', 'mic006'])
+        for micName, step in zip(refineMics, refineSteps):
+            convId = int(step._prerequisites[0])
+            self.assertIn(micName, convSteps[convId])
+
+    def testShardSteps(self):
+        protCTF = self._newProtocol('shards', list(range(1, 7)), runSteps=(),
+                                    parallelMode=PARALLEL_SHARDS,
+                                    numberOfShards=2)
+        convIds = {m: stepId for stepId, step in
+                   self._getSteps(protCTF, 'convertInputStep').items()
+                   for m in step._args[0]}
+        shardSteps = list(self._getSteps(protCTF,
+                                         'refineCtfShardStep').values())
+        self.assertEqual([s._args[0] for s in shardSteps], [1, 2])
+        for step in shardSteps:
+            micNames = [m for m, mic in protCTF.micDict.items()
+                        if mic.getFileName() in step._args[1:]]
+            self.assertEqual(len(micNames), 3)
+            self.assertEqual([int(i) for i in step._prerequisites],
+                             sorted(convIds[m] for m in micNames))
+
+        # Micrographs go to the shard with less cost so far
+        sizes = [100, 60, 50, 40, 30, 20]
+        protCTF.micSizeDict.update(zip(protCTF.micDict, sizes))
+        numSteps = len(protCTF._steps)
+        protCTF._insertShardSteps(
+            [(size, convIds[m], [m]) for m, size
+             in zip(protCTF.micDict, sizes)], micCost=0)
+        self.assertEqual([[os.path.basename(fn) for fn in s._args[1:]]
+                          for s in protCTF._steps[numSteps:]],
+                         [['shards_mic001.mrc', 'shards_mic004.mrc',
+                           'shards_mic006.mrc'],
+                          ['shards_mic002.mrc', 'shards_mic003.mrc',
+                           'shards_mic005.mrc']])
+
+
+class TestGoCTFOutput(TestGoCTFOfflineBase):
+    """ Output set written by updating a copy of the input database. """
+    def testBulkOutput(self):
+        print(magentaStr("\n==> Testing goctf output database:"))
+        protCTF = self._newProtocol('bulk', [1, 2, 3, 5], numMics=4)
+        partSet = protCTF.inputParticles.get()
+        self.assertFalse(protCTF.streamMode)
+        self.assertEqual(list(protCTF.micDict), ['mic001', 'mic002', 'mic003'])
+
+        # goCTF output with defocusU and defocusV exchanged in mic002,
+        # and no output for mic003, whose particles are not included
+        self._fakeGoCtfOutputs(protCTF, ['mic001', 'mic002'])
+        ctfFn = protCTF._getCtfFn(protCTF.micDict['mic002'].getFileName())
+        with open(ctfFn) as f:
+            lines = f.readlines()
+        with open(ctfFn, 'w') as f:
+            for line in lines:
+                values = line.split()
+                if len(values) == 5 and not line.startswith('_'):
+                    values[2], values[3] = values[3], values[2]
+                    line = ' '.join(values) + '\n'
+                f.write(line)
+
+        protCTF.createOutputStep()
+        output = protCTF.outputParticles
+        self.assertEqual(output.getFileName(),
+                         protCTF._getPath('particles.sqlite'))
+        self.assertEqual(output.getSize(), 20)
+        self.assertTrue(output.isStreamClosed())
+
+        expected = SetOfParticles(filename=protCTF._getPath('expected.sqlite'))
+        expected.copyInfo(partSet)
+        protCTF._appendRefinedParticles(expected, partSet)
+        expected.write()
+        self.assertEqual(expected.getSize(), 20)
+
+        output = SetOfParticles(filename=output.getFileName())
+        output.loadAllProperties()
+        self.assertEqual(output.getSize(), 20)
+        self.assertEqual(output.getSamplingRate(), expected.getSamplingRate())
+        for part, expectedPart in zip(output, expected):
+            self.assertEqual(part.getObjId(), expectedPart.getObjId())
+            self.assertTrue(part.getCTF().equalAttributes(expectedPart.getCTF()))
+            self.assertTrue(part.getCoordinate().equalAttributes(
+                expectedPart.getCoordinate()))
+        self.assertGreater(output.getFirstItem().getCTF().getDefocusU(),
+                           output.getFirstItem().getCTF().getDefocusV())
+
+        # Merge of each micrograph and the database update of all of them
+        with open(protCTF._getTimingFn(), newline='') as f:
+            rows = [(row['phase'], row['micrograph'])
+                    for row in csv.DictReader(f)
+                    if row['phase'].startswith('merge')]
+        self.assertEqual(rows[:5], [('mergeDb', ''),
+                                    ('merge', 'bulk_mic001.mrc'),
+                                    ('merge', 'bulk_mic002.mrc'),
+                                    ('merge', 'bulk_mic003.mrc'),
+                                    ('mergeDb', '')])
+
+    def testClassSubsetOutput(self):
+        protCTF = self._newProtocol('classout', [1, 2, 3], inputClass=True)
+        self.assertTrue(protCTF.inputParticles.get().getPrefix())
+        self._fakeGoCtfOutputs(protCTF)
+
+        protCTF.createOutputStep()
+        output = SetOfParticles(
+            filename=protCTF.outputParticles.getFileName())
+        output.loadAllProperties()
+        self.assertEqual(output.getSize(), 15)
+        for part in output:
+            self.assertEqual(part.getObjId() % 2, 1)
+            self.assertAlmostEqual(part.getCTF().getDefocusU(),
+                                   20000. + part.getMicId())
+
+
+class TestGoCTFDefocusRange(TestGoCTFOfflineBase):
+    """ Defocus search range per micrograph from the input CTF. """
+    def testDefocusRange(self):
+        protCTF = self._newProtocol('range', [1, 2], autoDefocusRange=True)
+
+        # Defocus of mic001 particles are 20001 (U) and 19000 (V)
+        micFn = protCTF.micDict['mic001'].getFileName()
+        self.assertEqual(protCTF._getDefocusRange(micFn),
+                         (19500.5 - 3501.5, 19500.5 + 3501.5))
+        job = protCTF._getMicJob(micFn, None)
+        self.assertIn('\n15999.000000\n23002.000000\n', job['args'])
+
+        protCTF.maxDefocus.set(21000.)
+        protCTF._defineArgs()
+        self.assertEqual(protCTF._getDefocusRange(micFn), (15999., 21000.))
+
+        protCTF.autoDefocusRange.set(False)
+        self.assertEqual(protCTF._getDefocusRange(micFn), (5000., 21000.))
+
+
+class TestGoCTFCalibration(TestGoCTFOfflineBase):
+    """ Calibration of the FFT box size and downsampling. """
+    def _fakeCalibrationJob(self, job, cache, timer):
+        """ goCTF output with the defocus changed and a run time
+        growing with the box size and decreasing with downsampling. """
+        windowSize = int(job['args'].split('\n')[7])
+        downFactor = job['downFactor']
+        change = (512 - windowSize) / 2 + (downFactor - 1) * 400
+        with timer.phase('goctf', os.path.basename(job['micFn'])):
+            time.sleep(0.05 * (windowSize / 512 / downFactor) ** 2)
+        coordsFn = job['ctfFn'].replace('_goCTF.star', '_go.star')
+        with open(coordsFn) as f, open(job['ctfFn'], 'w') as fOut:
+            for line in f:
+                values = line.split()
+                if len(values) == 5 and not line.startswith('_'):
+                    values[2:4] = [str(float(v) + change) for v in values[2:4]]
+                    line = ' '.join(values) + '\n'
+                fOut.write(line)
+
+    def testCalibration(self):
+        print(magentaStr("\n==> Testing goctf calibration:"))
+        protCTF = self._newProtocol('calib', [1, 2, 3, 4], runSteps=(),
+                                    doCalibration=True, calibrationMics=2,
+                                    calibrationDownFactors='2')
+        protCTF._runCalibrationJob = lambda *args: self._fakeCalibrationJob(*args)
+        self.assertEqual(protCTF._getCalibrationGrid(),
+                         [(512, 1), (384, 1), (256, 1),
+                          (512, 2), (384, 2), (256, 2)])
+
+        calibStep = protCTF._steps[0]
+        self.assertEqual(calibStep.funcName, 'calibrateStep')
+        self.assertEqual(calibStep._args, (['mic001', 'mic003'],))
+        for step in protCTF._steps:
+            if step.funcName == 'convertInputStep':
+                self.assertEqual(step._prerequisites, [1])
+
+        calibStep._runFunc()
+        report = protCTF._readCalibration()
+        self.assertEqual(len(report['sweep']), 6)
+        self.assertEqual(report['reference']['meanDelta'], 0)
+        self.assertEqual(report['sweep'][1]['meanDelta'], 64)
+        self.assertEqual(report['sweep'][4]['meanDelta'], 464)
+        self.assertEqual((report['selected']['windowSize'],
+                          report['selected']['downFactor']), (384, 1))
+        self.assertEqual(protCTF._params['windowSize'], 384)
+        self.assertFalse(os.path.exists(protCTF._getTmpPath('calibration')))
+        self.assertIn("used box 384 px and downsampling 1.00",
+                      protCTF._summary()[1])
+
+        protCTF.applyCalibration.set(False)
+        protCTF._defineArgs()
+        self.assertEqual(protCTF._params['windowSize'], 512)
+
+        # Downsampling factors below 1 would replace the reference
+        self.assertEqual(protCTF._validate(), [])
+        protCTF.calibrationDownFactors.set('0.5 2')
+        self.assertEqual(protCTF._validate(),
+                         ["Calibration downsampling factors should "
+                          "be 1 or greater."])
+
+
+class TestGoCTFSubset(TestGoCTFOfflineBase):
+    """ Refinement of a subset of particles per micrograph. """
+    def testSubset(self):
+        print(magentaStr("\n==> Testing goctf with a subset of particles:"))
+        protCTF = self._newProtocol('subset', [1, 2, 3], refineSubset=True,
+                                    subsetSize=4, subsetValidationMics=1)
+
+        for micName, numRows in [('mic001', 10), ('mic002', 4), ('mic003', 4)]:
+            micFn = protCTF.micDict[micName].getFileName()
+            self.assertEqual(len(protCTF._readCoords(
+                protCTF._getCoordsFn(micFn))), numRows)
+            self.assertEqual(os.path.exists(protCTF._getAllCoordsFn(micFn)),
+                             micName != 'mic001')
+        self._fakeGoCtfOutputs(protCTF)
+
+        protCTF.createOutputStep()
+        output = protCTF.outputParticles
+        self.assertEqual(output.getSize(), 30)
+        for part in output:
+            self.assertAlmostEqual(part.getCTF().getDefocusU(),
+                                   20000. + part.getMicId())
+
+        with open(protCTF._getSubsetReportFn()) as f:
+            report = json.load(f)
+        self.assertEqual([(m['micName'], m['particles'], m['subset'],
+                           round(m['maxResidual'], 6))
+                          for m in report['micrographs']],
+                         [('mic001', 10, 4, 0.)])
+
+    def testSubsetDisabled(self):
+        with mock.patch.object(pwutils, 'cleanPath',
+                               wraps=pwutils.cleanPath) as cleanPath:
+            protCTF = self._newProtocol('nosubset', [1, 2, 3],
+                                        fitPlanes=True)
+        allCoordsFns = [protCTF._getAllCoordsFn(mic.getFileName())
+                        for mic in protCTF.micDict.values()]
+        for args, _ in cleanPath.call_args_list:
+            self.assertFalse(set(args) & set(allCoordsFns))
+
+        # File of a previous run with a subset is not used
+        writer = CoordinatesWriter(allCoordsFns[0])
+        writer.writeRows(np.zeros((3, 5)))
+        writer.close()
+        self._fakeGoCtfOutputs(protCTF)
+
+        protCTF.createOutputStep()
+        output = protCTF.outputParticles
+        self.assertEqual(output.getSize(), 30)
+        for part in output:
+            self.assertAlmostEqual(part.getCTF().getDefocusU(),
+                                   20000. + part.getMicId())
+
+
+class TestGoCTFPlanes(TestGoCTFOfflineBase):
+    """ Robust defocus plane per micrograph and outliers. """
+    def testDefocusPlanes(self):
+        print(magentaStr("\n==> Testing goctf defocus planes:"))
+        protCTF = self._newProtocol('plane', [1, 2, 3], fitPlanes=True,
+                                    outlierAction=OUTLIERS_REMOVE)
+        partSet = protCTF.inputParticles.get()
+
+        # Refined defocus increases 0.5 A per A along x, with an outlier
+        for micName in ['mic001', 'mic002', 'mic003']:
+            micFn = protCTF.micDict[micName].getFileName()
+            rows = protCTF._readCoords(protCTF._getCoordsFn(micFn), [
+                'rlnCoordinateX', 'rlnCoordinateY', 'rlnDefocusU',
+                'rlnDefocusV', 'rlnDefocusAngle'])
+            rows[:, 2:4] += 0.5 * rows[:, :1]
+            if micName == 'mic002':
+                rows[3, 2:4] += 5000
+            writer = CoordinatesWriter(protCTF._getCtfFn(micFn))
+            writer.writeRows(rows)
+            writer.close()
+
+        protCTF.createOutputStep()
+        output = SetOfParticles(
+            filename=protCTF.outputParticles.getFileName())
+        output.loadAllProperties()
+        self.assertEqual(output.getSize(), 29)
+
+        protCTF.outlierAction.set(OUTLIERS_FLAG)
+        flagged = SetOfParticles(filename=protCTF._getPath('flagged.sqlite'))
+        flagged.copyInfo(partSet)
+        protCTF._appendRefinedParticles(flagged, partSet)
+        flagged.write()
+        self.assertEqual(flagged.getSize(), 30)
+
+        outliers = [(p.getMicId(), p.getObjId()) for p in flagged
+                    if p._goctf_outlier]
+        self.assertEqual(outliers, [(2, 14)])
+        for part in flagged:
+            residual = part._goctf_defocusResidual.get()
+            if part.getMicId() == 2 and part.getObjId() == 14:
+                self.assertAlmostEqual(residual, 5000, delta=1)
+            else:
+                self.assertAlmostEqual(residual, 0, delta=0.1)
+        for part in output:
+            self.assertAlmostEqual(part._goctf_planeOffset.get(),
+                                   19500 + part.getMicId() / 2, delta=0.1)
+            self.assertAlmostEqual(part._goctf_planeSlopeX.get(), 0.5)
+            self.assertAlmostEqual(part._goctf_planeSlopeY.get(), 0)
+            self.assertFalse(part._goctf_outlier)
+
+
+class TestGoCTFConvert(TestGoCTFOfflineBase):
+    """ Conversion of the particles coordinates. """
+    def testReadMicColumns(self):
+        print(magentaStr("\n==> Testing goctf columnar conversion:"))
+        protCTF = self._newProtocol('columns', [1, 2, 3], shifts=True,
+                                    runSteps=(), applyShifts=True)
+        partSet = protCTF.inputParticles.get()
+        warnings = []
+        protCTF.warning = warnings.append
+
+        micNames = ['mic002', 'mic003']
+        columns = protCTF._readMicColumns(partSet, micNames)
+        expected = protCTF._readMicColumnsFromParticles(partSet, micNames)
+        self.assertEqual([c[0].getMicName() for c in columns], micNames)
+        self.assertEqual(len(columns), len(expected))
+        for (mic, values, matrices), (_, expValues, expMatrices) in zip(
+                columns, expected):
+            np.testing.assert_allclose(values, expValues)
+            np.testing.assert_allclose(matrices, expMatrices)
+        self.assertEqual(warnings, [])  # Not read from the particles
+
+        protCTF._writeCoordinates(micNames, 1, protCTF._getCoordsFn)
+        micFn = protCTF.micDict['mic003'].getFileName()
+        rows = protCTF._readCoords(protCTF._getCoordsFn(micFn))
+        i = np.arange(10)
+        np.testing.assert_allclose(rows, np.column_stack(
+            [100 * i - i, 50 * (i % 4) + 2 * i]))
+
+    def testReadMicColumnsClassSubset(self):
+        protCTF = self._newProtocol('classconv', [1, 2, 3], shifts=True,
+                                    runSteps=(), applyShifts=True,
+                                    inputClass=True)
+        subset = protCTF.inputParticles.get()
+        self.assertTrue(subset.getPrefix())
+        warnings = []
+        protCTF.warning = warnings.append
+
+        # Only the particles of the class, read from its tables
+        micNames = ['mic002', 'mic003']
+        columns = protCTF._readMicColumns(subset, micNames)
+        expected = protCTF._readMicColumnsFromParticles(subset, micNames)
+        self.assertEqual([c[0].getMicName() for c in columns], micNames)
+        self.assertEqual(len(columns), len(expected))
+        for (mic, values, matrices), (_, expValues, expMatrices) in zip(
+                columns, expected):
+            np.testing.assert_allclose(values[:, 0], [0, 200, 400, 600, 800])
+            np.testing.assert_allclose(values, expValues)
+            np.testing.assert_allclose(matrices, expMatrices)
+        self.assertEqual(warnings, [])
+
+    def testConvertChunks(self):
+        print(magentaStr("\n==> Testing goctf conversion in chunks:"))
+        protCTF = self._newProtocol('chunks', list(range(1, 7)), shifts=True,
+                                    applyShifts=True, ctfDownFactor=2.)
+        convSteps = [s for s in protCTF._steps
+                     if s.funcName == 'convertInputStep']
+        self.assertGreater(len(convSteps), 1)
+
+        # Same files from a single chunk, read from the database or
+        # iterating the particles as the serial conversion did
+        micNames = list(protCTF.micDict)
+        for mode in ['columns', 'particles']:
+            if mode == 'particles':
+                protCTF._readMicColumns = protCTF._readMicColumnsFromParticles
+
+            def _getCoordsFn(micFn):
+                return protCTF._getExtraPath(
+                    mode, os.path.basename(protCTF._getCoordsFn(micFn)))
+
+            pwutils.makePath(protCTF._getExtraPath(mode))
+            protCTF._writeCoordinates(micNames, 2., _getCoordsFn)
+            for mic in protCTF.micDict.values():
+                with open(protCTF._getCoordsFn(mic.getFileName())) as f1, \
+                        open(_getCoordsFn(mic.getFileName())) as f2:
+                    self.assertEqual(f1.read(), f2.read())
+
+        # Shifts truncated before scaling by 0.5
+        micFn = protCTF.micDict['mic006'].getFileName()
+        rows = protCTF._readCoords(protCTF._getCoordsFn(micFn))
+        i = np.arange(10)
+        np.testing.assert_allclose(rows, np.column_stack(
+            [(100 * i - i) / 2, (50 * (i % 4) + 2 * i) / 2]))
+
+
+class TestGoCTFCost(TestGoCTFOfflineBase):
+    """ Cost estimate and table of the times of earlier runs. """
+    def testCostEstimate(self):
+        print(magentaStr("\n==> Testing goctf cost estimate:"))
+        protCTF = self._newProtocol('cost', [1, 2, 3], estimateCost=True,
+                                    numberOfThreads=3)
+        protCTF.inputMicrographs.get()._firstDim.set((2048, 2048, 1))
+        pwutils.cleanPath(protCTF._getCostTableFn())
+
+        # Default cost model, per micrograph: 2.1s for the 4 Mpixels,
+        # 4.55s for the 91 defocus steps and 2s for the 10 particles
+        cost = protCTF._estimateCost()
+        micSeconds = 0.5 * 2048 ** 2 / 1e6 + 4.55 + 2
+        self.assertEqual(cost['micrographs'], 3)
+        self.assertEqual(cost['records'], 0)
+        self.assertAlmostEqual(cost['cpuHours'] * 3600, 3 * micSeconds)
+        self.assertAlmostEqual(cost['wallHours'] * 3600, 1.5 * micSeconds)
+        # Two micrographs converted at a time plus the 3 spectra
+        self.assertEqual(cost['tmpBytes'], 2 * 4 * 2048 ** 2 + 3 * 4 * 512 ** 2)
+        self.assertEqual(len(protCTF._warnings()), 4)
+
+        # Run where goCTF takes twice the estimated time
+        self._fakeGoCtfOutputs(protCTF)
+        with open(protCTF._getTimingFn(), 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=PhaseTimer.FIELDS,
+                                    restval=0)
+            for mic in protCTF.micDict.values():
+                for phase, wallTime in [('preprocess', 1.),
+                                        ('goctf', 2 * micSeconds - 1)]:
+                    writer.writerow({'phase': phase, 'wallTime': wallTime,
+                                     'micrograph': os.path.basename(
+                                         mic.getFileName())})
+        protCTF.createOutputStep()
+
+        records = CostModel(protCTF._getCostTableFn()).records
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[0], {'pixels': 2048 ** 2, 'windowSize': 512,
+                                      'steps': 91, 'particles': 10,
+                                      'seconds': 2 * micSeconds})
+        cost = protCTF._estimateCost()
+        self.assertEqual(cost['records'], 3)
+        self.assertAlmostEqual(cost['cpuHours'] * 3600, 6 * micSeconds)
@@ -0,0 +1,146 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import time
+import numpy as np
+import mrcfile
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from goctf.constants import COST_TABLE_SIZE, COST_DEFAULT_COEFFS
+from goctf.utils import MicrographCache, CostModel, isFloatMrc
+
+
+class TestMicrographCache(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def testCache(self):
+        cache = MicrographCache(self.getOutputPath('cache'), maxSize=250)
+        created = []
+
+        def _create(micFn, downFactor):
+            def _func(outFn):
+                created.append((micFn, downFactor))
+                with open(outFn, 'wb') as f:
+                    f.write(b'0' * 100)
+            return _func
+
+        mics = []
+        for i in range(3):
+            micFn = self.getOutputPath('mic%d.tif' % i)
+            with open(micFn, 'w') as f:
+                f.write('mic%d' % i)
+            mics.append(micFn)
+
+        def _fetch(micFn, downFactor=2.):
+            destFn = self.getOutputPath('dest.mrc')
+            hit = cache.fetch(micFn, destFn, _create(micFn, downFactor),
+                              downFactor)
+            self.assertEqual(os.path.getsize(destFn), 100)
+            time.sleep(0.01)  # Keep access times ordered
+            return hit
+
+        self.assertFalse(_fetch(mics[0]))
+        self.assertTrue(_fetch(mics[0]))
+        self.assertFalse(_fetch(mics[0], downFactor=1.))  # Other params
+        self.assertEqual(len(created), 2)
+
+        # Only two entries fit, the least recently used is removed
+        self.assertTrue(_fetch(mics[0]))
+        self.assertFalse(_fetch(mics[1]))
+        self.assertTrue(_fetch(mics[0]))
+        self.assertFalse(_fetch(mics[0], downFactor=1.))
+        self.assertEqual((cache.hits, cache.misses), (3, 4))
+
+        # A new version of the micrograph is not taken from the cache
+        with open(mics[1], 'w') as f:
+            f.write('new mic1')
+        self.assertFalse(_fetch(mics[1]))
+
+
+class TestIsFloatMrc(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def testIsFloatMrc(self):
+        def _write(fn, data):
+            fn = self.getOutputPath(fn)
+            with mrcfile.new(fn, overwrite=True) as mrc:
+                mrc.set_data(data)
+            return fn
+
+        image = np.zeros((16, 20), dtype=np.float32)
+        self.assertTrue(isFloatMrc(_write('float.mrc', image)))
+        self.assertFalse(isFloatMrc(_write('int.mrc', image.astype(np.int16))))
+        self.assertFalse(isFloatMrc(_write('stack.mrc', np.stack([image] * 2))))
+        self.assertFalse(isFloatMrc(_write('float.mrcs', image)))
+        self.assertFalse(isFloatMrc(self.getOutputPath('missing.mrc')))
+
+
+class TestCostModel(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    @staticmethod
+    def _records(n, coeffs, seed=0):
+        rng = np.random.default_rng(seed)
+        records = [{'pixels': rng.uniform(4, 16) * 1e6,
+                    'windowSize': int(rng.choice([256, 512])),
+                    'steps': int(rng.integers(10, 100)),
+                    'particles': int(rng.integers(0, 500))}
+                   for _ in range(n)]
+        seconds = CostModel.getFeatures(records) @ coeffs
+        for record, value in zip(records, seconds):
+            record['seconds'] = float(value)
+        return records
+
+    def testCostModel(self):
+        tableFn = self.getOutputPath('costs', 'table.json')
+        model = CostModel(tableFn)
+        np.testing.assert_allclose(model.fit(), COST_DEFAULT_COEFFS)
+
+        # Few records: default coefficients scaled to the measured times
+        model.addRecords(self._records(5, np.array(COST_DEFAULT_COEFFS) * 3))
+        np.testing.assert_allclose(CostModel(tableFn).fit(),
+                                   np.array(COST_DEFAULT_COEFFS) * 3)
+
+        # Enough records: coefficients fitted, the ones < 0 are dropped
+        model.records = self._records(100, [2., 0.1, 0.])
+        np.testing.assert_allclose(model.fit(), [2., 0.1, 0.], atol=1e-6)
+        model.records = self._records(100, [2., -0.1, 0.3])
+        self.assertTrue((model.fit() >= 0).all())
+
+        model = CostModel(tableFn)
+        model.addRecords(self._records(COST_TABLE_SIZE, [1., 1., 1.]))
+        self.assertEqual(len(CostModel(tableFn).records), COST_TABLE_SIZE)
+        np.testing.assert_allclose(model.predict(model.records[:3]),
+                                   [r['seconds'] for r in model.records[:3]])
@@ -0,0 +1,208 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import json
+import logging
+from unittest import mock
+
+import numpy as np
+import mrcfile
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from goctf import shard
+from goctf.workers import MicJobPool, runMicJob, isOutputUpToDate
+
+
+class TestMicJobsBase(BaseTest):
+    """ Run micrograph jobs with cp as goCTF, that copies the coordinates
+    file given in the arguments as the goCTF output. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _newJob(self, name, floatMrc=True):
+        """ Return the job of a micrograph, written as a float mrc or as
+        an empty file that can not be converted. """
+        micPath = self.getOutputPath(name)
+        os.makedirs(micPath, exist_ok=True)
+        micFn = self.getOutputPath(name + '.mrc')
+        if floatMrc:
+            with mrcfile.new(micFn, overwrite=True) as mrc:
+                mrc.set_data(np.zeros((16, 16), dtype=np.float32))
+        else:
+            open(micFn, 'w').close()
+        coordsFn = os.path.join(micPath, name + '_go.star')
+        with open(coordsFn, 'w') as f:
+            f.write("\ndata_\n\nloop_\n_rlnCoordinateX #1\n"
+                    "_rlnCoordinateY #2\n_rlnDefocusU #3\n"
+                    "_rlnDefocusV #4\n_rlnDefocusAngle #5\n"
+                    "10 20 20000 19000 45\n30 40 20000 19000 45\n")
+        ctfFn = os.path.join(micPath, name + '_goCTF.star')
+        return {'micFn': micFn,
+                'micPath': micPath,
+                'micFnMrc': os.path.join(micPath, name + '.mrc'),
+                'downFactor': 1,
+                'program': 'cp',
+                'args': '%s %s' % (coordsFn, ctfFn),
+                'env': None,
+                'ctfFn': ctfFn,
+                'fingerprint': 'fingerprint-' + name,
+                'fingerprintFn': os.path.join(micPath, name + '_goCTF.sha1'),
+                'clean': True,
+                'cachePath': None,
+                'cacheSize': None,
+                'timingFn': self.getOutputPath('timing.csv')}
+
+
+class TestMicJobPool(TestMicJobsBase):
+    def testRunMicJob(self):
+        job = self._newJob('job_ok')
+        result = runMicJob(job, log=logging.getLogger(__name__))
+        self.assertEqual(result['refined'], 2)
+        self.assertIsNone(result['error'])
+        self.assertTrue(isOutputUpToDate(job['ctfFn'], job['fingerprintFn'],
+                                         job['fingerprint']))
+        self.assertFalse(os.path.lexists(job['micFnMrc']))  # Cleaned
+
+        # An empty file is not a micrograph that can be converted
+        job = self._newJob('job_bad', floatMrc=False)
+        result = runMicJob(job, log=logging.getLogger(__name__))
+        self.assertIsNone(result['refined'])
+        self.assertTrue(result['error'])
+        self.assertFalse(os.path.exists(job['ctfFn']))
+
+    def testStaleMicrograph(self):
+        def _preprocessMic(micFn, outFn, downFactor):
+            with open(outFn, 'wb') as f:
+                f.write(b'downsampled')
+
+        # Link to the input left by a failed run, now with downsampling
+        job = self._newJob('job_link')
+        job.update(downFactor=2, clean=False)
+        with open(job['micFn'], 'rb') as f:
+            micData = f.read()
+        os.symlink(job['micFn'], job['micFnMrc'])
+        with mock.patch('goctf.workers.preprocessMic',
+                        side_effect=_preprocessMic):
+            result = runMicJob(job, log=logging.getLogger(__name__))
+        self.assertIsNone(result['error'])
+        self.assertFalse(os.path.islink(job['micFnMrc']))
+        with open(job['micFn'], 'rb') as f:
+            self.assertEqual(f.read(), micData)
+
+        # Converted file left by a failed run, now linked to the input
+        job['downFactor'] = 1
+        result = runMicJob(job, log=logging.getLogger(__name__))
+        self.assertIsNone(result['error'])
+        self.assertEqual(result['refined'], 2)
+        self.assertTrue(os.path.islink(job['micFnMrc']))
+
+    def testPool(self):
+        jobs = [self._newJob('pool_%d' % i) for i in range(6)]
+        jobs[2] = self._newJob('pool_bad', floatMrc=False)
+        # A job that makes runMicJob fail in the worker process
+        jobs[4] = dict(jobs[4])
+        del jobs[4]['micFnMrc']
+
+        pool = MicJobPool(2, maxPending=2)
+        try:
+            results = {r['micFn']: r for r in pool.run(jobs)}
+        finally:
+            pool.shutdown()
+
+        self.assertEqual(set(results), set(job['micFn'] for job in jobs))
+        for i, job in enumerate(jobs):
+            result = results[job['micFn']]
+            if i in [2, 4]:
+                self.assertIsNone(result['refined'])
+                self.assertTrue(result['error'])
+            else:
+                self.assertEqual(result['refined'], 2)
+                self.assertIsNone(result['error'])
+
+    def testShutdown(self):
+        jobs = [self._newJob('shutdown_%d' % i) for i in range(8)]
+        pool = MicJobPool(1, maxPending=2)
+        results = pool.run(jobs)
+        first = next(results)
+        self.assertIsNone(first['error'])
+        results.close()  # Pending jobs are cancelled
+        pool.shutdown()
+
+        done = [job for job in jobs if os.path.exists(job['ctfFn'])]
+        self.assertLess(len(done), len(jobs))
+        self.assertIn(first['micFn'], [job['micFn'] for job in done])
+
+        # Shut down while a run is still waiting for its jobs
+        jobs = [self._newJob('shutdown_run_%d' % i) for i in range(8)]
+        pool = MicJobPool(1, maxPending=8)
+        results = pool.run(jobs)
+        next(results)
+        with mock.patch.object(pool._executor, 'shutdown',
+                               wraps=pool._executor.shutdown) as shutdown:
+            pool.shutdown()
+        # No cancel_futures, that python 3.8 does not have
+        shutdown.assert_called_once_with(wait=True)
+        results.close()
+        done = [job for job in jobs if os.path.exists(job['ctfFn'])]
+        self.assertLess(len(done), len(jobs))
+
+
+class TestShard(TestMicJobsBase):
+    def _writeShard(self, jobs):
+        shardFn = self.getOutputPath('shard.json')
+        for job in jobs:
+            job['doneFn'] = job['ctfFn'].replace('_goCTF.star', '.TXT')
+        with open(shardFn, 'w') as f:
+            json.dump(jobs, f)
+        return shardFn
+
+    def testShard(self):
+        jobs = [self._newJob('shard_%d' % i) for i in range(3)]
+        shardFn = self._writeShard(jobs)
+        self.assertEqual(shard.main(shardFn), 0)
+        for job in jobs:
+            self.assertTrue(os.path.exists(job['ctfFn']))
+            self.assertTrue(os.path.exists(job['doneFn']))
+
+        # Run again: up to date outputs are skipped, the other ones rerun
+        jobs[1]['fingerprint'] = 'changed'
+        for job in jobs:
+            job['program'] = 'false'
+        shardFn = self._writeShard(jobs)
+        self.assertEqual(shard.main(shardFn), 1)
+        self.assertEqual([os.path.exists(job['ctfFn']) for job in jobs],
+                         [True, False, True])
+
+        # A failed micrograph makes the shard fail
+        jobs = [self._newJob('shard_ok'),
+                self._newJob('shard_bad', floatMrc=False)]
+        self.assertEqual(shard.main(self._writeShard(jobs)), 1)
+        self.assertTrue(os.path.exists(jobs[0]['ctfFn']))
+        self.assertTrue(all(os.path.exists(job['doneFn']) for job in jobs))
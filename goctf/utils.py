@@ -0,0 +1,322 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import csv
+import json
+import time
+import shutil
+import struct
+import hashlib
+import resource
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+import pyworkflow.utils as pwutils
+
+from .constants import COST_TABLE_SIZE, COST_MIN_RECORDS, COST_DEFAULT_COEFFS
+
+
+class MicrographCache:
+    """ Size bounded cache of preprocessed micrographs that can be
+    shared by several runs. Each entry is a file named after a hash of
+    the source file identity (path, size and modification time) and the
+    preprocessing parameters. When the cache grows beyond maxSize, the
+    least recently used entries (by modification time) are removed.
+    """
+    def __init__(self, path, maxSize):
+        """
+        Params:
+            path: cache folder, it will be created if it does not exist.
+            maxSize: maximum size of the cache in bytes.
+        """
+        self.path = path
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        pwutils.makePath(path)
+
+    def getKey(self, micFn, *params):
+        """ Return the key for a micrograph file and preprocessing params. """
+        st = os.stat(micFn)
+        identity = [os.path.realpath(micFn), st.st_size, st.st_mtime_ns]
+        identity.extend(params)
+        return hashlib.sha1(repr(identity).encode()).hexdigest()
+
+    def fetch(self, micFn, destFn, createFunc, *params):
+        """ Put in destFn (as a hard link or a copy) the cached file for
+        micFn and params. If not in the cache, createFunc(outputFn) is
+        called to generate it. Return True if it was found in the cache.
+        """
+        key = self.getKey(micFn, *params)
+        cachedFn = os.path.join(self.path, key + '.mrc')
+
+        try:
+            linkOrCopy(cachedFn, destFn)
+            os.utime(cachedFn)  # Mark as recently used
+            with self._lock:
+                self.hits += 1
+            return True
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            self.misses += 1
+        # Create in a temporary file, other processes may be using the cache
+        tmpFn = os.path.join(self.path, '%s_%d_%d.tmp.mrc'
+                             % (key, os.getpid(), threading.get_ident()))
+        try:
+            createFunc(tmpFn)
+            linkOrCopy(tmpFn, destFn)
+            os.replace(tmpFn, cachedFn)
+        finally:
+            pwutils.cleanPath(tmpFn)
+
+        self._evict()
+
+        return False
+
+    def _evict(self):
+        """ Remove the least recently used entries until
+        the cache size is below maxSize. """
+        entries = []
+        for fn in os.listdir(self.path):
+            if fn.endswith('.mrc') and not fn.endswith('.tmp.mrc'):
+                try:
+                    st = os.stat(os.path.join(self.path, fn))
+                    entries.append((st.st_mtime, st.st_size, fn))
+                except FileNotFoundError:  # removed by other process
+                    pass
+
+        total = sum(e[1] for e in entries)
+        for _, size, fn in sorted(entries):
+            if total <= self.maxSize:
+                break
+            pwutils.cleanPath(os.path.join(self.path, fn))
+            total -= size
+
+    def getStats(self):
+        return f"{self.hits} hits, {self.misses} misses"
+
+
+def linkOrCopy(source, dest):
+    """ Hard link source to dest (so it is kept even if source is removed)
+    or copy it if the link can not be done (e.g. different file systems).
+    """
+    pwutils.cleanPath(dest)
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy(source, dest)
+
+
+def isFloatMrc(fn):
+    """ Return True if fn is a single image MRC file in float32 mode
+    and little endian, so it can be passed to goCTF without conversion.
+    """
+    if not fn.lower().endswith('.mrc'):
+        return False
+    try:
+        with open(fn, 'rb') as f:
+            header = f.read(1024)
+    except OSError:
+        return False
+    if len(header) < 1024:
+        return False
+
+    # nx, ny, nz and mode are the first words of the header,
+    # the machine stamp at byte 212 tells the byte order
+    nx, ny, nz, mode = struct.unpack('<4i', header[:16])
+    littleEndian = header[212:214] in (b'\x44\x44', b'\x44\x41')
+    return littleEndian and mode == 2 and nz == 1 and nx > 0 and ny > 0
+
+
+class PhaseTimer:
+    """ Record in a CSV file the wall time, CPU time, peak memory and
+    I/O of processing phases (e.g. the conversion or goCTF run for
+    a micrograph). Except for the wall time, values are measured for
+    the whole process (including its finished child processes), so
+    they overlap when several phases run at the same time in threads.
+    """
+    FIELDS = ['phase', 'micrograph', 'start', 'wallTime', 'cpuTime',
+              'maxRss', 'readBytes', 'writeBytes']
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, phase, micrograph=''):
+        """ Context manager to record the code inside as a phase. """
+        start = time.time()
+        t0 = time.perf_counter()
+        cpu0, _, read0, write0 = _getUsage()
+        try:
+            yield
+        finally:
+            wallTime = time.perf_counter() - t0
+            cpu1, maxRss, read1, write1 = _getUsage()
+            self._write({'phase': phase,
+                         'micrograph': micrograph,
+                         'start': '%0.3f' % start,
+                         'wallTime': '%0.3f' % wallTime,
+                         'cpuTime': '%0.3f' % (cpu1 - cpu0),
+                         'maxRss': maxRss,
+                         'readBytes': read1 - read0,
+                         'writeBytes': write1 - write0})
+
+    def _write(self, row):
+        with self._lock:
+            newFile = not os.path.exists(self.filename)
+            with open(self.filename, 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+                if newFile:
+                    writer.writeheader()
+                writer.writerow(row)
+
+
+def readPhaseTimes(filename):
+    """ Return a dict {phase: (count, wallTime, cpuTime)} with the totals
+    per phase from a PhaseTimer file, in order of appearance.
+    """
+    totals = OrderedDict()
+    with open(filename, newline='') as f:
+        for row in csv.DictReader(f):
+            count, wall, cpu = totals.get(row['phase'], (0, 0., 0.))
+            totals[row['phase']] = (count + 1, wall + float(row['wallTime']),
+                                    cpu + float(row['cpuTime']))
+    return totals
+
+
+def readMicPhaseTimes(filename, phases):
+    """ Return a dict {micrograph: wallTime} with the sum of the wall
+    times of the given phases of each micrograph in a PhaseTimer file.
+    Only the last time of each phase is used, when a micrograph was
+    processed several times (e.g. in a continued run).
+    """
+    times = {}
+    with open(filename, newline='') as f:
+        for row in csv.DictReader(f):
+            if row['phase'] in phases and row['micrograph']:
+                times[(row['micrograph'], row['phase'])] = float(row['wallTime'])
+
+    micTimes = {}
+    for (micrograph, _), wallTime in times.items():
+        micTimes[micrograph] = micTimes.get(micrograph, 0.) + wallTime
+    return micTimes
+
+
+class CostModel:
+    """ Linear model of the time (seconds of one core) to preprocess a
+    micrograph and run goCTF on it. The features are its number of
+    pixels (after downsampling), the defocus search steps and the
+    refined particles, these two scaled by the FFT box area.
+    The coefficients are fitted to a table of records measured in earlier
+    runs (dicts with pixels, windowSize, steps, particles and seconds),
+    stored as json in filename. The default coefficients (scaled to the
+    measured times) are used while the table has few records.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = []
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                self.records = json.load(f)
+
+    @staticmethod
+    def getFeatures(records):
+        """ Return the (N, 3) features of the records. """
+        features = [(r['pixels'] / 1e6,
+                     r['steps'] * (r['windowSize'] / 512.) ** 2,
+                     r['particles'] * (r['windowSize'] / 512.) ** 2)
+                    for r in records]
+        return np.array(features, dtype=float).reshape(-1, 3)
+
+    def addRecords(self, records):
+        """ Add the records to the table and write it, keeping only
+        the last COST_TABLE_SIZE ones. """
+        self.records = (self.records + list(records))[-COST_TABLE_SIZE:]
+        pwutils.makePath(os.path.dirname(self.filename))
+        tmpFn = self.filename + '.%d.tmp' % os.getpid()
+        with open(tmpFn, 'w') as f:
+            json.dump(self.records, f)
+        os.replace(tmpFn, self.filename)  # Other runs may read it now
+
+    def fit(self):
+        """ Return the model coefficients, non negative. """
+        coeffs = np.array(COST_DEFAULT_COEFFS, dtype=float)
+        if not self.records:
+            return coeffs
+
+        features = self.getFeatures(self.records)
+        seconds = np.array([r['seconds'] for r in self.records], dtype=float)
+        if len(self.records) >= COST_MIN_RECORDS:
+            # Least squares, dropping the features with negative
+            # coefficient until all of them are positive
+            active = np.ones(len(coeffs), dtype=bool)
+            while active.any():
+                fitted = np.zeros(len(coeffs))
+                fitted[active] = np.linalg.lstsq(features[:, active],
+                                                 seconds, rcond=None)[0]
+                if (fitted >= 0).all():
+                    if fitted.any():
+                        return fitted
+                    break
+                active &= fitted > 0
+
+        predicted = (features @ coeffs).sum()
+        if predicted > 0:
+            coeffs *= seconds.sum() / predicted
+        return coeffs
+
+    def predict(self, records):
+        """ Return the expected seconds for each record. """
+        return self.getFeatures(records) @ self.fit()
+
+
+def _getUsage():
+    """ Return the process CPU time, peak RSS (bytes) and
+    bytes read and written (including finished children). """
+    cpuTime = maxRss = 0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        cpuTime += usage.ru_utime + usage.ru_stime
+        maxRss = max(maxRss, usage.ru_maxrss * 1024)  # kB in Linux
+
+    io = {}
+    try:  # Only available in Linux
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                io[key] = int(value)
+    except OSError:
+        pass
+
+    return cpuTime, maxRss, io.get('rchar', 0), io.get('wchar', 0)
@@ -0,0 +1,217 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [1]
+# *
+# * [1] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Per micrograph goCTF pipeline (preprocessing, goCTF run and parsing of its
+output). It only depends on the values in a job dict, so it can be run by
+the protocol steps threads or by a pool of worker processes.
+"""
+
+import os
+import logging
+import traceback
+
+import pyworkflow.utils as pwutils
+
+from .convert import readCtfValues
+from .utils import MicrographCache, PhaseTimer, isFloatMrc
+
+logger = logging.getLogger(__name__)
+
+# Micrographs caches and timers of a worker process, by path
+_processCaches = {}
+_processTimers = {}
+
+
+def runMicJob(job, log=None, runJob=None, cache=None, timer=None):
+    """ Preprocess a micrograph, run goCTF on it and read its output.
+    Params:
+        job: dict with the values of a micrograph, see
+            ProtGoCTF._getMicJob for the keys.
+        log: object with info and error methods, the module logger
+            if None.
+        runJob: function(program, args, env, cwd) to launch goCTF,
+            pwutils.runJob if None.
+        cache, timer: MicrographCache and PhaseTimer to use, if None
+            they are created (once per process) from the job values.
+    Return a dict with the micrograph file name, if it was found in the
+    cache, the number of refined particles (None if goCTF failed) and
+    the error message, if any.
+    """
+    log = log or logger
+    if runJob is None:
+        def runJob(program, args, env, cwd):
+            pwutils.runJob(log, program, args, env=env, cwd=cwd)
+    if cache is None and job['cachePath']:
+        if job['cachePath'] not in _processCaches:
+            _processCaches[job['cachePath']] = MicrographCache(
+                job['cachePath'], job['cacheSize'])
+        cache = _processCaches[job['cachePath']]
+    if timer is None:
+        if job['timingFn'] not in _processTimers:
+            _processTimers[job['timingFn']] = PhaseTimer(job['timingFn'])
+        timer = _processTimers[job['timingFn']]
+
+    micFn, micFnMrc = job['micFn'], job['micFnMrc']
+    downFactor = job['downFactor']
+    micBase = os.path.basename(micFn)
+    result = {'micFn': micFn, 'cacheHit': None, 'refined': None,
+              'error': None}
+
+    # Errors are kept in the result, so the other micrographs
+    # of the same step or worker can still be processed
+    try:
+        # Outputs of a previous run with other inputs, so they are not
+        # taken as the result of this one if it fails. The micrograph of
+        # a failed run may be a link to the input, that would be
+        # overwritten by the conversion
+        pwutils.cleanPath(job['ctfFn'], job['fingerprintFn'], micFnMrc)
+
+        with timer.phase('preprocess', micBase):
+            if downFactor == 1 and isFloatMrc(micFn):
+                # goCTF can read the input directly, avoid rewriting it
+                pwutils.createAbsLink(micFn, micFnMrc)
+            elif cache is not None:
+                result['cacheHit'] = cache.fetch(
+                    micFn, micFnMrc,
+                    lambda outFn: preprocessMic(micFn, outFn, downFactor),
+                    downFactor)
+                log.info(f"Micrograph cache "
+                         f"{'hit' if result['cacheHit'] else 'miss'} for "
+                         f"{micFn} ({cache.getStats()})")
+            else:
+                preprocessMic(micFn, micFnMrc, downFactor)
+
+        # Run goCTF
+        with timer.phase('goctf', micBase):
+            runJob(job['program'], job['args'], env=job['env'],
+                   cwd=job['micPath'])
+
+        ctfFn = job['ctfFn']
+        if os.path.exists(ctfFn):
+            values = readCtfValues(ctfFn)
+            result['refined'] = 0 if values is None else len(values)
+            with open(job['fingerprintFn'], 'w') as f:
+                f.write(job['fingerprint'])
+
+        # Let's clean the temporary mrc micrograph
+        if job['clean']:
+            pwutils.cleanPath(micFnMrc)
+
+    except Exception as e:
+        log.error(f"ERROR: goCTF has failed on {micFn}")
+        traceback.print_exc()
+        result['error'] = str(e)
+
+    return result
+
+
+def isOutputUpToDate(ctfFn, fingerprintFn, fingerprint):
+    """ Return True if the goCTF output ctfFn exists and the fingerprint
+    of the inputs that produced it (stored in fingerprintFn) is the
+    given one. """
+    if not (os.path.exists(ctfFn) and os.path.exists(fingerprintFn)):
+        return False
+
+    with open(fingerprintFn) as f:
+        return f.read().strip() == fingerprint
+
+
+def preprocessMic(micFn, outFn, downFactor):
+    """ Write micFn as a float mrc, downsampled if downFactor != 1. """
+    from pwem import emlib
+    ih = emlib.image.ImageHandler()
+    if downFactor != 1:
+        ih.scaleFourier(micFn, outFn, downFactor)
+    else:
+        ih.convert(micFn, outFn, emlib.DT_FLOAT)
+
+
+class MicJobPool:
+    """ Pool of worker processes to run micrograph jobs in a single node.
+    The number of jobs submitted and not finished is bounded, so the
+    pending work is kept by the caller and the pool can be shut down
+    at any time without losing much done work.
+    """
+    def __init__(self, numWorkers, maxPending=None):
+        """
+        Params:
+            numWorkers: number of worker processes.
+            maxPending: maximum number of jobs submitted to the workers
+                at a time, twice the number of workers by default.
+        """
+        self.numWorkers = numWorkers
+        self.maxPending = maxPending or 2 * numWorkers
+        # Imported here, the protocol module is loaded by every Scipion
+        # process but the pool only by the ones running the steps
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # Workers are started with spawn, forking a process
+        # with several running threads is not safe
+        self._executor = ProcessPoolExecutor(
+            max_workers=numWorkers,
+            mp_context=multiprocessing.get_context('spawn'))
+        self._futures = set()  # Submitted and not finished, of all runs
+
+    def run(self, jobs):
+        """ Run the jobs and yield their results as they finish. """
+        from concurrent.futures import FIRST_COMPLETED, wait
+        jobs = iter(jobs)
+        pending = {}  # Job of each submitted future
+        try:
+            while True:
+                for job in jobs:
+                    future = self._executor.submit(runMicJob, job)
+                    self._futures.add(future)
+                    future.add_done_callback(self._futures.discard)
+                    pending[future] = job
+                    if len(pending) >= self.maxPending:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # e.g. a worker process that died, the other
+                        # micrographs can still be processed
+                        logger.error(f"ERROR: goCTF job has failed on "
+                                     f"{job['micFn']}: {e}")
+                        result = {'micFn': job['micFn'], 'cacheHit': None,
+                                  'refined': None, 'error': str(e)}
+                    yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def shutdown(self):
+        """ Cancel the jobs not started and wait for the running ones. """
+        # Executor.shutdown can not cancel them before python 3.9
+        for future in list(self._futures):
+            future.cancel()
+        self._executor.shutdown(wait=True)